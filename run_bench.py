@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Name: unball throughput benchmark
+
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+Generates a deterministic corpus of synthetic archives, then times
+L{tryExtract} on each one with every viable extractor for its mimetype.
+
+Each corpus entry is described by a spec with these axes:
+ - C{size}: Total uncompressed payload size in bytes.
+ - C{members}: Number of files in the archive.
+ - C{distribution}: C{uniform} (equal sizes) or C{skewed} (Pareto-like).
+ - C{compressibility}: Fraction (0 to 1) of the payload which is repetitive
+   text rather than incompressible noise.
+ - C{format}: A container (C{tar} or C{zip}, optional) followed by one or more
+   compression layers, so C{tar.gz} is two levels deep and C{tar.gz.bz2}
+   three. (C{7z} layers require a 7-Zip binary in the C{PATH})
+
+C{--startup} instead checks start-up time against L{STARTUP_BUDGET}.
+
+Every run happens in a fresh child process so wall time, CPU time (including
+subprocesses), and peak RSS aren't skewed by earlier runs. Results are
+written as JSON for comparison across versions and machines.
+
+@todo: Add cpio, ar, and rar containers when their tools are available.
+"""
+
+__author__ = "Stephan Sokolow (deitarion)"
+__license__ = "GNU GPL 2.0 or later"
+
+import binascii, bz2, gzip, hashlib, io, json, os, platform, random, shutil
+import subprocess, sys, tarfile, tempfile, time, zipfile
+
+from optparse import OptionParser
+
+BASE_SPEC = {
+    'size': 8 * 1024 ** 2,
+    'members': 64,
+    'distribution': 'uniform',
+    'compressibility': 0.5,
+    'format': 'tar.gz',
+    'seed': 0,
+}
+"""The corpus entry every axis in L{AXES} is varied from."""
+
+AXES = [
+    ('size', [1024 ** 2, 8 * 1024 ** 2, 64 * 1024 ** 2]),
+    ('members', [1, 64, 4096]),
+    ('distribution', ['uniform', 'skewed']),
+    ('compressibility', [0.0, 0.5, 0.95]),
+    ('format', ['tar', 'zip', 'gz', 'bz2', 'tar.gz', 'tar.bz2', 'tar.7z',
+                'tar.gz.bz2']),
+]
+"""Values to try for each axis, one axis at a time."""
+
+QUICK_AXES = [
+    ('size', [256 * 1024, 1024 ** 2]),
+    ('members', [1, 256]),
+    ('compressibility', [0.0, 0.95]),
+    ('format', ['tar', 'zip', 'gz', 'bz2', 'tar.gz', 'tar.bz2', 'tar.7z']),
+]
+"""A smaller set of axes for C{--quick} runs."""
+
+BLOCK_SIZE = 4096  #: Granularity at which compressibility is mixed
+
+STARTUP_SPEC = dict(BASE_SPEC, size=16 * 1024, members=4, format='zip')
+"""The small archive extracted by the C{--startup} benchmark."""
+
+STARTUP_BUDGET = {
+    'version': 0.035,
+    'extract': 0.055,
+}
+"""How many seconds each C{--startup} scenario may take beyond starting a
+bare interpreter. (Fastest of C{--repeat} runs, with warm caches)"""
+
+class SkipSpec(Exception):
+    """The corpus entry can't be built on this system."""
+
+#{ Corpus generation
+
+def corpus_specs(axes=AXES, base=BASE_SPEC):
+    """Return the list of specs obtained by varying each axis of C{base}
+    in turn. (Duplicates removed, order preserved)"""
+    specs = []
+    for axis, values in axes:
+        for value in values:
+            spec = dict(base)
+            spec[axis] = value
+            if spec not in specs:
+                specs.append(spec)
+    return specs
+
+def spec_name(spec):
+    """Return a filename-safe identifier for C{spec}. (Without extension)"""
+    return ('%(size)d-%(members)dm-%(distribution)s-c%(compressibility)g-'
+            's%(seed)d' % spec)
+
+def _noise(seed, length):
+    """Return C{length} deterministic, incompressible bytes.
+    (A SHA-512 keystream, so it's the same on every Python and platform)"""
+    chunks, counter = [], 0
+    while length > 0:
+        chunk = hashlib.sha512(('%s:%d' % (seed, counter)).encode('ascii')
+                               ).digest()[:length]
+        chunks.append(chunk)
+        length -= len(chunk)
+        counter += 1
+    return b''.join(chunks)
+
+def member_sizes(spec, rand):
+    """Split C{spec['size']} into C{spec['members']} file sizes."""
+    count = max(1, spec['members'])
+    if spec['distribution'] == 'skewed':
+        weights = [rand.paretovariate(1.2) for _ in range(count)]
+    else:
+        weights = [1.0] * count
+    total = sum(weights)
+    sizes = [int(spec['size'] * x / total) for x in weights]
+    sizes[0] += spec['size'] - sum(sizes)  # Keep the total exact
+    return sizes
+
+def member_data(spec, index, size, rand, words):
+    """Generate the contents of one member as C{bytes}.
+    @param words: The vocabulary for compressible blocks."""
+    parts, remaining, block = [], size, 0
+    while remaining > 0:
+        length = min(BLOCK_SIZE, remaining)
+        if rand.random() < spec['compressibility']:
+            # Not rand.choice(), which differs between Python 2 and 3
+            text = ' '.join(words[int(rand.random() * len(words))]
+                            for _ in range(length // 8))
+            parts.append((text.encode('ascii') + b'\n' * length)[:length])
+        else:
+            parts.append(_noise('%s:%d:%d' % (spec['seed'], index, block),
+                                length))
+        remaining -= length
+        block += 1
+    return b''.join(parts)
+
+def _members(spec):
+    """Yield C{(name, data)} for every member of C{spec}."""
+    rand = random.Random(spec['seed'])
+    words = [binascii.hexlify(_noise('%s:word:%d' % (spec['seed'], x),
+                                     3 + x % 7)).decode('ascii')
+             for x in range(64)]
+    for index, size in enumerate(member_sizes(spec, rand)):
+        name = 'payload/dir%02d/file%05d.dat' % (index % 16, index)
+        yield name, member_data(spec, index, size, rand, words)
+
+def _find_7z():
+    """Return the name of an available 7-Zip binary or C{None}."""
+    from unball.util import which
+    for name in ('7z', '7za', '7zr'):
+        if which(name):
+            return name
+    return None
+
+def _compress(path, layer):
+    """Wrap the file at C{path} in a compression C{layer}, replacing it.
+    @return: The new path.
+    """
+    out_path = '%s.%s' % (path, layer)
+    if layer in ('gz', 'bz2'):
+        with open(path, 'rb') as src:
+            if layer == 'gz':  # Fixed mtime for reproducible output
+                dst = gzip.GzipFile(out_path, 'wb', mtime=0)
+            else:
+                dst = bz2.BZ2File(out_path, 'wb')
+            try:
+                shutil.copyfileobj(src, dst, 1024 ** 2)
+            finally:
+                dst.close()
+    elif layer == '7z':
+        binary = _find_7z()
+        if not binary:
+            raise SkipSpec("No 7-Zip binary for .7z layers")
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call([binary, 'a', '-bd', out_path, path],
+                                  stdout=null, stderr=null)
+    else:
+        raise ValueError("Unknown compression layer: %s" % layer)
+    os.remove(path)
+    return out_path
+
+def build_archive(spec, outdir):
+    """Generate the archive described by C{spec} in C{outdir} unless an
+    identical one is already there.
+
+    Generation is deterministic: payloads are identical everywhere and
+    archives are byte-identical for a given Python version. (C{tarfile} and
+    C{zipfile} header details vary between versions)
+
+    @return: The path to the archive.
+    @raises SkipSpec: A tool needed for C{spec['format']} is missing.
+    """
+    layers = spec['format'].split('.')
+    final = os.path.join(outdir, '%s.%s' % (spec_name(spec), spec['format']))
+    if os.path.exists(final):
+        return final
+
+    path = os.path.join(outdir, spec_name(spec))
+    container = layers[0] in ('tar', 'zip') and layers.pop(0) or None
+    if container == 'tar':
+        path += '.tar'
+        archive = tarfile.open(path, 'w', format=tarfile.GNU_FORMAT)
+        for name, data in _members(spec):
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime, info.mode = len(data), 1000000000, 0o644
+            archive.addfile(info, io.BytesIO(data))
+        archive.close()
+    elif container == 'zip':
+        path += '.zip'
+        archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        for name, data in _members(spec):
+            info = zipfile.ZipInfo(name, (2001, 9, 9, 1, 46, 40))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            archive.writestr(info, data)
+        archive.close()
+    else:
+        single = dict(spec, members=1)
+        with open(path, 'wb') as fobj:
+            for _, data in _members(single):
+                fobj.write(data)
+
+    try:
+        for layer in layers:
+            path = _compress(path, layer)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path
+
+#}
+#{ Measurement
+
+def _measure(archive, mime, index):
+    """Child process side of L{measure}: extract C{archive} with the
+    C{index}th viable extractor for C{mime} and return the metrics."""
+    import resource
+    from unball import main as unball_main
+    from unball.extractors import get_dispatch_table
+    from unball.util import tree_size
+
+    chosen = get_dispatch_table().resolve(mime)[index]
+    resolve = unball_main.mimeToExtractor
+    unball_main.mimeToExtractor = lambda x: (x == mime and [chosen] or
+                                             resolve(x))
+
+    workdir = tempfile.mkdtemp(prefix='unball-bench-')
+    try:
+        cpu_before = sum(os.times()[:4])
+        started = time.time()
+        target = unball_main.tryExtract(archive, workdir)
+        wall = time.time() - started
+        cpu = sum(os.times()[:4]) - cpu_before
+        bytes_out = tree_size(target)
+    finally:
+        shutil.rmtree(workdir)
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        peak //= 1024  # Bytes there, KiB on Linux
+    return {
+        'extractor': repr(chosen),
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'peak_rss_kib': peak,
+        'bytes_out': bytes_out,
+        'bytes_per_second': bytes_out / (wall or 1e-9),
+    }
+
+def measure(archive, mime, index):
+    """Run L{_measure} in a fresh interpreter so each measurement starts
+    from a clean heap and C{RUSAGE_CHILDREN} only counts its own tools."""
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             '--child', json.dumps([archive, mime, index])],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode:
+        return {'error': err.decode('utf8', 'replace').strip().split('\n')[-1]}
+    return json.loads(out.decode('utf8'))
+
+def viable_extractors(mime):
+    """Return the reprs of all viable extractors for C{mime}, in order."""
+    from unball.extractors import get_dispatch_table
+    return [repr(x) for x in get_dispatch_table().resolve(mime)]
+
+def run(specs, corpus_dir, repeat=1, log=sys.stderr):
+    """Build and benchmark every spec in C{specs}.
+
+    @return: A list of result dicts. (One per spec and extractor)
+    """
+    from unball.extractors import EXTRACTORS
+    from unball.mimetypes import pathToMimetype
+
+    results = []
+    for spec in specs:
+        entry = dict(spec)
+        try:
+            started = time.time()
+            archive = build_archive(spec, corpus_dir)
+        except SkipSpec as err:
+            entry['skipped'] = str(err)
+            results.append(entry)
+            log.write("SKIP %s.%s: %s\n" % (spec_name(spec), spec['format'],
+                                            err))
+            continue
+        log.write("Built %s in %.1fs\n" % (os.path.basename(archive),
+                                           time.time() - started))
+
+        mime = pathToMimetype(archive, EXTRACTORS)
+        entry.update(archive=os.path.basename(archive), mime=mime,
+                     bytes_in=os.path.getsize(archive))
+        for index, name in enumerate(viable_extractors(mime)):
+            runs = [measure(archive, mime, index) for _ in range(repeat)]
+            ok = [x for x in runs if 'error' not in x]
+            result = dict(entry, extractor=name, runs=len(runs))
+            if ok:  # Report the fastest run, as is usual for benchmarks
+                result.update(min(ok, key=lambda x: x['wall_seconds']))
+            else:
+                result['error'] = runs[-1]['error']
+            results.append(result)
+            log.write("  %-40s %s\n" % (name, 'error' in result and
+                "ERROR: %s" % result['error'] or "%.3fs %.1f MiB/s" % (
+                    result['wall_seconds'],
+                    result['bytes_per_second'] / 1024 ** 2)))
+    return results
+
+def _time_command(argv, repeat, setup=None):
+    """Return the fastest wall time for running C{argv} C{repeat} times.
+    (C{setup}, if given, is called untimed before each run)"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__))] +
+        [x for x in [os.environ.get('PYTHONPATH')] if x]))
+    best = None
+    with open(os.devnull, 'w') as null:
+        for _ in range(repeat):
+            if setup:
+                setup()
+            started = time.time()
+            subprocess.check_call(argv, stdout=null, env=env)
+            elapsed = time.time() - started
+            best = min(best or elapsed, elapsed)
+    return best
+
+def startup(corpus_dir, repeat=10, budget=STARTUP_BUDGET):
+    """Time C{unball --version} and the extraction of one small archive in
+    fresh interpreters and compare their overhead against C{budget}.
+
+    @return: A dict of results per scenario, plus the C{baseline} time for
+        C{python -c pass}.
+    """
+    archive = build_archive(STARTUP_SPEC, corpus_dir)
+    outdir = os.path.join(corpus_dir, 'startup-out')
+
+    def clean():
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        os.mkdir(outdir)
+
+    unball = [sys.executable, '-m', 'unball.main']
+    scenarios = {
+        'version': (unball + ['--version'], None),
+        'extract': (unball + ['-d', outdir, archive], clean),
+    }
+
+    # Warm the OS page cache and unball's dispatch table cache first
+    for argv, setup in scenarios.values():
+        _time_command(argv, 1, setup)
+
+    baseline = _time_command([sys.executable, '-c', 'pass'], repeat)
+    results = {'baseline_seconds': baseline}
+    for name, (argv, setup) in sorted(scenarios.items()):
+        seconds = _time_command(argv, repeat, setup)
+        results[name] = {
+            'seconds': seconds,
+            'overhead_seconds': seconds - baseline,
+            'budget_seconds': budget[name],
+            'within_budget': seconds - baseline <= budget[name],
+        }
+    return results
+
+def environment():
+    """Describe the machine and code being benchmarked."""
+    from unball.main import __version__
+    try:
+        with open(os.devnull, 'w') as null:
+            revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=null).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    try:
+        import multiprocessing
+        cpus = multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        cpus = None
+
+    return {
+        'unball_version': __version__,
+        'revision': revision,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': cpus,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+#}
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]",
+        description="Benchmark unball's extractors on a synthetic corpus.")
+    parser.add_option('-o', '--output', action="store", dest="output",
+        metavar="FILE", help="Write JSON results to FILE (default: stdout)")
+    parser.add_option('--corpus', action="store", dest="corpus",
+        metavar="DIR", help="Keep (and reuse) generated archives in DIR "
+        "instead of a temporary directory")
+    parser.add_option('--quick', action="store_true", dest="quick",
+        default=False, help="Use a small corpus for smoke-testing")
+    parser.add_option('-n', '--repeat', action="store", type="int",
+        dest="repeat", default=1, metavar="N",
+        help="Run each measurement N times and keep the fastest")
+    parser.add_option('--format', action="append", dest="formats",
+        metavar="FMT", help="Only benchmark specs with this format (eg. "
+        "tar.gz). May be given more than once.")
+    parser.add_option('--startup', action="store_true", dest="startup",
+        default=False, help="Check start-up time against STARTUP_BUDGET "
+        "instead (exits non-zero if over budget)")
+    parser.add_option('--child', action="store", dest="child",
+        help="(Internal) Measure one extraction and print its JSON.")
+
+    opts, args = parser.parse_args()
+    failed = False
+
+    if opts.child:
+        print(json.dumps(_measure(*json.loads(opts.child))))
+        sys.exit(0)
+
+    specs = corpus_specs(opts.quick and QUICK_AXES or AXES,
+        opts.quick and dict(BASE_SPEC, size=256 * 1024, members=16)
+        or BASE_SPEC)
+    if opts.formats:
+        specs = [x for x in specs if x['format'] in opts.formats]
+
+    corpus_dir = opts.corpus or tempfile.mkdtemp(prefix='unball-corpus-')
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    try:
+        report = {'environment': environment()}
+        if opts.startup:
+            report['startup'] = startup(corpus_dir, max(opts.repeat, 10))
+            for name in sorted(STARTUP_BUDGET):
+                result = report['startup'][name]
+                failed = failed or not result['within_budget']
+                sys.stderr.write("%-8s %.1fms over baseline (budget %.1fms)"
+                    "%s\n" % (name, result['overhead_seconds'] * 1000,
+                              result['budget_seconds'] * 1000,
+                              not result['within_budget'] and
+                              " OVER BUDGET" or ''))
+        else:
+            report['results'] = run(specs, corpus_dir, opts.repeat)
+    finally:
+        if not opts.corpus:
+            shutil.rmtree(corpus_dir)
+
+    if opts.output:
+        with open(opts.output, 'w') as fobj:
+            json.dump(report, fobj, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    sys.exit(failed and 1 or 0)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's library API."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, pickle, shutil, sys, tarfile, tempfile, zipfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+try:
+    from cStringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+from unball import main
+from unball.api import ExtractionResult, extract, extract_many
+
+class ArchiveTestCase(unittest.TestCase):
+    """Base class for tests which need a few small archives to extract"""
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.target = os.path.join(self.workdir, 'out')
+        os.mkdir(self.target)
+
+        self.paths = []
+        for name in ('one', 'two', 'three'):
+            path = os.path.join(self.workdir, name + '.zip')
+            archive = zipfile.ZipFile(path, 'w')
+            archive.writestr('%s.txt' % name, name)
+            archive.close()
+            self.paths.append(path)
+
+        self.text = os.path.join(self.workdir, 'notes.txt')
+        with open(self.text, 'w') as fobj:
+            fobj.write("Not an archive\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+class TestExtractMany(ArchiveTestCase):
+    def test_extract(self):
+        """extract: success produces a populated ExtractionResult"""
+        result = extract(self.paths[0], self.target)
+        self.assertTrue(result.ok)
+        self.assertEqual(result.target, os.path.join(self.target, 'one.txt'))
+        self.assertEqual(result.mime, 'application/zip')
+        self.assertTrue(result.extractor)
+        self.assertTrue('extract' in result.stats['phases'])
+
+    def test_failure(self):
+        """extract: failures are reported, not raised"""
+        result = extract(self.text, self.target)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.errcode, 0)
+        self.assertEqual(result.error, 'UnsupportedFiletypeError')
+        self.assertTrue(result.message)
+
+        result = extract(os.path.join(self.workdir, 'missing.zip'))
+        self.assertFalse(result.ok)
+        self.assertTrue(result.errcode)
+
+    def test_ordered(self):
+        """extract_many: results come back in order, in parallel or not"""
+        paths = self.paths + [self.text]
+        for jobs in (1, 2):
+            target = os.path.join(self.workdir, 'out%d' % jobs)
+            os.mkdir(target)
+            results = list(extract_many(paths, target, jobs=jobs))
+            self.assertEqual([x.source for x in results], paths)
+            self.assertEqual([x.ok for x in results], [True] * 3 + [False])
+            for result in results[:3]:
+                self.assertTrue(os.path.exists(result.target))
+
+    def test_unordered(self):
+        """extract_many: unordered results still cover every input"""
+        results = extract_many(self.paths, self.target, jobs=2,
+                               ordered=False)
+        self.assertEqual(sorted(x.source for x in results),
+                         sorted(self.paths))
+
+    def test_pickle(self):
+        """ExtractionResult: survives pickling (for worker processes)"""
+        result = pickle.loads(pickle.dumps(extract(self.paths[0]), 2))
+        self.assertTrue(isinstance(result, ExtractionResult))
+        self.assertTrue(result.ok)
+        self.assertEqual(result.source, self.paths[0])
+
+    def test_same_target(self):
+        """extract_many: concurrent jobs never replace each other's output"""
+        names = ('a.txt', 'b.txt')
+        paths = [os.path.join(self.workdir, x) for x in ('foo.zip', 'foo.tar')]
+        with zipfile.ZipFile(paths[0], 'w') as archive:
+            for name in names:
+                archive.writestr(name, 'zip')
+        with tarfile.open(paths[1], 'w') as archive:
+            for name in names:
+                archive.add(self.text, name)
+
+        results = list(extract_many(paths, self.target, jobs=2))
+        self.assertEqual(sorted(x.ok for x in results), [False, True])
+        winner, loser = sorted(results, key=lambda x: not x.ok)
+        self.assertEqual(winner.target, os.path.join(self.target, 'foo'))
+        self.assertEqual(sorted(os.listdir(winner.target)), list(names))
+        self.assertEqual((loser.error, loser.errcode), ('OSError', 3))
+        self.assertEqual(os.listdir(self.target), ['foo'])
+
+        with open(os.path.join(winner.target, names[0])) as fobj:
+            content = fobj.read()
+        self.assertEqual(list(extract_many(paths, self.target))[0].errcode, 3)
+        with open(os.path.join(winner.target, names[0])) as fobj:
+            self.assertEqual(fobj.read(), content)
+
+class TestMain(ArchiveTestCase):
+    """Tests for the command-line wrapper around L{extract_many}"""
+
+    def _main(self, *args):
+        """Run C{unball} and return its exit code and output lines."""
+        old_argv, old_stdout = sys.argv, sys.stdout
+        sys.argv = ['unball', '-d', self.target] + list(args)
+        sys.stdout = StringIO()
+        try:
+            try:
+                main.main()
+            except SystemExit as err:
+                code = err.code
+            else:
+                code = 0
+            return code, sys.stdout.getvalue().splitlines()
+        finally:
+            sys.argv, sys.stdout = old_argv, old_stdout
+
+    def test_jobs_ordered(self):
+        """main: --jobs reports results in the order they were given"""
+        code, lines = self._main('-j', '2', *self.paths)
+        self.assertEqual(code, 0)
+        self.assertEqual(lines, ["Extracted to %s" %
+                                 os.path.join(self.target, x + '.txt')
+                                 for x in ('one', 'two', 'three')])
+
+    def test_exit_code(self):
+        """main: the exit code reflects every job, not just the last one"""
+        missing = os.path.join(self.workdir, 'missing.zip')
+        for jobs in ('1', '2'):
+            shutil.rmtree(self.target)
+            os.mkdir(self.target)
+            code, lines = self._main('-j', jobs, missing, *self.paths)
+            self.assertEqual(code, 2)  # IOError
+            self.assertEqual(len([x for x in lines
+                                  if x.startswith('Extracted')]), 3)
+
+        self.assertEqual(self._main(self.text)[0], 0)
+        self.assertEqual(self._main('--strict', self.text)[0], 1)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's extraction cache."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, shutil, sys, tempfile, zipfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball.cache import ExtractionCache
+from unball.main import tryExtract
+from unball.util import ExtractionStats, OutputLimitExceeded, OutputLimits
+
+class TestExtractionCache(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.cache = ExtractionCache(os.path.join(self.workdir, 'cache'))
+
+        self.tree = os.path.join(self.workdir, 'tree')
+        os.makedirs(os.path.join(self.tree, 'sub'))
+        for name in ('a.txt', os.path.join('sub', 'b.txt')):
+            with open(os.path.join(self.tree, name), 'w') as fobj:
+                fobj.write(name * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def make_zip(self, name, *members):
+        path = os.path.join(self.workdir, name)
+        archive = zipfile.ZipFile(path, 'w')
+        for member in members:
+            archive.writestr(member, member)
+        archive.close()
+        return path
+
+    def test_roundtrip(self):
+        """ExtractionCache: store, lookup, and materialize an entry"""
+        self.assertIsNone(self.cache.lookup('deadbeef'))
+        self.assertTrue(self.cache.store('deadbeef', self.tree, mime='x/y'))
+
+        cached = self.cache.lookup('deadbeef')
+        self.assertEqual(cached.mime, 'x/y')
+
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        cached(None, target)
+        with open(os.path.join(target, 'sub', 'b.txt')) as fobj:
+            self.assertEqual(fobj.read(), os.path.join('sub', 'b.txt') * 100)
+
+    def test_eviction(self):
+        """ExtractionCache: least recently used entries are evicted first"""
+        self.cache.store('first', self.tree)
+        self.cache.store('second', self.tree)
+        self.cache.limit = sum(x[1] for x in self.cache.entries()) - 1
+
+        os.utime(os.path.join(self.cache.root, 'second'), (0, 0))
+        self.cache.lookup('first')  # Mark as recently used
+        self.cache.evict()
+
+        self.assertEqual([x[2] for x in self.cache.entries()], ['first'])
+        self.assertEqual(os.listdir(self.cache.root), ['first'])
+
+    def test_tryExtract(self):
+        """tryExtract: identical archives are served from the cache"""
+        first = self.make_zip('first.zip', 'one.txt', 'two.txt')
+        second = os.path.join(self.workdir, 'second.zip')
+        shutil.copy(first, second)
+
+        stats = ExtractionStats()
+        result = tryExtract(first, stats=stats, cache=self.cache)
+        self.assertEqual(stats.info['cache'], 'stored')
+        self.assertEqual(sorted(os.listdir(result)), ['one.txt', 'two.txt'])
+
+        stats = ExtractionStats()
+        result = tryExtract(second, stats=stats, cache=self.cache)
+        self.assertEqual(stats.info['cache'], 'hit')
+        self.assertEqual(os.path.basename(result), 'second')
+        self.assertEqual(sorted(os.listdir(result)), ['one.txt', 'two.txt'])
+
+    def test_stale(self):
+        """tryExtract: an entry evicted after lookup falls back to extracting
+        """
+        path = self.make_zip('stale.zip', 'one.txt', 'two.txt')
+        key = self.cache.key(path)
+        self.cache.store(key, self.tree)
+        shutil.rmtree(os.path.join(self.cache.root, key, 'tree'))
+
+        stats = ExtractionStats()
+        result = tryExtract(path, stats=stats, cache=self.cache)
+        self.assertEqual(sorted(os.listdir(result)), ['one.txt', 'two.txt'])
+
+    def test_limits(self):
+        """tryExtract: cached trees are checked against limits before being
+        copied"""
+        path = self.make_zip('small.zip', 'one.txt', 'two.txt')
+        self.cache.store(self.cache.key(path), self.tree)
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+
+        stats = ExtractionStats()
+        self.assertRaises(OutputLimitExceeded, tryExtract, path, target,
+                          stats=stats, cache=self.cache,
+                          limits=OutputLimits(size=1000))
+        self.assertEqual(stats.info['cache'], 'hit')
+        self.assertEqual(os.listdir(target), [])
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's streaming decompression engine."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import bz2, gzip, io, os, random, shutil, struct, sys, tempfile, zlib
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball import decompress
+from unball.decompress import (BZIP2, GZIP, Bzip2Format, DecompressingReader,
+                               StreamStats, iter_decompress, parallel_chunks)
+
+def gzip_compress(data):
+    """Equivalent to Python 3's gzip.compress()"""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fobj:
+        fobj.write(data)
+    return buf.getvalue()
+
+PARTS = [(b'%d' % x) * (50000 * x) for x in range(1, 5)]
+PAYLOAD = b''.join(PARTS)
+COMPRESSORS = ((GZIP, gzip_compress), (BZIP2, bz2.compress))
+
+class TestIterDecompress(unittest.TestCase):
+    def test_multi_member(self):
+        """Test that concatenated members are all decoded"""
+        for fmt, compress in COMPRESSORS:
+            blob = b''.join(compress(x) for x in PARTS)
+            # Tiny reads exercise member boundaries split across reads
+            for read_size in (3, 4096, 1 << 20):
+                stats = StreamStats()
+                out = b''.join(iter_decompress(io.BytesIO(blob), fmt, stats,
+                                               read_size=read_size))
+                self.assertEqual(out, PAYLOAD)
+                self.assertEqual(stats.members, len(PARTS))
+                self.assertEqual(stats.bytes_in, len(blob))
+                self.assertEqual(stats.bytes_out, len(PAYLOAD))
+
+    def test_trailing_garbage(self):
+        """Test that padding after the last member is ignored"""
+        for fmt, compress in COMPRESSORS:
+            blob = compress(PAYLOAD) + b'\0' * 1000
+            self.assertEqual(b''.join(iter_decompress(io.BytesIO(blob), fmt)),
+                             PAYLOAD)
+
+    def test_truncated(self):
+        """Test that a truncated final member raises an error"""
+        for fmt, compress in COMPRESSORS:
+            blob = compress(PAYLOAD)[:-10]
+            self.assertRaises(EOFError, b''.join,
+                              iter_decompress(io.BytesIO(blob), fmt))
+
+    def test_bomb(self):
+        """Test that highly compressible input comes out in bounded chunks"""
+        size, zeros = 100 << 20, b'\0' * (1 << 20)
+        for fmt, compressor, bound in (
+                (GZIP, zlib.compressobj(9, zlib.DEFLATED, 31),
+                 decompress.OUTPUT_LIMIT),
+                (BZIP2, bz2.BZ2Compressor(), decompress.BZ2_BLOCK_OUTPUT)):
+            blob = b''.join([compressor.compress(zeros)
+                             for _ in range(size // len(zeros))] +
+                            [compressor.flush()])
+
+            largest = total = 0
+            for chunk in iter_decompress(io.BytesIO(blob), fmt):
+                largest, total = max(largest, len(chunk)), total + len(chunk)
+            self.assertEqual(total, size)
+            self.assertTrue(largest <= bound, (fmt.name, largest))
+
+class TestDecompressingReader(unittest.TestCase):
+    def test_read_and_peek(self):
+        """Test that peek() doesn't consume and read() reassembles output"""
+        reader = DecompressingReader(io.BytesIO(gzip_compress(PAYLOAD)), GZIP)
+        self.assertEqual(reader.peek(10), PAYLOAD[:10])
+        self.assertEqual(reader.read(5), PAYLOAD[:5])
+        self.assertEqual(reader.read(100000), PAYLOAD[5:100005])
+        self.assertEqual(reader.read(), PAYLOAD[100005:])
+        self.assertEqual(reader.read(), b'')
+
+    def test_copy_to(self):
+        """Test that copy_to() writes everything not yet read"""
+        reader = DecompressingReader(io.BytesIO(bz2.compress(PAYLOAD)), BZIP2)
+        reader.peek(512)
+        out = io.BytesIO()
+        self.assertEqual(reader.copy_to(out), len(PAYLOAD))
+        self.assertEqual(out.getvalue(), PAYLOAD)
+
+def bgzf_compress(data):
+    """Minimal BGZF member writer (one member per call)"""
+    deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflater.compress(data) + deflater.flush()
+    header = (b'\x1f\x8b\x08\x04\0\0\0\0\0\xff' + struct.pack('<H', 6) +
+              b'BC' + struct.pack('<HH', 2, len(body) + 25))
+    return header + body + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                                       len(data))
+
+class FakeMagicBzip2(Bzip2Format):
+    """A bzip2 format which also "finds" block magic halfway through the
+    second block, as if it had occurred there by chance"""
+    def split(self, data):
+        pieces = list(Bzip2Format.split(self, data))
+        start, end = pieces[1]
+        self.fake = (start, (start + end) // 2)
+        return iter(pieces[:1] + [self.fake, (self.fake[1], end)] +
+                    pieces[2:])
+
+class TestParallelChunks(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        rand = random.Random(0)
+        # Poorly-compressible data so level 1 produces several 100k blocks
+        self.payload = b''.join(struct.pack('<I', rand.getrandbits(32))
+                                for _ in range(100000)) * 2
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _write(self, data):
+        path = os.path.join(self.workdir, 'data')
+        with open(path, 'wb') as fobj:
+            fobj.write(data)
+        return path
+
+    def test_bzip2_blocks(self):
+        """Test that bzip2 blocks are split, decoded, and reordered"""
+        for blob in (bz2.compress(self.payload, 1),
+                     bz2.compress(self.payload[:300000], 1) +
+                     bz2.compress(self.payload[300000:], 2)):
+            stats = StreamStats()
+            chunks = parallel_chunks(self._write(blob), BZIP2, 3, stats)
+            self.assertEqual(b''.join(chunks), self.payload)
+            self.assertTrue(stats.members > 2)
+
+    def test_bgzf_members(self):
+        """Test that BGZF members are split, decoded, and reordered"""
+        parts = [self.payload[x:x + 60000]
+                 for x in range(0, len(self.payload), 60000)]
+        blob = b''.join(bgzf_compress(x) for x in parts) + bgzf_compress(b'')
+        chunks = parallel_chunks(self._write(blob), GZIP, 3)
+        self.assertEqual(b''.join(chunks), self.payload)
+
+    def test_unsplittable(self):
+        """Test that parallel_chunks declines files it can't split"""
+        self.assertIsNone(parallel_chunks(
+            self._write(bz2.compress(b'tiny')), BZIP2, 3))
+        self.assertIsNone(parallel_chunks(
+            self._write(gzip_compress(self.payload)), GZIP, 3))
+        self.assertIsNone(parallel_chunks(
+            self._write(bz2.compress(self.payload, 1)), BZIP2, 1))
+
+    def test_false_magic(self):
+        """Test that a piece split at false block magic falls back to serial
+        decoding rather than failing"""
+        fmt = FakeMagicBzip2()
+        path = self._write(bz2.compress(self.payload, 1))
+        chunks = parallel_chunks(path, fmt, 3)
+        self.assertEqual(b''.join(chunks), self.payload)
+
+        with open(path, 'rb') as fobj:
+            self.assertRaises(Exception, fmt.decode_piece, fobj.read(),
+                              fmt.fake)
+
+    def test_chunked_scan(self):
+        """Test that scanning in steps finds magic straddling each step"""
+        with open(self._write(bz2.compress(self.payload, 1)), 'rb') as fobj:
+            data = fobj.read()
+        expected = decompress._find_bit_pattern(data,
+                                                decompress.BZ2_BLOCK_MAGIC)
+        self.assertTrue(len(expected) > 2)
+        # (Including steps ending on either side of a block's first byte)
+        for step in (4099, expected[1] // 8, expected[1] // 8 + 1,
+                     len(data)):
+            self.assertEqual(list(decompress._iter_bit_pattern(
+                data, decompress.BZ2_BLOCK_MAGIC, step=step)), expected)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's output deduplication."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, shutil, sys, tempfile, zipfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball.dedup import Deduplicator, HEAD_SIZE
+from unball.main import tryExtract
+from unball.util import ExtractionStats
+
+class TestDeduplicator(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.tree = os.path.join(self.workdir, 'tree')
+        os.makedirs(os.path.join(self.tree, 'sub'))
+
+        big = b'x' * (HEAD_SIZE + 10)
+        self.files = {
+            'a.bin': big, os.path.join('sub', 'b.bin'): big,
+            'c.bin': big[:-1] + b'y',  # Same size and head. Different tail.
+            'd.txt': b'same', 'e.txt': b'same', 'f.txt': b'diff',
+            'empty1': b'', 'empty2': b'',
+        }
+        for name, data in self.files.items():
+            with open(os.path.join(self.tree, name), 'wb') as fobj:
+                fobj.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def check_contents(self):
+        for name, data in self.files.items():
+            with open(os.path.join(self.tree, name), 'rb') as fobj:
+                self.assertEqual(fobj.read(), data)
+        self.assertEqual(sorted(x for x in os.listdir(self.tree)
+                                if x.startswith('.')), [])
+
+    def test_hardlinks(self):
+        """Deduplicator: identical files are hardlinked, others untouched"""
+        dedup = Deduplicator(hardlinks=True, batch=2)  # Force partitioning
+        dedup.reflinks = False
+        self.assertEqual(dedup(self.tree), (2, HEAD_SIZE + 10 + 4))
+
+        self.check_contents()
+        ino = lambda x: os.stat(os.path.join(self.tree, x)).st_ino
+        self.assertEqual(ino('a.bin'), ino(os.path.join('sub', 'b.bin')))
+        self.assertEqual(ino('d.txt'), ino('e.txt'))
+        self.assertNotEqual(ino('a.bin'), ino('c.bin'))
+        self.assertNotEqual(ino('empty1'), ino('empty2'))
+
+        self.assertEqual(dedup(self.tree), (0, 0))  # Already linked
+
+    def test_disabled(self):
+        """Deduplicator: nothing changes without reflinks or hardlinks"""
+        dedup = Deduplicator()
+        dedup.reflinks = False
+        self.assertEqual(dedup(self.tree), (0, 0))
+        self.check_contents()
+
+    def test_tryExtract(self):
+        """tryExtract: dedup runs on the output and is recorded in stats"""
+        path = os.path.join(self.workdir, 'dupes.zip')
+        archive = zipfile.ZipFile(path, 'w')
+        for name in ('one.txt', 'two.txt', 'three.txt'):
+            archive.writestr(name, 'identical')
+        archive.close()
+
+        stats, dedup = ExtractionStats(), Deduplicator(hardlinks=True)
+        dedup.reflinks = False
+        result = tryExtract(path, stats=stats, dedup=dedup)
+        self.assertEqual(stats.info['dedup_saved'], 2 * len('identical'))
+        self.assertEqual(os.stat(os.path.join(result, 'one.txt')).st_nlink,
+                         3)
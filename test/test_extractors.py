@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's built-in extractors."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import bz2, gzip, io, os, shutil, stat, subprocess, sys, tarfile, tempfile
+import zipfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball import extractors, main
+from unball.extractors import (BZip2Extractor, DispatchTable, Extractor,
+                               ExtractorTable, GZipExtractor, MemberFilter,
+                               PipeExtractor, TarExtractor, ZipExtractor)
+from unball.main import NothingProducedError, tryExtract
+
+class TestZipExtractor(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.zip_path = os.path.join(self.workdir, 'test.zip')
+        self.members = dict(('dir%d/file%d.txt' % (x % 3, x),
+                             ('%d\n' % x).encode('ascii') * (x * 50))
+                            for x in range(30))
+
+        archive = zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('empty/', '')
+        archive.writestr('../escape.txt', b'up')
+        for name, data in self.members.items():
+            archive.writestr(name, data)
+        archive.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def check_extract(self, extractor):
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        extractor(self.zip_path, target)
+
+        self.assertTrue(os.path.isdir(os.path.join(target, 'empty')))
+        self.assertTrue(os.path.isfile(os.path.join(target, 'escape.txt')))
+        for name, data in self.members.items():
+            with open(os.path.join(target, name), 'rb') as fobj:
+                self.assertEqual(fobj.read(), data)
+
+    def test_serial(self):
+        """Test that single-threaded zip extraction matches the archive"""
+        self.check_extract(ZipExtractor(threads=1))
+
+    def test_parallel(self):
+        """Test that thread-pooled zip extraction matches the archive"""
+        extractor = ZipExtractor(threads=4)
+        extractor.PARALLEL_MIN_BYTES = 0
+        self.check_extract(extractor)
+
+    def test_filter(self):
+        """Test that zip extraction only writes the selected members"""
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        ZipExtractor(threads=1)(self.zip_path, target,
+            MemberFilter(['dir1/*'], ['*/file1.txt']))
+
+        self.assertEqual(os.listdir(target), ['dir1'])
+        self.assertEqual(sorted(os.listdir(os.path.join(target, 'dir1'))),
+            sorted(os.path.basename(x) for x in self.members
+                   if x.startswith('dir1/') and x != 'dir1/file1.txt'))
+
+    def test_prefix(self):
+        """Test that zip extraction can strip a top-level directory"""
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        ZipExtractor(threads=1)(self.zip_path, target, prefix='dir2')
+        self.assertEqual(sorted(os.listdir(target)),
+            sorted(os.path.basename(x) for x in self.members
+                   if x.startswith('dir2/')))
+
+class NonSeekable(object):
+    """A read-only wrapper which hides C{seek}/C{tell}, like a pipe"""
+    def __init__(self, fileobj):
+        self.read = fileobj.read
+
+class TestTarExtractor(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.tar_path = os.path.join(self.workdir, 'test.tar')
+
+        archive = tarfile.open(self.tar_path, 'w')
+        locked = tarfile.TarInfo('locked')
+        locked.type, locked.mode, locked.mtime = tarfile.DIRTYPE, 0o500, 1000
+        archive.addfile(locked)
+        for name in ('locked/one.txt', 'locked/two.txt'):
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            archive.addfile(info, io.BytesIO(name.encode('ascii')))
+        archive.close()
+
+    def tearDown(self):
+        for path, dirs, _ in os.walk(self.workdir):
+            for name in dirs:
+                os.chmod(os.path.join(path, name), 0o700)
+        shutil.rmtree(self.workdir)
+
+    def check_extract(self, target):
+        locked = os.path.join(target, 'locked')
+        self.assertEqual(sorted(os.listdir(locked)), ['one.txt', 'two.txt'])
+        self.assertEqual(stat.S_IMODE(os.stat(locked).st_mode), 0o500)
+        self.assertEqual(os.stat(locked).st_mtime, 1000)
+
+    def test_path(self):
+        """Test that directory metadata is applied after their contents"""
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        TarExtractor()(self.tar_path, target)
+        self.check_extract(target)
+
+    def test_fileobj(self):
+        """Test that extraction works from a non-seekable stream"""
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        with open(self.tar_path, 'rb') as fobj:
+            TarExtractor().extract_fileobj(NonSeekable(fobj), target)
+        self.check_extract(target)
+
+    def test_filter(self):
+        """Test that unselected tar members are skipped"""
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        TarExtractor()(self.tar_path, target, MemberFilter(['*/two.*']))
+        self.assertEqual(os.listdir(os.path.join(target, 'locked')),
+                         ['two.txt'])
+
+        shutil.rmtree(target)
+        os.mkdir(target)
+        TarExtractor()(self.tar_path, target, MemberFilter(['nothing']))
+        self.assertEqual(os.listdir(target), [])
+
+    def test_prefix(self):
+        """Test that a stripped top-level directory's metadata goes to the
+        target"""
+        target = os.path.join(self.workdir, 'out')
+        os.mkdir(target)
+        TarExtractor()(self.tar_path, target, prefix='locked')
+        self.assertEqual(sorted(os.listdir(target)), ['one.txt', 'two.txt'])
+        self.assertEqual(stat.S_IMODE(os.stat(target).st_mode), 0o500)
+
+    def test_hardlink(self):
+        """Test that streamed hardlinks work even if linking fails or their
+        target was filtered out"""
+        tar_path = os.path.join(self.workdir, 'links.tar')
+        archive = tarfile.open(tar_path, 'w')
+        info = tarfile.TarInfo('dir/data.txt')
+        info.size = 4
+        archive.addfile(info, io.BytesIO(b'data'))
+        link = tarfile.TarInfo('other/link.txt')
+        link.type, link.linkname = tarfile.LNKTYPE, 'dir/data.txt'
+        archive.addfile(link)
+        archive.close()
+
+        def extract(target, member_filter=None):
+            os.mkdir(target)
+            with open(tar_path, 'rb') as fobj:
+                TarExtractor().extract_fileobj(NonSeekable(fobj), target,
+                                               member_filter)
+            return os.path.join(target, 'other', 'link.txt')
+
+        linked = extract(os.path.join(self.workdir, 'linked'))
+        self.assertTrue(os.path.samefile(linked, os.path.join(
+            os.path.dirname(linked), '..', 'dir', 'data.txt')))
+
+        old_link = os.link
+        os.link = lambda src, dst: old_link(src, '/nonexistent/' + dst)
+        try:
+            copied = extract(os.path.join(self.workdir, 'copied'))
+        finally:
+            os.link = old_link
+        with open(copied, 'rb') as fobj:
+            self.assertEqual(fobj.read(), b'data')
+
+        target = os.path.join(self.workdir, 'filtered')
+        extract(target, MemberFilter(['*/link.txt']))
+        self.assertEqual(os.listdir(target), [])
+
+class TestStreamedTar(unittest.TestCase):
+    """Tests for decompressors which stream tarballs into a tar extractor"""
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.target = os.path.join(self.workdir, 'out')
+        os.mkdir(self.target)
+
+        tar_path = os.path.join(self.workdir, 'test.tar')
+        archive = tarfile.open(tar_path, 'w')
+        for name in ('dir/one.txt', 'dir/two.txt'):
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            archive.addfile(info, io.BytesIO(name.encode('ascii')))
+        archive.close()
+        with open(tar_path, 'rb') as fobj:
+            data = fobj.read()
+
+        self.paths = {}
+        for name, opener in (('test.tar.gz', gzip.GzipFile),
+                             ('test.tar.bz2', bz2.BZ2File),
+                             ('test.gz', gzip.GzipFile)):
+            self.paths[name] = os.path.join(self.workdir, name)
+            compressed = opener(self.paths[name], 'wb')
+            compressed.write(data)
+            compressed.close()
+
+        self.popens = []
+        self._old = (extractors.mimeToExtractor,
+                     TarExtractor.__dict__['extract_fileobj'],
+                     subprocess.Popen)
+        popens = self.popens
+
+        class Popen(subprocess.Popen):
+            def __init__(self, args, *posargs, **kwargs):
+                popens.append(args[0])
+                super(Popen, self).__init__(args, *posargs, **kwargs)
+        subprocess.Popen = Popen
+
+    def tearDown(self):
+        (extractors.mimeToExtractor, TarExtractor.extract_fileobj,
+         subprocess.Popen) = self._old
+        shutil.rmtree(self.workdir)
+
+    def prefer(self, untar):
+        """Make C{untar} the preferred tar extractor and forbid the other."""
+        extractors.mimeToExtractor = lambda mime: [untar]
+        TarExtractor.extract_fileobj = self._old[1]
+        if not isinstance(untar, TarExtractor):
+            def extract_fileobj(*args, **kwargs):
+                raise AssertionError("Preferred tar ignored")
+            TarExtractor.extract_fileobj = extract_fileobj
+
+    def check_extract(self, extractor, name):
+        """Run C{extractor} with each tar preference in turn"""
+        for untar in (TarExtractor(), Extractor('tar', 'xf')):
+            self.prefer(untar)
+            del self.popens[:]
+            extractor(self.paths[name], self.target)
+            self.assertEqual(os.listdir(self.target), ['dir'])
+            self.assertEqual(sorted(os.listdir(
+                os.path.join(self.target, 'dir'))), ['one.txt', 'two.txt'])
+            shutil.rmtree(os.path.join(self.target, 'dir'))
+            if not isinstance(extractor, GZipExtractor):  # Sniffed, once
+                self.assertEqual(self.popens.count(extractor._args[0]), 1)
+
+    def test_gzip(self):
+        """Test that .tar.gz is streamed without an intermediate .tar"""
+        self.check_extract(GZipExtractor(), 'test.tar.gz')
+        if extractors.which('gunzip'):
+            self.check_extract(PipeExtractor('gunzip', '.gz'), 'test.tar.gz')
+
+    def test_bzip2(self):
+        """Test that .tar.bz2 is streamed without an intermediate .tar"""
+        self.check_extract(BZip2Extractor(), 'test.tar.bz2')
+        if extractors.which('bunzip2'):
+            self.check_extract(PipeExtractor('bunzip2', '.bz2'),
+                               'test.tar.bz2')
+
+    def test_misnamed(self):
+        """Test that a tarball named like foo.gz is still untarred"""
+        self.check_extract(GZipExtractor(), 'test.gz')
+        if extractors.which('gunzip'):
+            self.check_extract(PipeExtractor('gunzip', '.gz'), 'test.gz')
+
+    def test_modes(self):
+        """Test that streamed tarballs never leave 000 permissions behind,
+        whichever tar extractor the tarball was streamed into"""
+        path = os.path.join(self.workdir, 'modes.tar.gz')
+        archive = tarfile.open(path, 'w:gz')
+        for name, kind in (('locked', tarfile.DIRTYPE),
+                           ('locked/file', tarfile.REGTYPE)):
+            info = tarfile.TarInfo(name)
+            info.type, info.mode = kind, 0
+            archive.addfile(info, io.BytesIO())
+        archive.close()
+
+        for untar in (TarExtractor(), Extractor('tar', 'xf')):
+            self.prefer(untar)
+            GZipExtractor()(path, self.target)
+            locked = os.path.join(self.target, 'locked')
+            self.assertEqual(os.stat(locked).st_mode & 0o500, 0o500, untar)
+            self.assertEqual(os.stat(os.path.join(locked, 'file')).st_mode &
+                             0o400, 0o400, untar)
+            shutil.rmtree(locked)
+
+class TestMemberFilter(unittest.TestCase):
+    def test_match(self):
+        """MemberFilter: includes, excludes, and path normalization"""
+        member_filter = MemberFilter(['*.xml', 'docs/*'], ['*/skip.xml'])
+        self.assertTrue(member_filter('a.xml'))
+        self.assertTrue(member_filter('./deep/er/a.xml'))
+        self.assertTrue(member_filter('docs/readme'))
+        self.assertFalse(member_filter('src/docs/readme'))
+        self.assertFalse(member_filter('a.XML'))
+        self.assertFalse(member_filter('deep/skip.xml'))
+        self.assertTrue(MemberFilter(exclude=['*.o'])('a.c'))
+        self.assertFalse(MemberFilter())
+
+    def test_args(self):
+        """MemberFilter: native syntax for each tool"""
+        member_filter = MemberFilter(['*.xml'], ['*.bak'])
+        self.assertEqual(member_filter.args('/usr/bin/7z'),
+                         (['-ir!*.xml', '-xr!*.bak'], [], ()))
+        self.assertEqual(member_filter.args('unzip'),
+                         ([], ['*.xml', '-x', '*.bak'], (11,)))
+        self.assertEqual(member_filter.args('unrar'),
+                         (['-x*.bak'], ['*.xml'], (10,)))
+        self.assertEqual(member_filter.args('tar')[1],
+                         ['--anchored', '--wildcards', '--exclude=*.bak'])
+        self.assertEqual(member_filter.args('cabextract'), ([], [], ()))
+
+    def test_prune(self):
+        """MemberFilter: prune removes unselected files and emptied dirs"""
+        workdir = tempfile.mkdtemp('-unballtest')
+        try:
+            for name in ('keep/a.xml', 'keep/b.txt', 'drop/c.txt'):
+                path = os.path.join(workdir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+            os.chmod(os.path.join(workdir, 'drop'), 0o500)
+
+            self.assertEqual(MemberFilter(['*.xml']).prune(workdir), 2)
+            self.assertEqual(os.listdir(workdir), ['keep'])
+            self.assertEqual(os.listdir(os.path.join(workdir, 'keep')),
+                             ['a.xml'])
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_nested(self):
+        """MemberFilter: applies to an archive wrapped in another one"""
+        workdir = tempfile.mkdtemp('-unballtest')
+        try:
+            tar_path = os.path.join(workdir, 'proj.tar')
+            tar = tarfile.open(tar_path, 'w')
+            for name in ('proj/a.xml', 'proj/b.txt'):
+                info = tarfile.TarInfo(name)
+                info.size = len(name)
+                tar.addfile(info, io.BytesIO(name.encode('ascii')))
+            tar.close()
+            zip_path = os.path.join(workdir, 'proj.zip')
+            archive = zipfile.ZipFile(zip_path, 'w')
+            archive.write(tar_path, 'proj.tar')
+            archive.close()
+            os.remove(tar_path)
+
+            outdir = os.path.join(workdir, 'out')
+            for patterns, expected in ((['*.xml'], ['a.xml']),
+                                       (['proj.tar'], ['a.xml', 'b.txt'])):
+                os.mkdir(outdir)
+                result = tryExtract(zip_path, outdir,
+                                    member_filter=MemberFilter(patterns))
+                self.assertEqual(result, os.path.join(outdir, 'proj'))
+                self.assertEqual(sorted(os.listdir(result)), expected)
+                shutil.rmtree(outdir)
+
+            os.mkdir(outdir)
+            self.assertRaises(NothingProducedError, tryExtract, zip_path,
+                              outdir, member_filter=MemberFilter(['*.c']))
+            self.assertEqual(os.listdir(outdir), [])
+
+            # Not a wrapper, so the listing rules it out without extracting
+            archive = zipfile.ZipFile(zip_path, 'a')
+            archive.writestr('README', b'')
+            archive.close()
+            old_run, main._run_extractor = main._run_extractor, None
+            try:
+                self.assertRaises(NothingProducedError, tryExtract, zip_path,
+                                  outdir, member_filter=MemberFilter(['*.c']))
+            finally:
+                main._run_extractor = old_run
+            self.assertEqual(os.listdir(outdir), [])
+        finally:
+            shutil.rmtree(workdir)
+
+class TestExtractorTable(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.table = ExtractorTable({
+            'application/x-a': lambda: self.build('a'),
+            'application/x-b': lambda: (self.build('b'), self.build('c')),
+        })
+        self.table.alias('application/a', 'application/x-a')
+
+    def build(self, name):
+        self.calls.append(name)
+        return Extractor(name)
+
+    def test_lazy(self):
+        """ExtractorTable: entries are only built when first looked up"""
+        self.assertEqual(len(self.table), 3)
+        self.assertTrue('application/a' in self.table)
+        self.assertFalse('application/x-c' in self.table)
+        DispatchTable(self.table).fingerprint()
+        self.assertEqual(self.calls, [])
+
+        entry = self.table['application/a']
+        self.assertTrue(entry is self.table['application/x-a'])
+        self.assertEqual(self.calls, ['a'])
+
+    def test_alias_overwrite(self):
+        """ExtractorTable: aliases can't shadow existing entries"""
+        self.assertRaises(Exception, self.table.alias, 'application/x-b',
+                          'application/x-a')
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's archive listing and listing index."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import bz2, errno, os, shutil, sys, tarfile, tempfile, zipfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball import listing
+from unball.extractors import (Extractor, TarExtractor,
+                               UnsupportedFiletypeError, ZipExtractor)
+from unball.listing import ListingIndex, Member, list_archive
+from unball import main, util
+from unball.main import plan_target, preflight, tryExtract
+from unball.util import ExtractionStats, OutputLimitExceeded, OutputLimits
+
+SEVENZIP_SLT = """
+7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov : 2016-05-21
+
+Listing archive: test.7z
+
+--
+Path = test.7z
+Type = 7z
+Physical Size = 187
+
+----------
+Path = docs
+Size = 0
+Packed Size = 0
+Attributes = D drwxr-xr-x
+CRC =
+
+Path = docs/readme.txt
+Size = 12
+Packed Size = 16
+Attributes = A -rw-r--r--
+CRC = 3610A686
+""".splitlines()
+
+UNRAR_LT = """
+UNRAR 5.61 beta 1 freeware      Copyright (c) 1993-2018 Alexander Roshal
+
+Archive: test.rar
+Details: RAR 5
+
+        Name: docs/readme.txt
+        Type: File
+        Size: 12
+ Packed size: 16
+       CRC32: 0000A686
+
+        Name: docs
+        Type: Directory
+""".splitlines()
+
+class TestListers(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self._run = listing._run
+
+    def tearDown(self):
+        listing._run = self._run
+        shutil.rmtree(self.workdir)
+
+    def test_zip(self):
+        """list_archive: zip members come from the central directory"""
+        path = os.path.join(self.workdir, 'test.zip')
+        archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('docs/', '')
+        archive.writestr('docs/readme.txt', 'hello' * 100)
+        archive.close()
+
+        members = list_archive(path)
+        self.assertEqual([x.name for x in members],
+                         ['docs/', 'docs/readme.txt'])
+        self.assertEqual(members[1].size, 500)
+        self.assertTrue(members[1].compressed < 500)
+        self.assertEqual(len(members[1].crc), 8)
+
+    def test_tar(self):
+        """list_archive: compressed tar headers are read in one pass"""
+        src = os.path.join(self.workdir, 'readme.txt')
+        with open(src, 'w') as fobj:
+            fobj.write('hello')
+        path = os.path.join(self.workdir, 'test.tar.gz')
+        tar = tarfile.open(path, 'w:gz')
+        tar.add(src, 'readme.txt')
+        tar.close()
+
+        self.assertEqual(list_archive(path),
+                         [Member('readme.txt', 5, None, None)])
+
+    def test_not_archive(self):
+        """list_archive: non-archives raise UnsupportedFiletypeError"""
+        path = os.path.join(self.workdir, 'plain.txt')
+        with open(path, 'w') as fobj:
+            fobj.write("Just text\n")
+        self.assertRaises(UnsupportedFiletypeError, list_archive, path)
+
+    def test_7z(self):
+        """list_7z: parses 7z l -slt output"""
+        listing._run = lambda *commands: lambda args: SEVENZIP_SLT
+        self.assertEqual(listing.list_7z('test.7z'), [
+            Member('docs/', 0, 0, None),
+            Member('docs/readme.txt', 12, 16, '3610a686')])
+
+    def test_rar(self):
+        """list_rar: parses unrar lt output"""
+        listing._run = lambda *commands: lambda args: UNRAR_LT
+        self.assertEqual(listing.list_rar('test.rar'), [
+            Member('docs/readme.txt', 12, 16, '0000a686'),
+            Member('docs/', None, None, None)])
+
+class TestListingIndex(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.index = ListingIndex(os.path.join(self.workdir, 'index.db'))
+
+        self.path = os.path.join(self.workdir, 'test.zip')
+        archive = zipfile.ZipFile(self.path, 'w')
+        archive.writestr('one.txt', 'one')
+        archive.close()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.workdir)
+
+    def test_cached(self):
+        """ListingIndex: listings are reused until the archive changes"""
+        self.assertIsNone(self.index.get(self.path, os.stat(self.path)))
+        members = list_archive(self.path, self.index)
+        self.assertEqual(self.index.get(self.path, os.stat(self.path)),
+                         members)
+
+        fake = [Member('cached.txt', 1, 1, None)]
+        self.index.put(self.path, os.stat(self.path), 'application/zip',
+                       fake)
+        self.assertEqual(list_archive(self.path, self.index), fake)
+
+        archive = zipfile.ZipFile(self.path, 'a')
+        archive.writestr('two.txt', 'two')
+        archive.close()
+        os.utime(self.path, (0, 0))  # In case mtime resolution is coarse
+        self.assertEqual([x.name for x in
+                          list_archive(self.path, self.index)],
+                         ['one.txt', 'two.txt'])
+
+class TestPlanTarget(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.outdir = os.path.join(self.workdir, 'out')
+        os.mkdir(self.outdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def make_zip(self, *names):
+        path = os.path.join(self.workdir, 'test.zip')
+        archive = zipfile.ZipFile(path, 'w')
+        for name in names:
+            archive.writestr(name, name)
+        archive.close()
+        return path
+
+    def plan(self, path, extractor=ZipExtractor()):
+        return plan_target(path, self.outdir, 'application/zip', extractor)
+
+    def test_plan(self):
+        """plan_target: predicts the staged output name from the listing"""
+        path = self.make_zip('one.txt', 'two.txt')
+        self.assertEqual(self.plan(path),
+                         (os.path.join(self.outdir, 'test'), None))
+
+        path = self.make_zip('top/', 'top/one.txt', 'top/two.txt')
+        self.assertEqual(self.plan(path),
+                         (os.path.join(self.outdir, 'top'), 'top'))
+        self.assertIsNone(self.plan(path, Extractor()))
+
+        for names in (['lonely.txt'], ['../escape.txt', 'one.txt']):
+            self.assertIsNone(self.plan(self.make_zip(*names)))
+
+    def test_plan_tar(self):
+        """plan_target: tarballs are planned from their headers, and only
+        for extractors which strip prefixes"""
+        path = os.path.join(self.workdir, 'test.tar')
+        tar = tarfile.open(path, 'w')
+        for name in ('top', 'top/one.txt'):
+            info = tarfile.TarInfo(name)
+            if name == 'top':
+                info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        tar.close()
+
+        self.assertEqual(list(listing.iter_tar_names(path)),
+                         ['top/', 'top/one.txt'])
+        self.assertEqual(plan_target(path, self.outdir, 'application/x-tar',
+                                     TarExtractor()),
+                         (os.path.join(self.outdir, 'top'), 'top'))
+        self.assertIsNone(plan_target(path, self.outdir, 'application/x-tar',
+                                      Extractor('tar', 'xf')))
+
+    def test_tryExtract(self):
+        """tryExtract: planned extractions match the staged result"""
+        for names, expected, planned in (
+                (['one.txt', 'two.txt'], 'test', True),
+                (['top/', 'top/one.txt', 'top/two.txt'], 'top', False)):
+            stats = ExtractionStats()
+            result = tryExtract(self.make_zip(*names), self.outdir,
+                                stats=stats)
+            if planned:  # Otherwise, it depends on the preferred extractor
+                self.assertTrue(stats.info.get('planned'))
+            self.assertEqual(result, os.path.join(self.outdir, expected))
+            self.assertEqual(sorted(os.listdir(result)),
+                             ['one.txt', 'two.txt'])
+            self.assertEqual(os.listdir(self.outdir), [expected])
+            shutil.rmtree(result)
+
+class TestPreflight(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.path = os.path.join(self.workdir, 'bomb.zip')
+        archive = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('zeros.bin', b'\0' * (1024 * 1024))
+        archive.close()
+        self.members = list_archive(self.path)
+        self.free_space = main.free_space
+        self.tree_size = util.tree_size
+
+    def tearDown(self):
+        main.free_space = self.free_space
+        shutil.rmtree(self.workdir)
+
+    def test_limits(self):
+        """preflight: listed sizes are checked against OutputLimits"""
+        preflight(self.path, self.workdir, self.members)
+        preflight(self.path, self.workdir, self.members, OutputLimits(5000))
+        self.assertRaises(OutputLimitExceeded, preflight, self.path,
+                          self.workdir, self.members, OutputLimits(10))
+        self.assertRaises(OutputLimitExceeded, preflight, self.path,
+                          self.workdir, self.members,
+                          OutputLimits(size=1024))
+
+        self.assertRaises(OutputLimitExceeded, tryExtract, self.path,
+                          limits=OutputLimits(10))
+        self.assertEqual(os.listdir(self.workdir), ['bomb.zip'])
+
+    def test_stream_bomb(self):
+        """preflight: compressed streams aren't decompressed to list them,
+        and limits stop in-process decompression before the first write"""
+        path = os.path.join(self.workdir, 'zeros.bz2')
+        compressor, zeros = bz2.BZ2Compressor(), b'\0' * (1 << 20)
+        with open(path, 'wb') as fobj:
+            for _ in range(100):
+                fobj.write(compressor.compress(zeros))
+            fobj.write(compressor.flush())
+
+        self.assertIsNone(main.list_members(path, 'application/x-bzip2',
+                                            thorough=True))
+        util.tree_size = lambda path: 0  # Leave it to the write path
+        try:
+            self.assertRaises(OutputLimitExceeded, tryExtract, path,
+                              limits=OutputLimits(size=1 << 20))
+        finally:
+            util.tree_size = self.tree_size
+        self.assertEqual(sorted(os.listdir(self.workdir)),
+                         ['bomb.zip', 'zeros.bz2'])
+
+    def test_free_space(self):
+        """preflight: archives which won't fit fail with ENOSPC"""
+        main.free_space = lambda path: 1024
+        try:
+            preflight(self.path, self.workdir, self.members)
+        except IOError as err:
+            self.assertEqual(err.errno, errno.ENOSPC)
+        else:
+            self.fail("IOError not raised")
+
+    def test_thorough(self):
+        """list_members: only free listings are read unless thorough"""
+        path = os.path.join(self.workdir, 'test.tar')
+        tar = tarfile.open(path, 'w')
+        tar.add(self.path, 'bomb.zip')
+        tar.close()
+
+        self.assertIsNone(main.list_members(path, 'application/x-tar'))
+        self.assertEqual([x.name for x in main.list_members(
+            path, 'application/x-tar', thorough=True)], ['bomb.zip'])
+        self.assertEqual(main.list_members(self.path, 'application/zip'),
+                         self.members)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's built-in header matching."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, shutil, struct, sys, tarfile, tempfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball.extractors import EXTRACTORS, FALLBACK_DESCRIPTIONS
+from unball.mimetypes import SIGNATURES, findPayloads, sniffMimetype
+
+TEST_SOURCES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'test sources')
+
+#: A minimal DOS stub pointing at a PE header
+MZ_HEADER = (b'MZ' + struct.pack('<4H', 0x90, 3, 0, 4) + b'\0' * 50 +
+             struct.pack('<I', 64) + b'PE\0\0')
+
+class TestSniffMimetype(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as fobj:
+            fobj.write(data)
+        return path
+
+    def test_header_files(self):
+        """Test sniffMimetype on the extensionless .header test sources"""
+        expected = {
+            'arctest.header': 'application/x-arc',
+            'arjtest.header': 'application/arj',
+            'artest.header': 'application/x-ar',
+            'bziptest.header': 'application/bzip2',
+            'compress_test.txt.header': 'application/x-compress',
+            'cpiotest.header': 'application/x-cpio',
+            'gziptest.header': 'application/x-gzip',
+            'hqxtest.header': 'application/mac-binhex40',
+            'lhatest.header': 'application/lzh',
+            'rartest.header': 'application/x-rar',
+            'sit5test.header': 'application/x-stuffit',
+            'tartest.header': 'application/x-tar',
+            'ziptest.header': 'application/zip',
+            'zootest.header': 'application/x-zoo',
+        }
+        for name, mime in expected.items():
+            self.assertEqual(sniffMimetype(os.path.join(TEST_SOURCES, name)),
+                             mime, "Misidentified %s" % name)
+
+    def test_szdd(self):
+        """Test that MS-DOS COMPRESS.EXE files are recognized"""
+        self.assertEqual(
+            sniffMimetype(os.path.join(TEST_SOURCES, 'mscompress.tx_')),
+            'application/x-ms-compress-szdd')
+
+    def test_zip_sfx(self):
+        """Test that executables with a trailing zip are identified as zip"""
+        path = self._write('sfx.exe', MZ_HEADER + b'\0' * 100000 +
+            b'PK\x05\x06' + b'\0' * 18)
+        self.assertEqual(sniffMimetype(path), 'application/zip')
+
+        path = self._write('plain.exe', MZ_HEADER + b'\0' * 40000)
+        self.assertEqual(sniffMimetype(path), 'application/x-dosexec')
+
+    def test_short_magic_tar(self):
+        """Test that tarballs whose first member starts with a short magic
+        number (MZ, BZh) are still identified as tar"""
+        member = self._write('member', b'test')
+        for name in ('MZmine-2.5/', 'BZh/'):
+            path = os.path.join(self.workdir, 'test.tar')
+            tar = tarfile.open(path, 'w')
+            tar.add(member, name + 'member')
+            tar.close()
+            self.assertEqual(sniffMimetype(path), 'application/x-tar',
+                             "Misidentified tar starting with %s" % name)
+
+        path = self._write('fake.bz2', b'BZh/not really bzip2')
+        self.assertIsNone(sniffMimetype(path))
+
+    def test_v7_tar(self):
+        """Test that tar archives without the ustar magic are recognized"""
+        path = os.path.join(self.workdir, 'v7.tar')
+        member = self._write('member', b'test')
+        tar = tarfile.open(path, 'w', format=tarfile.USTAR_FORMAT)
+        tar.add(member, 'member')
+        tar.close()
+
+        with open(path, 'rb') as fobj:
+            data = bytearray(fobj.read())
+        data[257:265] = b'\0' * 8  # Strip the ustar magic and version
+        data[148:156] = b'%06o\0 ' % (sum(data[:148]) + 256 +
+                                      sum(data[156:512]))
+        path = self._write('v7', bytes(data))
+        self.assertEqual(sniffMimetype(path), 'application/x-tar')
+
+    def test_uu_vs_xx(self):
+        """Test that uuencoded and xxencoded files are told apart"""
+        path = self._write('a.txt', b'begin 644 a\nM' + b'x' * 60 + b'\n')
+        self.assertEqual(sniffMimetype(path), 'application/x-uuencode')
+        path = self._write('b.txt', b'begin 644 b\nh' + b'x' * 60 + b'\n')
+        self.assertEqual(sniffMimetype(path), 'application/x-xx-encoded')
+
+    def test_unknown(self):
+        """Test that unrecognized files return None"""
+        path = self._write('text', b'Just some text\n')
+        self.assertIsNone(sniffMimetype(path))
+
+    def test_ole2(self):
+        """Test that OLE2 files are left to libmagic, since most (.doc, .xls,
+        Thumbs.db) aren't MSI packages"""
+        path = self._write('Thumbs.db',
+                           b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' + b'\0' * 504)
+        self.assertIsNone(sniffMimetype(path))
+
+    def test_signature_targets(self):
+        """Checking for signatures with no extractor or description"""
+        orphans = [mime for _, _, mime, _ in SIGNATURES
+                   if not (mime in EXTRACTORS or
+                           mime in FALLBACK_DESCRIPTIONS)]
+        self.assertFalse(orphans, "SIGNATURES entries must map to "
+                         "EXTRACTORS or FALLBACK_DESCRIPTIONS: %s" % orphans)
+
+class TestFindPayloads(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_sfx_sources(self):
+        """Test that each self-extractor's payload is found by signature"""
+        expected = {
+            '7zsfxtest.exe': 'application/x-7z-compressed',
+            'ace1sfxtest.exe': 'application/x-ace-compressed',
+            'ace2sfxtest.exe': 'application/x-ace-compressed',
+            'rarsfxtest.exe': 'application/x-rar',
+            'zipsfxtest.exe': 'application/zip',
+        }
+        for name, mime in expected.items():
+            payloads = findPayloads(os.path.join(TEST_SOURCES, name))
+            self.assertEqual([x[1] for x in payloads], [mime],
+                             "Wrong payloads for %s: %s" % (name, payloads))
+            self.assertTrue(payloads[0][0] > 0)
+
+    def test_no_payload(self):
+        """Test that bare magic numbers in code aren't taken as payloads"""
+        path = os.path.join(self.workdir, 'plain.exe')
+        with open(path, 'wb') as fobj:
+            fobj.write(b'MZ' + b'\xff' * 100 + b'PK\x03\x04\xe8\xff' +
+                       b'\x60\xea\x10\x00' + b'-lh5-' + b'\xff' * 4000)
+        self.assertEqual(findPayloads(path), [])
+        self.assertEqual(findPayloads(os.path.join(TEST_SOURCES,
+            'ace1sfxtest.exe'), ['application/arj']), [])
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's extraction daemon and client."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, shutil, socket, sys, tempfile, threading, zipfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball import server
+from unball.api import _extract_one
+from unball.server import ExtractionServer, ServerError, submit
+
+def flaky_extract(job):
+    """Stand-in for L{_extract_one} which fails as badly as it can"""
+    name = os.path.basename(job[0])
+    if name == 'raise.zip':
+        raise SystemExit(1)  # Not even an Exception
+    elif name == 'die.zip':
+        os._exit(1)  # eg. The OOM killer
+    return _extract_one(job)
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.target = os.path.join(self.workdir, 'out')
+        self.sock = os.path.join(self.workdir, 'unball.sock')
+        os.mkdir(self.target)
+
+        self.paths = []
+        for name in ('one', 'two', 'three', 'four'):
+            path = os.path.join(self.workdir, name + '.zip')
+            archive = zipfile.ZipFile(path, 'w')
+            archive.writestr('%s.txt' % name, name)
+            archive.close()
+            self.paths.append(path)
+
+        self.server = ExtractionServer(self.sock, jobs=2, queue_depth=1)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def test_submit(self):
+        """server: results stream back in order through a full queue"""
+        results = list(submit(self.sock, self.paths, self.target))
+        self.assertEqual([x.source for x in results], self.paths)
+        for result in results:
+            self.assertTrue(result.ok, result.message)
+            self.assertEqual(result.mime, 'application/zip')
+            self.assertTrue(os.path.exists(result.target))
+
+    def test_failure(self):
+        """server: extraction failures are results, not protocol errors"""
+        missing = os.path.join(self.workdir, 'missing.zip')
+        result, = submit(self.sock, [missing], self.target, ordered=False)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.source, missing)
+
+    def test_message(self):
+        """server: error messages don't contain reprs of unicode paths"""
+        missing = os.path.join(self.workdir, u'missing.zip')
+        result, = submit(self.sock, [missing], self.target)
+        self.assertEqual(result.message,
+                         u"Source file does not exist: %s" % missing)
+
+    def test_worker_failure(self):
+        """server: jobs whose worker raises or dies still free their slot"""
+        sock = os.path.join(self.workdir, 'flaky.sock')
+        server._extract_one = flaky_extract
+        try:
+            flaky = ExtractionServer(sock, jobs=1, queue_depth=1)
+        finally:
+            server._extract_one = _extract_one
+        thread = threading.Thread(target=flaky.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        try:
+            paths = [os.path.join(self.workdir, x)
+                     for x in ('raise.zip', 'die.zip')] + self.paths[:1]
+            results = list(submit(sock, paths, self.target))
+        finally:
+            flaky.shutdown()
+            thread.join()
+            flaky.server_close()
+        self.assertEqual([x.error for x in results],
+                         ['SystemExit', 'WorkerLost', None])
+        self.assertEqual([x.errcode for x in results], [7, 7, None])
+
+    def test_bad_request(self):
+        """server: malformed requests are rejected"""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.sock)
+        client.sendall(b'{"paths": "relative.zip"}\n')
+        self.assertTrue(b'"error"' in client.makefile('rb').readline())
+        client.close()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.sock)
+        client.sendall(b'{"target": "/tmp"}\n')
+        self.assertTrue(b'"Bad request: missing paths"' in
+                        client.makefile('rb').readline())
+        client.close()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.sock)
+        client.sendall(b'{"paths": [], "memory_budget": "lots"}\n')
+        self.assertTrue(b'"Bad request: ' in
+                        client.makefile('rb').readline())
+        client.close()
+
+    def test_socket(self):
+        """server: live sockets are protected, stale ones replaced"""
+        self.assertEqual(os.stat(self.sock).st_mode & 0o777, 0o600)
+        self.assertRaises(socket.error, ExtractionServer, self.sock)
+
+        stale = os.path.join(self.workdir, 'stale.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(stale)
+        listener.close()
+        ExtractionServer(stale).server_close()
+        self.assertFalse(os.path.exists(stale))
+
+    def test_unreachable(self):
+        """submit: a missing daemon raises socket.error"""
+        missing = os.path.join(self.workdir, 'missing.sock')
+        self.assertRaises(socket.error, list, submit(missing, self.paths))
+        self.assertTrue(issubclass(ServerError, Exception))
@@ -5,7 +5,7 @@
 __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2.0 or later"
 
-import logging, sys
+import errno, logging, os, shutil, subprocess, sys, tempfile, time, warnings
 log = logging.getLogger(__name__)
 
 if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
@@ -14,7 +14,13 @@ if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
 else:                                                     # pragma: no cover
     import unittest
 
-from unball.util import BinYes, which  # , NamedTemporaryFolder
+from unball import util
+from unball.util import (BinYes, CrossDeviceWarning, ExtractionStats,
+                         OutputLimitExceeded, OutputLimits, PathIndex,
+                         ProcessRegistry, StagingGuard, StagingOverflow,
+                         TempTarget, check_staging, move_tree,
+                         normalize_permissions, parse_size, rename_new,
+                         which)  # , NamedTemporaryFolder
 
 class TestBinYes(unittest.TestCase):
     def test_callability(self):
@@ -102,7 +108,362 @@ class TestNamedTemporaryFolder(unittest.TestCase):
         @todo: Look into how to test a context manager for GC-safety.
     """
 
-#TODO: Test TempTarget and which() fully and properly
+class TestPathIndex(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.bindir = os.path.join(self.workdir, 'bin')
+        os.mkdir(self.bindir)
+        open(os.path.join(self.bindir, 'foo'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_which(self):
+        """Test that PathIndex.which() searches paths in order"""
+        index = PathIndex()
+        missing = os.path.join(self.workdir, 'missing')
+        self.assertEqual(index.which('foo', [missing, self.bindir]),
+                         os.path.join(self.bindir, 'foo'))
+        self.assertIsNone(index.which('bar', [missing, self.bindir]))
+
+    def test_memoization(self):
+        """Test that PathIndex lists each directory only once"""
+        index = PathIndex()
+        index.which('foo', [self.bindir])
+        mtimes = index.mtimes()
+        self.assertEqual(list(mtimes), [self.bindir])
+
+        open(os.path.join(self.bindir, 'bar'), 'w').close()
+        self.assertIsNone(index.which('bar', [self.bindir]),
+            "PathIndex must not re-list directories until refreshed")
+
+        # Force an mtime change in case the filesystem's resolution is coarse
+        os.utime(self.bindir, (0, 0))
+        self.assertFalse(index.is_current(mtimes))
+
+        index.refresh()
+        self.assertEqual(index.which('bar', [self.bindir]),
+                         os.path.join(self.bindir, 'bar'))
+
+class TestNormalizePermissions(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+
+    def tearDown(self):
+        for path, dirs, files in os.walk(self.workdir):
+            os.chmod(path, 0o755)
+        shutil.rmtree(self.workdir)
+
+    def test_fixes_only_what_is_needed(self):
+        """Test that normalize_permissions only touches broken entries"""
+        locked_dir = os.path.join(self.workdir, 'locked')
+        locked_file = os.path.join(locked_dir, 'secret')
+        fine_file = os.path.join(self.workdir, 'fine')
+        os.mkdir(locked_dir)
+        open(locked_file, 'w').close()
+        open(fine_file, 'w').close()
+        os.chmod(locked_file, 0)
+        os.chmod(fine_file, 0o640)
+        os.chmod(locked_dir, 0o200)
+
+        self.assertEqual(normalize_permissions(self.workdir), 2)
+        self.assertEqual(os.stat(locked_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(locked_file).st_mode & 0o777, 0o400)
+        self.assertEqual(os.stat(fine_file).st_mode & 0o777, 0o640)
+        self.assertEqual(normalize_permissions(self.workdir), 0)
+
+    def test_symlinks_not_followed(self):
+        """Test that normalize_permissions doesn't chmod through symlinks"""
+        outside = tempfile.mkdtemp('-unballtest')
+        try:
+            target = os.path.join(outside, 'target')
+            open(target, 'w').close()
+            os.chmod(target, 0)
+            os.symlink(target, os.path.join(self.workdir, 'link'))
+
+            normalize_permissions(self.workdir)
+            self.assertEqual(os.stat(target).st_mode & 0o777, 0)
+        finally:
+            shutil.rmtree(outside)
+
+class TestTempTarget(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.target = os.path.join(self.workdir, 'target')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _extract(self, context):
+        with context as tmp:
+            with open(os.path.join(tmp, 'data'), 'wb') as fobj:
+                fobj.write(b'x' * 1000)
+        with open(os.path.join(self.target, 'data'), 'rb') as fobj:
+            self.assertEqual(fobj.read(), b'x' * 1000)
+        self.assertEqual(os.listdir(self.workdir), ['target'])
+
+    def test_same_device(self):
+        """Test that an unusable parent falls back to the target's folder"""
+        context = TempTarget(self.target,
+                             parent=os.path.join(self.workdir, 'missing'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self._extract(context)
+        self.assertTrue(context.same_device)
+        self.assertEqual(context.bytes_copied, 0)
+        self.assertFalse(caught)
+
+    def test_cross_device(self):
+        """Test that copying across filesystems is warned about and measured
+        """
+        staging = tempfile.mkdtemp('-unballtest')
+        old_device, old_mkdtemp = util._device, tempfile.mkdtemp
+
+        def mkdtemp(suffix='', prefix='tmp', dir=None):
+            if dir == self.workdir:  # Simulate a read-only target folder
+                raise OSError(13, "Permission denied", dir)
+            return old_mkdtemp(suffix, prefix, dir)
+
+        util._device = lambda path: path == self.workdir and 1 or 2
+        tempfile.mkdtemp = mkdtemp
+        context = TempTarget(self.target, parent=staging)
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                self._extract(context)
+        finally:
+            util._device, tempfile.mkdtemp = old_device, old_mkdtemp
+            shutil.rmtree(staging)
+        self.assertFalse(context.same_device)
+        self.assertEqual(context.bytes_copied, 1000)
+        self.assertTrue(all(issubclass(x.category, CrossDeviceWarning)
+                            for x in caught) and len(caught) == 2)
+
+    def test_target_taken(self):
+        """Test that a taken target fails with EEXIST and is never replaced
+        """
+        def extract(target, name):
+            with TempTarget(target, parent=self.workdir,
+                            collapse=True) as tmp:
+                with open(os.path.join(tmp, name), 'w') as fobj:
+                    fobj.write('new')
+
+        os.mkdir(self.target)
+        target = os.path.join(self.workdir, 'foo.txt')
+        with open(target, 'w') as fobj:
+            fobj.write('old')
+
+        for args in ((self.target, 'data'), (target, 'foo.txt')):
+            try:
+                extract(*args)
+            except OSError as err:
+                self.assertEqual(err.errno, errno.EEXIST)
+            else:
+                self.fail("OSError not raised for %s" % args[0])
+        self.assertEqual(os.listdir(self.target), [])
+        with open(target) as fobj:
+            self.assertEqual(fobj.read(), 'old')
+        self.assertEqual(sorted(os.listdir(self.workdir)),
+                         sorted([os.path.basename(self.target), 'foo.txt']))
+
+    def test_rename_new(self):
+        """Test that rename_new fails rather than replacing anything"""
+        src, dst = (os.path.join(self.workdir, x) for x in ('src', 'dst'))
+        for make, remove in ((os.mkdir, os.rmdir),
+                             (lambda path: open(path, 'w').close(),
+                              os.remove)):
+            make(src)
+            make(dst)
+            self.assertRaises(OSError, rename_new, src, dst)
+            self.assertTrue(os.path.exists(src))
+            remove(dst)
+            rename_new(src, dst)
+            self.assertFalse(os.path.exists(src))
+            remove(dst)
+
+    def test_move_tree(self):
+        """Test that move_tree copies files, links, and modes, then deletes
+        the source"""
+        src = os.path.join(self.workdir, 'src')
+        os.makedirs(os.path.join(src, 'a', 'b'))
+        for index in range(20):
+            with open(os.path.join(src, 'a', 'b', str(index)), 'wb') as fobj:
+                fobj.write(b'x' * index)
+        os.symlink('b/0', os.path.join(src, 'a', 'link'))
+        os.chmod(os.path.join(src, 'a', 'b', '1'), 0o640)
+        os.chmod(os.path.join(src, 'a', 'b'), 0o500)
+
+        copied, seconds = move_tree(src, self.target, threads=4)
+        self.assertEqual(copied, sum(range(20)))
+        self.assertFalse(os.path.exists(src))
+
+        moved = os.path.join(self.target, 'a', 'b')
+        self.assertEqual(os.readlink(os.path.join(self.target, 'a', 'link')),
+                         'b/0')
+        self.assertEqual(os.stat(os.path.join(moved, '1')).st_mode & 0o777,
+                         0o640)
+        self.assertEqual(os.stat(moved).st_mode & 0o777, 0o500)
+        os.chmod(moved, 0o700)
+
+    def test_move_tree_exists(self):
+        """Test that move_tree refuses to merge into an existing target"""
+        src = os.path.join(self.workdir, 'src')
+        os.mkdir(src)
+        os.mkdir(self.target)
+        self.assertRaises(OSError, move_tree, src, self.target)
+        self.assertTrue(os.path.isdir(src))
+
+class TestMemoryStaging(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.memdir = tempfile.mkdtemp('-unballtest')
+        self.target = os.path.join(self.workdir, 'target')
+        self.old_env = os.environ.get('UNBALL_MEMORY_DIR')
+        os.environ['UNBALL_MEMORY_DIR'] = self.memdir
+
+    def tearDown(self):
+        if self.old_env is None:
+            del os.environ['UNBALL_MEMORY_DIR']
+        else:
+            os.environ['UNBALL_MEMORY_DIR'] = self.old_env
+        shutil.rmtree(self.workdir)
+        shutil.rmtree(self.memdir)
+
+    def _fill(self, path, size, guard=None):
+        with open(os.path.join(path, 'data'), 'wb') as fobj:
+            fobj.write(b'x' * size)
+        if guard:
+            for _ in range(100):  # Give the guard's thread a chance to run
+                if guard.exceeded:
+                    break
+                time.sleep(0.05)
+
+    def test_parse_size(self):
+        """Test that sizes accept binary unit suffixes"""
+        self.assertEqual(parse_size('4096'), 4096)
+        self.assertEqual(parse_size('50M'), 50 * 1024 ** 2)
+        self.assertEqual(parse_size('1.5g'), 3 * 1024 ** 3 // 2)
+        self.assertEqual(parse_size('2KiB'), 2048)
+        self.assertRaises(ValueError, parse_size, 'lots')
+
+    def test_publish_from_memory(self):
+        """Test that TempTarget stages in the memory directory and copies
+        the result out without a warning"""
+        context = TempTarget(self.target, memory_budget=1024)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with context as tmp:
+                self.assertEqual(os.path.dirname(tmp), self.memdir)
+                self._fill(tmp, 100)
+        self.assertFalse(caught)
+        self.assertEqual(context.bytes_copied, 100)
+        self.assertEqual(os.listdir(self.memdir), [])
+        self.assertEqual(os.listdir(self.target), ['data'])
+
+    def test_overflow(self):
+        """Test that exceeding the budget aborts extraction and subprocesses
+        """
+        registry = ProcessRegistry()
+        guard = StagingGuard(self.memdir, 100, interval=0.01)
+        guard.start()
+        try:
+            proc = registry.popen(['sleep', '30'], owner=self.memdir)
+            util.CHILDREN, old_children = registry, util.CHILDREN
+            try:
+                self._fill(self.memdir, 1000, guard)
+            finally:
+                util.CHILDREN = old_children
+            self.assertTrue(guard.exceeded)
+            self.assertTrue(proc.wait() < 0)
+            self.assertRaises(StagingOverflow, check_staging,
+                              os.path.join(self.memdir, 'nested'))
+        finally:
+            guard.stop()
+        check_staging(self.memdir)  # No longer guarded
+
+    def test_charge(self):
+        """Test that reported writes are counted against the budget before
+        the guard's thread next measures"""
+        guard = StagingGuard(self.memdir, 100, interval=3600)
+        guard.start()
+        try:
+            check_staging(self.memdir, 60)
+            self.assertRaises(StagingOverflow, check_staging,
+                              os.path.join(self.memdir, 'nested'), 60)
+            self.assertTrue(guard.exceeded)
+        finally:
+            guard.stop()
+        self.assertEqual(guard.written, 120)
+
+    def test_overflow_context(self):
+        """Test that TempTarget reports an aborted extraction as an overflow
+        """
+        context = TempTarget(self.target, memory_budget=100)
+
+        def extract():
+            with context as tmp:
+                self._fill(tmp, 1000, context.guard)
+                check_staging(tmp)
+        self.assertRaises(StagingOverflow, extract)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertEqual(os.listdir(self.memdir), [])
+
+    def test_output_limit(self):
+        """Test that TempTarget fails extractions which outgrow their
+        output_limit, even after a clean exit"""
+        context = TempTarget(self.target, parent=self.workdir,
+                             output_limit=100)
+
+        def extract():
+            with context as tmp:
+                self._fill(tmp, 1000, context.output_guard)
+        self.assertRaises(OutputLimitExceeded, extract)
+        self.assertTrue(context.output_guard.exceeded)
+        self.assertEqual(os.listdir(self.workdir), [])
+
+        archive = os.path.join(self.workdir, 'archive')
+        self._fill(self.workdir, 1000)
+        os.rename(os.path.join(self.workdir, 'data'), archive)
+        self.assertEqual(OutputLimits(100).budget(archive), 100000)
+        self.assertEqual(OutputLimits(100, 5000).budget(archive), 5000)
+        self.assertEqual(OutputLimits(size=0).budget(archive), 0)
+        self.assertEqual(OutputLimits().budget(archive), None)
+
+        open(archive, 'w').close()
+        self.assertEqual(OutputLimits(100).budget(archive),
+                         OutputLimits.RATIO_FLOOR)
+
+    def test_registry_check_call(self):
+        """Test that ProcessRegistry.check_call behaves like the original"""
+        registry = ProcessRegistry()
+        self.assertEqual(registry.check_call(['true']), 0)
+        self.assertRaises(subprocess.CalledProcessError,
+                          registry.check_call, ['false'])
+
+#TODO: Test which() fully and properly
+class TestExtractionStats(unittest.TestCase):
+    def test_phases(self):
+        """ExtractionStats: repeated phases accumulate in first-seen order"""
+        stats = ExtractionStats()
+        for name in ('detect', 'extract', 'detect'):
+            with stats.phase(name):
+                pass
+        stats.add('publish', 0.5)
+        self.assertEqual([x[0] for x in stats.phases],
+                         ['detect', 'extract', 'publish'])
+        self.assertTrue(stats.total >= 0.5)
+
+    def test_measure(self):
+        """ExtractionStats: measure() records child resource usage"""
+        stats = ExtractionStats()
+        with stats.measure():
+            subprocess.call(['true'])
+        record = stats.as_dict()
+        self.assertEqual(set(record),
+                         set(['phases', 'total', 'process', 'children']))
+        if util.resource:
+            self.assertTrue('user_seconds' in record['children'])
+
 def test_which():
     """Placeholder integration test for which()
 
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Test Suite for Unball's watch-folder mode."""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, shutil, sys, tempfile, threading, time, zipfile
+
+if sys.version_info[0] == 2 and sys.version_info[1] < 7:  # pragma: no cover
+    import unittest2 as unittest
+    unittest  # Silence erroneous PyFlakes warning
+else:                                                     # pragma: no cover
+    import unittest
+
+from unball.watch import Inotify, SeenFiles, watch
+
+try:
+    Inotify().close()
+    HAVE_INOTIFY = True
+except OSError:
+    HAVE_INOTIFY = False
+
+class TestSeenFiles(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.path = os.path.join(self.workdir, 'notes.txt')
+        with open(self.path, 'w') as fobj:
+            fobj.write("Not an archive\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_invalidation(self):
+        """SeenFiles: entries expire when the file changes"""
+        seen = SeenFiles()
+        self.assertFalse((self.path, os.stat(self.path)) in seen)
+        seen.add(self.path, os.stat(self.path), 0)
+        self.assertTrue((self.path, os.stat(self.path)) in seen)
+
+        with open(self.path, 'a') as fobj:
+            fobj.write("More text\n")
+        self.assertFalse((self.path, os.stat(self.path)) in seen)
+
+    def test_persistence(self):
+        """SeenFiles: entries survive a save/load round-trip"""
+        cache_path = os.path.join(self.workdir, 'cache', 'seen.json')
+        seen = SeenFiles(cache_path)
+        seen.add(self.path, os.stat(self.path), 0)
+        seen.save()
+        self.assertTrue((self.path, os.stat(self.path)) in
+                        SeenFiles(cache_path))
+
+        os.remove(self.path)
+        seen.prune(self.workdir)
+        self.assertEqual(seen.entries, {})
+
+class CountingSeenFiles(SeenFiles):
+    """A L{SeenFiles} which counts how often it's actually written out"""
+    writes = 0
+
+    def save(self):
+        if self.dirty:
+            self.writes += 1
+        SeenFiles.save(self)
+
+@unittest.skipUnless(HAVE_INOTIFY, "inotify not available")
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp('-unballtest')
+        self.watched = os.path.join(self.workdir, 'in')
+        self.target = os.path.join(self.workdir, 'out')
+        os.mkdir(self.watched)
+        os.mkdir(self.target)
+        self.seen = SeenFiles()
+
+        with open(os.path.join(self.watched, 'notes.txt'), 'w') as fobj:
+            fobj.write("Not an archive\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def make_zip(self, name):
+        """Write a zip elsewhere and move it in, like a careful producer."""
+        path = os.path.join(self.workdir, name)
+        archive = zipfile.ZipFile(path, 'w')
+        archive.writestr('%s.txt' % name, name)
+        archive.close()
+        os.rename(path, os.path.join(self.watched, name))
+
+    def test_watch(self):
+        """watch: existing and newly arrived files are processed once"""
+        results = watch(self.watched, self.target, settle=0, seen=self.seen)
+        try:
+            result = next(results)
+            self.assertEqual(result.errcode, 0)
+
+            self.make_zip('one.zip')
+            result = next(results)
+            self.assertTrue(result.ok, result.message)
+            self.assertEqual(os.path.basename(result.source), 'one.zip')
+        finally:
+            results.close()
+
+        # A restart only picks up files which are new or changed
+        results = watch(self.watched, self.target, settle=0, seen=self.seen)
+        try:
+            self.make_zip('two.zip')
+            result = next(results)
+            self.assertEqual(os.path.basename(result.source), 'two.zip')
+        finally:
+            results.close()
+
+    def test_settle(self):
+        """watch: files aren't processed until they stop changing"""
+        results = watch(self.watched, self.target, settle=0.5,
+                        seen=self.seen)
+        try:
+            next(results)
+            start = time.time()
+            self.make_zip('one.zip')
+            result = next(results)
+            self.assertTrue(result.ok, result.message)
+            self.assertTrue(time.time() - start >= 0.5)
+        finally:
+            results.close()
+
+    def test_settle_existing(self):
+        """watch: files present at startup must stop changing too"""
+        path = os.path.join(self.watched, 'notes.txt')
+        fobj = open(path, 'a')  # A producer which was already writing
+
+        def produce():
+            for _ in range(8):
+                time.sleep(0.1)
+                fobj.write("More text\n")
+                fobj.flush()
+        producer = threading.Thread(target=produce)
+
+        results = watch(self.watched, self.target, settle=0.5,
+                        seen=self.seen)
+        try:
+            producer.start()
+            result = next(results)
+            self.assertEqual(result.errcode, 0)
+            producer.join()
+            self.assertTrue((path, os.stat(path)) in self.seen)
+        finally:
+            results.close()
+            producer.join()
+            fobj.close()
+
+    def test_save_batched(self):
+        """watch: the seen cache is written once per batch, not per file"""
+        for name in ('one.zip', 'two.zip', 'three.zip'):
+            self.make_zip(name)
+        seen = CountingSeenFiles(os.path.join(self.workdir, 'seen.json'))
+        results = watch(self.watched, self.target, settle=0, seen=seen)
+        try:
+            for _ in range(4):
+                next(results)
+            self.assertEqual(seen.writes, 0)
+        finally:
+            results.close()
+        self.assertEqual(seen.writes, 1)
+        self.assertEqual(len(SeenFiles(seen.cache_path).entries), 7)
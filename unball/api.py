@@ -0,0 +1,250 @@
+"""Library interface for embedding unball in other Python programs.
+
+Unlike shelling out to the C{unball} command once per file, these functions
+keep the extractor dispatch table and the libmagic handle loaded for the life
+of the process (and share them with worker processes via C{fork}) and return
+structured results rather than text to be scraped from stdout.
+
+Example::
+
+    from unball.api import extract_many
+
+    for result in extract_many(paths, '/srv/incoming', jobs=4):
+        if result.ok:
+            ingest(result.target)
+        else:
+            log.warning("%s: %s", result.source, result.message)
+
+@note: L{ExtractionResult} and the worker functions must stay picklable and
+    importable at module level so they can cross process boundaries.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import multiprocessing, subprocess
+
+from .extractors import (get_dispatch_table, NoExtractorError,
+                         UnsupportedFiletypeError)
+from .main import NothingProducedError, tryExtract
+from .mimetypes import load_magic
+from .util import ExtractionStats, OutputLimitExceeded
+
+class ExtractionResult(object):
+    """The outcome of extracting a single archive.
+
+    @ivar source: The path to the archive, as given.
+    @ivar target: The path of the directory or file which was produced, or
+        C{None} if extraction failed.
+    @ivar extractor: C{repr()} of the extractor which succeeded (or was
+        tried last), if any.
+    @ivar mime: The detected mimetype of C{source}.
+    @ivar error: The class name of the exception which stopped extraction,
+        or C{None} on success.
+    @ivar errcode: The C{unball} exit code corresponding to C{error}.
+        (C{None} on success and C{0} for files which weren't recognized as
+        archives)
+    @ivar message: The error message, if any.
+    @ivar stats: The L{ExtractionStats.as_dict} record for the attempt, with
+        per-phase timings and resource usage.
+    """
+    def __init__(self, source, target=None, error=None, errcode=None,
+                 message=None, stats=None):
+        self.source, self.target = source, target
+        self.error, self.errcode, self.message = error, errcode, message
+        self.stats = stats or {}
+        self.extractor = self.stats.get('extractor')
+        self.mime = self.stats.get('mime')
+
+    def __repr__(self):
+        return "<ExtractionResult(%r, target=%r, error=%r)>" % (
+            self.source, self.target, self.error)
+
+    def as_dict(self):
+        """Return the constructor arguments as a JSON-serializable dict.
+        (C{ExtractionResult(**result.as_dict())} rebuilds the result)"""
+        return dict(source=self.source, target=self.target,
+                    error=self.error, errcode=self.errcode,
+                    message=self.message, stats=self.stats)
+
+    @property
+    def ok(self):
+        """C{True} if extraction succeeded."""
+        return self.errcode is None
+
+    @property
+    def cache_hit(self):
+        """C{True} if the output was copied from an extraction cache."""
+        return self.stats.get('cache') == 'hit'
+
+    @property
+    def seconds(self):
+        """Total wall-clock time spent on this archive."""
+        return self.stats.get('total', 0)
+
+#{ Worker functions
+
+#: Exit codes for exceptions raised by L{tryExtract}, checked in order.
+#: (L{UnsupportedFiletypeError} must precede L{NoExtractorError})
+ERRCODES = (
+    (UnsupportedFiletypeError, 0),  # Not an archive. Just a caution.
+    (NothingProducedError, 1),      # Bug trap triggered
+    (IOError, 2),                   # Permissions error
+    (OSError, 3),                   # Path error (eg. target exists)
+    (NoExtractorError, 4),          # Could not find suitable extractor
+    (subprocess.CalledProcessError, 5),  # Extractor failed
+    (OutputLimitExceeded, 8),       # Too big or a decompression bomb
+    (Exception, 7),                 # Unknown error
+)
+
+def _errcode(err):
+    """Map an exception from L{tryExtract} to an C{unball} exit code."""
+    for cls, errcode in ERRCODES:
+        if isinstance(err, cls):
+            if errcode == 5 and err.returncode < 0:
+                return 6  # Extractor killed by a signal (eg. Ctrl+C)
+            return errcode
+    return 7  # Not even an Exception. (eg. SystemExit in a worker)
+
+def _extract_one(job):
+    """Run L{tryExtract} on a single C{(archive, outdir, options)} tuple and
+    reduce the outcome to an L{ExtractionResult}. (C{options} is a dict of
+    extra L{tryExtract} arguments)
+
+    @rtype: L{ExtractionResult}
+    """
+    archive, outdir, options = job
+    stats = ExtractionStats()
+    try:
+        target = tryExtract(archive, outdir, stats=stats, **options)
+    except Exception as err:
+        return _error_result(archive, err, stats)
+    return ExtractionResult(archive, target, stats=stats.as_dict())
+
+def _error_result(archive, err, stats=None):
+    """Build the L{ExtractionResult} for C{archive} failing with C{err}."""
+    return ExtractionResult(archive, None, type(err).__name__, _errcode(err),
+                            _message(err), stats and stats.as_dict())
+
+def _message(err):
+    """Format C{err} for L{ExtractionResult.message}.
+
+    Unlike C{str()}, this doesn't turn unicode paths into C{u'...'} reprs on
+    Python 2.
+    """
+    if isinstance(err, subprocess.CalledProcessError):
+        cmd = err.cmd
+        if not isinstance(cmd, basestring):
+            cmd = ' '.join(cmd)
+        return "%s returned non-zero exit status %d" % (cmd, err.returncode)
+    elif isinstance(err, EnvironmentError) and err.strerror:
+        if err.filename is None:
+            return err.strerror
+        return "%s: %s" % (err.strerror, err.filename)
+    elif isinstance(err, KeyError) and err.args:
+        return "%s" % (err.args[0],)  # (str() gives the repr)
+
+    try:
+        return u"%s" % (err,)
+    except UnicodeError:  # Non-ASCII byte strings on Python 2
+        return str(err)
+
+def _options(memory_budget=None, cache=None, dedup=None, member_filter=None,
+             limits=None):
+    """Build the L{tryExtract} keyword arguments for the given settings."""
+    options = dict(memory_budget=memory_budget, cache=cache, dedup=dedup,
+                   member_filter=member_filter, limits=limits)
+    return dict((key, value) for key, value in options.items() if value)
+
+def _iter_pool(results, poll=3600):
+    """Yield from a C{Pool.imap} iterator without blocking C{SIGINT}.
+
+    @note: Waiting without a timeout can't be interrupted by Ctrl+C.
+        (See http://bugs.python.org/issue8296)
+    """
+    while True:
+        try:
+            yield results.next(poll)
+        except StopIteration:
+            return
+        except multiprocessing.TimeoutError:
+            continue
+
+#}
+
+def preload():
+    """Load everything that is otherwise deferred until first use (the
+    dispatch table and the libmagic database) so later calls, and worker
+    processes forked after this, don't pay for it."""
+    get_dispatch_table()
+    load_magic()
+
+def extract(path, target=None, memory_budget=None, cache=None, dedup=None,
+            member_filter=None, limits=None):
+    """Extract a single archive.
+
+    @param path: The archive to extract.
+    @param target: The directory to extract into. (Default: the directory
+        containing C{path})
+    @param memory_budget: If given, stage archives expected to unpack to
+        fewer than this many bytes in RAM. (See L{tryExtract})
+    @param cache: An L{ExtractionCache<unball.cache.ExtractionCache>} to
+        reuse the output of previous extractions from.
+    @param dedup: A L{Deduplicator<unball.dedup.Deduplicator>} to replace
+        identical files in each output tree with links.
+    @param member_filter: A L{MemberFilter<unball.extractors.MemberFilter>}
+        selecting which members to extract.
+    @param limits: L{OutputLimits<unball.util.OutputLimits>} to fail
+        archives which would unpack to too much with C{errcode} 8.
+
+    @rtype: L{ExtractionResult}
+    """
+    return _extract_one((path, target, _options(memory_budget, cache, dedup,
+                                                member_filter, limits)))
+
+def extract_many(paths, target=None, jobs=1, ordered=True,
+                 memory_budget=None, cache=None, dedup=None,
+                 member_filter=None, limits=None, pool=None):
+    """Extract several archives, yielding an L{ExtractionResult} for each as
+    it completes.
+
+    @param paths: An iterable of archive paths.
+    @param target: See L{extract}.
+    @param jobs: Extract up to this many archives in parallel.
+    @param ordered: If C{False}, yield results as soon as each archive
+        finishes rather than in the order of C{paths}.
+    @param memory_budget: See L{extract}.
+    @param cache: See L{extract}.
+    @param dedup: See L{extract}.
+    @param member_filter: See L{extract}.
+    @param limits: See L{extract}.
+    @param pool: A C{multiprocessing.Pool} to reuse rather than starting one
+        for this call. (Recommended for long-running services) It will not be
+        terminated when the generator finishes.
+
+    @note: Closing the generator early (eg. C{break}) terminates any pool it
+        started, killing extractions still in progress.
+    @rtype: generator of L{ExtractionResult}
+    """
+    options = _options(memory_budget, cache, dedup, member_filter, limits)
+    jobs_list = [(path, target, options) for path in paths]
+
+    preload()  # Before forking, so workers inherit it
+
+    owned = None
+    if pool is None and jobs > 1 and len(jobs_list) > 1:
+        pool = owned = multiprocessing.Pool(min(jobs, len(jobs_list)))
+
+    try:
+        if pool:
+            imap = ordered and pool.imap or pool.imap_unordered
+            results = _iter_pool(imap(_extract_one, jobs_list))
+        else:
+            results = (_extract_one(job) for job in jobs_list)
+
+        for result in results:
+            yield result
+    finally:
+        if owned:
+            owned.terminate()
+            owned.join()
@@ -0,0 +1,179 @@
+"""Content-addressed cache of extracted trees, so an archive which has been
+extracted before (under any name) is copied out of the cache rather than
+extracted again.
+
+Entries are keyed by a hash of the archive's contents and hold what the
+extractor produced (before any archive nested within it was unpacked) in
+C{<root>/<key>/tree}, plus a small C{meta.json}. Copies in and out use
+reflinks where the filesystem supports them (See L{copy_file}) and,
+optionally, hardlinks.
+
+Each entry's directory mtime records when it was last used, so the least
+recently used entries can be evicted once the cache exceeds its size limit.
+Entries are only ever published and evicted by C{rename}, so several
+processes can share a cache. A reader which loses a race with eviction
+falls back to running the real extractor.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import errno, hashlib, json, os, shutil, tempfile, time
+
+from .extractors import Extractor
+from .util import copy_file, copy_tree, tree_size
+
+DEFAULT_LIMIT = 1024 ** 3  #: Default cache size limit in bytes
+HASH_BLOCK = 1024 * 1024   #: Read size when hashing archives
+
+class CachedTree(Extractor):
+    """A pseudo-extractor which copies a cache entry into the target
+    instead of extracting anything."""
+    normalizes_permissions = True  # It was done before the tree was stored
+
+    def __init__(self, cache, key, meta):
+        self.cache, self.key, self.meta = cache, key, meta
+        self.mime = meta.get('mime')
+
+    def __repr__(self):
+        return "<%s(%r)>" % (self.__class__.__name__, self.key)
+
+    def __call__(self, path, target, member_filter=None):
+        self.cache.materialize(self.key, target)
+
+    def isViable(self):
+        return True
+
+class ExtractionCache(object):
+    """A size-limited, LRU-evicted store of extracted trees.
+
+    @param root: The directory holding the cache. Created on first store.
+    @param limit: The size, in bytes, the cache is trimmed to after each
+        store.
+    @param hardlinks: Hardlink files in and out of the cache when reflinks
+        aren't available.
+
+    @note: Hardlinked outputs share their inodes with the cache, so editing
+        them in place (rather than replacing them) also alters the cached
+        copy. Leave C{hardlinks} off unless outputs are treated as
+        read-only.
+    """
+    def __init__(self, root, limit=DEFAULT_LIMIT, hardlinks=False):
+        self.root = os.path.abspath(root)
+        self.limit = limit
+        self.hardlinks = hardlinks
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (self.__class__.__name__, self.root,
+                                   self.limit, self.hardlinks)
+
+    @staticmethod
+    def key(path):
+        """Return the cache key for the archive at C{path}.
+
+        @rtype: C{str}
+        """
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fobj:
+            for block in iter(lambda: fobj.read(HASH_BLOCK), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _copier(self, src, dst):
+        """Copy a file for L{copy_tree}, hardlinking if allowed."""
+        if self.hardlinks:
+            try:
+                os.link(src, dst)
+                return 0
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        return copy_file(src, dst)
+
+    def lookup(self, key):
+        """Return a L{CachedTree} for C{key} (marking it as recently used)
+        or C{None} if it isn't cached."""
+        entry = os.path.join(self.root, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as fobj:
+                meta = json.load(fobj)
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return CachedTree(self, key, meta)
+
+    def materialize(self, key, target):
+        """Replace the empty directory C{target} with a copy of the tree
+        cached under C{key}.
+
+        @raises OSError: The entry was evicted or C{target} isn't empty.
+        """
+        os.rmdir(target)
+        copy_tree(os.path.join(self.root, key, 'tree'), target,
+                  copier=self._copier)
+
+    def store(self, key, tree, **meta):
+        """Copy C{tree} into the cache under C{key}, then evict the least
+        recently used entries until the cache fits in L{limit}.
+
+        Failures are ignored since the cache is purely an optimization.
+
+        @param meta: Extra details to record in C{meta.json}.
+        @return: C{True} if the entry was stored.
+        """
+        try:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            staging = tempfile.mkdtemp(prefix='.store-', dir=self.root)
+        except (IOError, OSError):
+            return False
+
+        try:
+            copy_tree(tree, os.path.join(staging, 'tree'),
+                      copier=self._copier)
+            meta.update(size=tree_size(staging), stored=time.time())
+            with open(os.path.join(staging, 'meta.json'), 'w') as fobj:
+                json.dump(meta, fobj)
+            os.rename(staging, os.path.join(self.root, key))
+        except (IOError, OSError):
+            return False  # Includes another process having stored it first
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict()
+        return True
+
+    def entries(self):
+        """Return C{(last_used, size, key)} for every cache entry,
+        least recently used first."""
+        entries = []
+        for key in os.listdir(self.root):
+            if key.startswith('.'):
+                continue  # Being stored or evicted
+            entry = os.path.join(self.root, key)
+            try:
+                with open(os.path.join(entry, 'meta.json')) as fobj:
+                    size = json.load(fobj)['size']
+                entries.append((os.stat(entry).st_mtime, size, key))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+        return sorted(entries)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        L{limit}."""
+        try:
+            entries = self.entries()
+        except OSError:
+            return
+        total = sum(x[1] for x in entries)
+        for _, size, key in entries:
+            if total <= self.limit:
+                break
+            doomed = os.path.join(self.root, '.evict-%s' % key)
+            try:
+                os.rename(os.path.join(self.root, key), doomed)
+            except OSError:
+                continue  # Another process got to it first
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
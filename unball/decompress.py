@@ -0,0 +1,554 @@
+"""Streaming in-process decompression for the stdlib-based extractors
+
+Compressed input is read into one large, reused buffer and fed to the
+decompressor in bounded slices so a single iteration can never balloon into
+an unbounded amount of output. (At most L{OUTPUT_LIMIT} for gzip and one
+block, L{BZ2_BLOCK_OUTPUT}, for bzip2) Output is produced lazily, so a slow
+consumer (eg. a disk or C{tarfile}) naturally throttles how much input gets
+read.
+
+Both formats may consist of several concatenated members/streams (as
+produced by C{pbzip2}, C{bgzip}, C{cat a.gz b.gz}, etc.) and these are
+decoded back to back, just as C{gunzip} and C{bunzip2} do.
+
+L{parallel_chunks} additionally splits seekable input into independently
+decodable pieces (bzip2 blocks or BGZF members) and decodes them on a thread
+pool. (C{zlib} and C{bz2} release the GIL while decompressing)
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import binascii, mmap, os, struct, time
+
+READ_SIZE = 1 << 20    #: Bytes of compressed input read per system call
+FEED_SIZE = 1 << 16    #: Bytes of compressed input per decompress() call
+OUTPUT_LIMIT = 1 << 22  #: Target bytes of output per decompress() call
+SCAN_SIZE = 1 << 22    #: Bytes searched per step when splitting bzip2 files
+
+try:
+    _view = buffer  # Python 2: Zero-copy slices of the read buffer
+except NameError:  # pragma: no cover
+    def _view(buf, offset, size):
+        """Zero-copy slice of C{buf} for Python 3"""
+        return memoryview(buf)[offset:offset + size]
+
+#{ Formats
+
+class Format(object):
+    """Describes how to decode one compressed stream format.
+
+    @ivar name: Human-readable name for error messages.
+    @ivar magic: Bytes every member/stream must start with. Data following
+        the last member which doesn't match is ignored as trailing garbage.
+    """
+    name, magic = None, None
+
+    def new(self):
+        """Return a fresh decompressor object for the next member."""
+        raise NotImplementedError()
+
+    def decompress(self, decomp, data):
+        """Feed C{data} to C{decomp}, returning C{(output, unconsumed)}."""
+        return decomp.decompress(data), b''
+
+    def split(self, data):
+        """Find independently decodable pieces in C{data}.
+
+        This is a generator so decoding can begin before the whole file has
+        been scanned. (See L{parallel_chunks})
+
+        @param data: The entire compressed file. (Usually an C{mmap})
+        @return: Opaque piece descriptors for L{decode_piece}, in order.
+        @raises ValueError: The data can't be split. (Possibly only
+            discovered after some pieces were yielded)
+        """
+        raise ValueError("%s data can't be split" % self.name)
+        yield  # pragma: no cover
+
+    def decode_piece(self, data, piece):
+        """Decode one piece returned by L{split}, returning its output."""
+        raise NotImplementedError()
+
+class GzipFormat(Format):
+    """gzip (RFC 1952) via C{zlib}
+
+    Only BGZF files (as written by C{bgzip}) can be split for parallel
+    decoding since they're the only gzip variant which records the
+    compressed size of each member."""
+    name, magic = 'gzip', b'\x1f\x8b'
+
+    def new(self):
+        import zlib
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, decomp, data):
+        return decomp.decompress(data, OUTPUT_LIMIT), decomp.unconsumed_tail
+
+    def split(self, data):
+        """Walk BGZF C{BC} extra fields to find member boundaries."""
+        pos, size = 0, len(data)
+        while pos < size:
+            header = data[pos:pos + 12]
+            if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+                raise ValueError("Not BGZF (or trailing garbage)")
+            xlen = struct.unpack('<H', header[10:12])[0]
+            extra, bsize = data[pos + 12:pos + 12 + xlen], None
+            while len(extra) >= 4:
+                slen = struct.unpack('<H', extra[2:4])[0]
+                if extra[:2] == b'BC' and slen == 2:
+                    bsize = struct.unpack('<H', extra[4:6])[0]
+                extra = extra[4 + slen:]
+            if bsize is None:
+                raise ValueError("gzip member without a BGZF size")
+            yield pos, pos + bsize + 1
+            pos += bsize + 1
+
+    def decode_piece(self, data, piece):
+        import zlib
+        return zlib.decompress(data[piece[0]:piece[1]], 16 + zlib.MAX_WBITS)
+
+BZ2_BLOCK_MAGIC = 0x314159265359  #: Start of every bzip2 block (pi)
+BZ2_EOS_MAGIC = 0x177245385090    #: End of every bzip2 stream (sqrt(pi))
+#: Most output one bzip2 block can decode to. (900k of run-length encoded
+#: input where every 5 bytes expand to 259)
+BZ2_BLOCK_OUTPUT = 900000 // 5 * 259
+
+def _bits(data, start, end):
+    """Return bits C{[start, end)} of C{data} (MSB-first) as an integer."""
+    first, last = start // 8, (end + 7) // 8
+    value = int(binascii.hexlify(data[first:last]), 16)
+    return (value >> (last * 8 - end)) & ((1 << (end - start)) - 1)
+
+def _find_bit_pattern(data, magic, bits=48, begin=0, end=None):
+    """Return every bit offset at which the C{bits}-bit C{magic} occurs,
+    starting within bytes C{[begin, end)} of C{data}, in order.
+
+    Each of the eight possible alignments is found with a fast byte search
+    for its fully-determined middle bytes and then verified bit by bit.
+    """
+    end = min(len(data), end is None and len(data) or end)
+    found = []
+    for shift in range(8):
+        shifted = magic << (64 - bits - shift)  # Left-aligned in 8 bytes
+        whole = binascii.unhexlify('%016x' % shifted)
+        lead = shift and 1 or 0
+        needle = whole[lead:(shift + bits) // 8]
+
+        stop = end + lead + len(needle) - 1  # Must start before end+lead
+        pos = data.find(needle, begin + lead, stop)
+        while pos >= 0:
+            start = (pos - lead) * 8 + shift
+            if start >= 0 and start + bits <= len(data) * 8 and \
+                    _bits(data, start, start + bits) == magic:
+                found.append(start)
+            pos = data.find(needle, pos + 1, stop)
+    return sorted(found)
+
+def _iter_bit_pattern(data, magic, bits=48, step=SCAN_SIZE):
+    """Like L{_find_bit_pattern} for the whole of C{data}, but scanning
+    C{step} bytes at a time and yielding offsets as they're found."""
+    for begin in range(0, len(data), step):
+        for offset in _find_bit_pattern(data, magic, bits, begin,
+                                        begin + step):
+            yield offset
+
+class _Bzip2Decompressor(object):
+    """A C{BZ2Decompressor} plus the size of the slice L{Bzip2Format} will
+    feed it next.
+
+    C{BZ2Decompressor} (unlike C{zlib}) can't be told to stop early on
+    Python 2, so output per call is bounded by shrinking the slice instead.
+    Feeding starts at one byte and grows while output stays small since a
+    bomb can pack a whole block into a few dozen bytes.
+
+    @ivar feed: Bytes of input to pass in the next call.
+    @ivar unfed: Input set aside by L{Bzip2Format.decompress} when the
+        stream ended partway through its data.
+    """
+    def __init__(self):
+        import bz2
+        self._decomp = bz2.BZ2Decompressor()
+        self.feed, self.unfed = 1, b''
+
+    def __getattr__(self, name):
+        return getattr(self._decomp, name)
+
+    @property
+    def unused_data(self):
+        """Data following the end-of-stream marker, including any input
+        which L{Bzip2Format.decompress} hadn't fed in yet."""
+        unused = self._decomp.unused_data
+        return unused and unused + self.unfed
+
+    def decompress(self, data):
+        return self._decomp.decompress(data)
+
+class Bzip2Format(Format):
+    """bzip2 via C{bz2}
+
+    Output per L{decompress} call is kept near L{OUTPUT_LIMIT} by feeding
+    input in adaptively-sized slices, but a single block can't be split, so
+    the hard bound is L{BZ2_BLOCK_OUTPUT}.
+
+    Blocks within a bzip2 stream aren't byte-aligned but are delimited by
+    48-bit magic numbers, so L{split} locates them bit by bit and
+    L{decode_piece} re-wraps each one as a standalone single-block stream.
+
+    @note: Block magic can, in theory, occur by chance inside compressed
+        data. (Roughly once per 35,000TB) The resulting pieces fail their
+        CRC check, so L{parallel_chunks} falls back to serial decoding.
+    """
+    name, magic = 'bzip2', b'BZh'
+
+    def new(self):
+        return _Bzip2Decompressor()
+
+    def decompress(self, decomp, data):
+        size = decomp.feed
+        out = decomp.decompress(bytes(data[:size]))
+        rest = _view(data, size, max(0, len(data) - size))
+
+        if len(out) > OUTPUT_LIMIT:  # Aim for OUTPUT_LIMIT on the next call
+            decomp.feed = max(1, size * OUTPUT_LIMIT // len(out))
+        elif len(out) < OUTPUT_LIMIT // 2:
+            decomp.feed = min(FEED_SIZE, size * 2)
+
+        if decomp.unused_data:  # Stream ended. Hand back everything unfed.
+            decomp.unfed = bytes(rest)
+            return out, b''
+        return out, rest
+
+    def split(self, data):
+        """Yield C{(start_bit, end_bit)} for every block in every stream,
+        scanning the file in L{SCAN_SIZE} steps."""
+        if data[:3] != b'BZh':
+            raise ValueError("Not bzip2")
+
+        prev = None
+        for start in _iter_bit_pattern(data, BZ2_BLOCK_MAGIC):
+            if prev is None:
+                if start != 32:
+                    raise ValueError("No block after the stream header")
+            elif not self._starts_stream(data, start):
+                yield prev, start
+            else:  # The previous stream ends 32 bits before this block
+                yield prev, self._end_of_stream(data, prev, start - 32)
+            prev = start
+
+        if prev is None:
+            raise ValueError("No bzip2 blocks found")
+        yield prev, self._end_of_stream(data, prev, len(data) * 8)
+
+    @staticmethod
+    def _starts_stream(data, start):
+        """Return whether the block at bit C{start} directly follows the
+        byte-aligned "BZh1"-"BZh9" header of a new stream."""
+        return (start % 8 == 0 and start >= 32 and
+                data[start // 8 - 4:start // 8 - 1] == b'BZh')
+
+    @staticmethod
+    def _end_of_stream(data, start, stream_end):
+        """Return the bit offset of the end-of-stream marker terminating the
+        last block (at bit C{start}) of a stream which ends at bit
+        C{stream_end}. (The marker is followed by a 32-bit CRC and 0-7 bits
+        of padding)
+
+        @raises ValueError: Trailing garbage or an unexpected layout.
+        """
+        for pad in range(8):
+            eos = stream_end - pad - 80
+            if eos > start and _bits(data, eos, eos + 48) == BZ2_EOS_MAGIC:
+                return eos
+        raise ValueError("No bzip2 end-of-stream marker found")
+
+    def decode_piece(self, data, piece):
+        import bz2
+        start, end = piece
+        crc = _bits(data, start + 48, start + 80)
+        total = end - start + 80
+        pad = -total % 8
+        value = (((_bits(data, start, end) << 48) | BZ2_EOS_MAGIC) << 32) | crc
+        stream = b'BZh9' + binascii.unhexlify(
+            '%0*x' % ((total + pad) // 4, value << pad))
+        return bz2.decompress(stream)
+
+GZIP, BZIP2 = GzipFormat(), Bzip2Format()
+
+#}
+#{ Decoding
+
+class StreamStats(object):
+    """Byte counts and timing for a decompression run.
+
+    @ivar bytes_in: Compressed bytes consumed.
+    @ivar bytes_out: Decompressed bytes produced.
+    @ivar members: Number of gzip members/bzip2 streams decoded.
+    @ivar seconds: Wall-clock time spent inside the decoder (including time
+        the consumer spent processing each chunk).
+    """
+    def __init__(self):
+        self.bytes_in = self.bytes_out = self.members = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        """Decompressed output in bytes per second (0 if unmeasured)"""
+        return self.seconds and self.bytes_out / self.seconds or 0
+
+    def __repr__(self):
+        return "<%s %d -> %d bytes, %d member(s), %.1f MiB/s>" % (
+            self.__class__.__name__, self.bytes_in, self.bytes_out,
+            self.members, self.throughput / (1 << 20))
+
+def _finished(decomp):
+    """Return C{True} if C{decomp} has seen its end-of-stream marker."""
+    eof = getattr(decomp, 'eof', None)  # Python 3.3+
+    if eof is not None:
+        return eof
+    if decomp.unused_data:
+        return True
+    try:  # Probe with a byte that an ended stream will refuse or set aside
+        decomp.decompress(b'\0')
+    except EOFError:  # bz2 raises once the stream has ended
+        return True
+    except Exception:  # Corrupt data error means it was still expecting more
+        return False
+    return bool(decomp.unused_data)
+
+def iter_decompress(fileobj, fmt, stats=None, read_size=READ_SIZE):
+    """Decompress C{fileobj} incrementally, yielding chunks of output.
+
+    @param fileobj: A binary file-like object. (Need not be seekable)
+    @param fmt: The L{Format} of the data. (eg. L{GZIP} or L{BZIP2})
+    @param stats: If provided, a L{StreamStats} to update as data flows.
+
+    @raises EOFError: The input ended in the middle of a member.
+    @raises IOError: The input is corrupt. (Raised by C{zlib} or C{bz2})
+    """
+    stats = stats or StreamStats()
+    buf = bytearray(read_size)
+    readinto = getattr(fileobj, 'readinto', None)
+    magic = fmt.magic
+
+    decomp, fed, carry = fmt.new(), False, b''
+    started = time.time()
+    try:
+        while True:
+            if readinto:
+                count = readinto(buf)
+            else:
+                data = fileobj.read(read_size)
+                count = len(data)
+                buf[:count] = data
+            if not count:
+                break
+            stats.bytes_in += count
+
+            for offset in range(0, count, FEED_SIZE):
+                data = _view(buf, offset, min(FEED_SIZE, count - offset))
+                if carry:
+                    data, carry = carry + bytes(data), b''
+
+                while data:
+                    if not fed:
+                        if bytes(data[:len(magic)]) != magic:
+                            if len(data) < len(magic):
+                                carry = bytes(data)  # Split magic number?
+                                break
+                            return  # Trailing garbage (eg. tar padding)
+                        stats.members += 1
+
+                    try:
+                        out, data = fmt.decompress(decomp, data)
+                        fed = True
+                    except EOFError:  # bz2 refuses data past end-of-stream
+                        leftover = data
+                    else:
+                        leftover = decomp.unused_data
+                        if out:
+                            stats.bytes_out += len(out)
+                            stats.seconds = time.time() - started
+                            yield out
+
+                    if leftover:  # This member ended. Start the next one.
+                        decomp, fed, data = fmt.new(), False, leftover
+
+        if fed and not _finished(decomp):
+            raise EOFError("Compressed %s data ended before the "
+                           "end-of-stream marker was reached" % fmt.name)
+    finally:
+        stats.seconds = time.time() - started
+
+#}
+#{ File-like Interfaces
+
+class DecompressingReader(object):
+    """A read-only, non-seekable file-like wrapper around L{iter_decompress}
+    suitable for C{tarfile}'s stream mode or for copying to disk.
+
+    @ivar stats: The L{StreamStats} for this stream.
+    """
+    def __init__(self, fileobj, fmt, chunks=None, stats=None):
+        """
+        @param fileobj: The compressed input.
+        @param fmt: The L{Format} of the data.
+        @param chunks: An alternative iterator of decompressed chunks to wrap
+            instead of L{iter_decompress}. (eg. from L{parallel_chunks})
+        @param stats: The L{StreamStats} C{chunks} reports to, if any.
+        """
+        self.stats = stats or StreamStats()
+        self._chunks = chunks or iter_decompress(fileobj, fmt, self.stats)
+        self._pending, self._pos = b'', 0
+
+    def _fill(self):
+        """Fetch the next chunk. Returns C{False} at end of stream."""
+        for chunk in self._chunks:
+            self._pending, self._pos = chunk, 0
+            return True
+        return False
+
+    def peek(self, size):
+        """Return up to C{size} bytes without consuming them."""
+        while len(self._pending) - self._pos < size:
+            rest = self._pending[self._pos:]
+            if not self._fill():
+                self._pending, self._pos = rest, 0
+                break
+            self._pending = rest + self._pending
+        return self._pending[self._pos:self._pos + size]
+
+    def read(self, size=-1):
+        """Read up to C{size} bytes. (All remaining data if negative)"""
+        if size is None or size < 0:
+            parts = [self._pending[self._pos:]]
+            parts.extend(self._chunks)
+            self._pending, self._pos = b'', 0
+            return b''.join(parts)
+
+        parts, wanted = [], size
+        while wanted:
+            if self._pos >= len(self._pending) and not self._fill():
+                break
+            part = self._pending[self._pos:self._pos + wanted]
+            self._pos += len(part)
+            wanted -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+    def copy_to(self, fileobj):
+        """Write all remaining data to C{fileobj} without re-buffering it.
+
+        @return: The number of bytes written.
+        """
+        written = len(self._pending) - self._pos
+        fileobj.write(self._pending[self._pos:])
+        self._pending, self._pos = b'', 0
+        for chunk in self._chunks:
+            fileobj.write(chunk)  # Blocks (and so throttles) if disk is slow
+            written += len(chunk)
+        return written
+
+#}
+#{ Parallel Decoding
+
+def default_threads():
+    """Return the default number of decoder threads. (One per CPU)"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _ordered_map(func, items, threads):
+    """Like C{ThreadPool.imap} but with at most C{2 * threads} results held
+    in memory at once, so output order is kept without unbounded buffering.
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    try:
+        pending, items = [], iter(items)
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= threads * 2:
+                yield pending.pop(0).get()
+        while pending:
+            yield pending.pop(0).get()
+    finally:
+        pool.terminate()
+
+def parallel_chunks(path, fmt, threads=None, stats=None):
+    """Decode C{path} on a thread pool, yielding output in order.
+
+    @param path: The compressed file. (Must be a regular, mappable file)
+    @param fmt: The L{Format} of the data.
+    @param threads: The pool size. Defaults to L{default_threads}.
+    @param stats: If provided, a L{StreamStats} to update as data flows.
+
+    @return: An iterator of decompressed chunks or C{None} if parallel
+        decoding isn't possible or worthwhile for this file. (In which case
+        the caller should fall back to L{iter_decompress})
+    @raises IOError: The file is corrupt.
+
+    @note: If a piece fails to decode (eg. because L{Format.split} was
+        fooled by a false positive bzip2 block magic), decoding restarts
+        serially and skips the output already produced, so such a file is
+        only an error if it's genuinely corrupt.
+    """
+    import itertools
+    threads = threads or default_threads()
+    if threads < 2:
+        return None
+
+    with open(path, 'rb') as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        if not size:
+            return None
+        data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Only the first two pieces are needed to decide. The rest are found as
+    # decoding proceeds.
+    pieces = fmt.split(data)
+    try:
+        first = list(itertools.islice(pieces, 2))
+    except ValueError:
+        first = []
+    if len(first) < 2:
+        data.close()
+        return None
+    pieces = itertools.chain(first, pieces)
+
+    stats = stats or StreamStats()
+    stats.bytes_in = size
+
+    def generate():
+        """Decode and yield each piece while holding the mapping open."""
+        started = time.time()
+        try:
+            try:
+                for out in _ordered_map(lambda x: fmt.decode_piece(data, x),
+                                        pieces, threads):
+                    stats.bytes_out += len(out)
+                    stats.members += 1
+                    stats.seconds = time.time() - started
+                    yield out
+                return
+            except Exception:  # Bad piece or split. (See the @note)
+                pass
+
+            skip = stats.bytes_out
+            with open(path, 'rb') as fobj:
+                for out in iter_decompress(fobj, fmt):
+                    if skip:
+                        out, skip = out[skip:], max(0, skip - len(out))
+                        if not out:
+                            continue
+                    stats.bytes_out += len(out)
+                    stats.seconds = time.time() - started
+                    yield out
+        finally:
+            stats.seconds = time.time() - started
+            data.close()
+    return generate()
+
+#}
@@ -0,0 +1,165 @@
+"""Post-extraction deduplication of byte-identical files within an output
+tree, for archives (mod packs, firmware bundles, etc.) which contain many
+copies of the same file.
+
+Files are grouped by size first so only files which share a size are read,
+then by a hash of their first L{HEAD_SIZE} bytes, and only files which still
+collide are hashed in full. Duplicates are replaced by reflinks where the
+filesystem supports them and, optionally, hardlinks.
+
+To bound memory use on trees with millions of entries, candidates are
+gathered in passes which each only consider the files whose sizes fall into
+one partition, so no more than about L{BATCH_SIZE} paths are held at once.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import errno, hashlib, os, shutil
+from stat import S_ISDIR, S_ISREG
+
+from .util import _FICLONE, _UNSUPPORTED, _lstat_entries, _reflink
+
+BATCH_SIZE = 100000     #: Approximate number of candidate paths held at once
+HEAD_SIZE = 64 * 1024   #: Bytes hashed to cheaply split same-size groups
+HASH_BLOCK = 1024 * 1024
+
+class Deduplicator(object):
+    """Replaces byte-identical files in a tree with links to one copy.
+
+    Only regular, non-empty files which aren't already hardlinked
+    elsewhere (C{st_nlink == 1}) are considered, since replacing one name of
+    a multiply-linked file frees nothing.
+
+    @param hardlinks: Hardlink duplicates when reflinks aren't supported.
+        Hardlinks are only made between files with identical modes and the
+        surviving copy's timestamps apply to every name.
+    @param batch: See L{BATCH_SIZE}.
+
+    @note: Hardlinked files share an inode, so editing one in place (rather
+        than replacing it) alters every copy. Leave C{hardlinks} off unless
+        outputs are treated as read-only.
+    """
+    def __init__(self, hardlinks=False, batch=BATCH_SIZE):
+        self.hardlinks = hardlinks
+        self.batch = batch
+        self.reflinks = bool(_FICLONE)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.hardlinks)
+
+    def __call__(self, root):
+        """Deduplicate the tree under C{root}.
+
+        @return: C{(files_replaced, bytes_saved)}
+        """
+        count = sum(1 for _ in _walk(root))
+        partitions = max(1, -(-count // self.batch))
+
+        replaced = saved = 0
+        for partition in range(partitions):
+            by_size = {}
+            for path, st in _walk(root):
+                if st.st_size % partitions == partition:
+                    by_size.setdefault(st.st_size, []).append((path, st))
+
+            for size, group in by_size.items():
+                if len(group) < 2:
+                    continue
+                groups = self._split(group, HEAD_SIZE)
+                if size > HEAD_SIZE:
+                    groups = [y for x in groups for y in self._split(x)]
+                for dupes in groups:
+                    for duplicate in dupes[1:]:
+                        if self.link(dupes[0], duplicate):
+                            replaced += 1
+                            saved += size
+        return replaced, saved
+
+    @staticmethod
+    def _split(group, limit=None):
+        """Partition C{group} into lists of 2+ files with matching hashes
+        of their first C{limit} bytes (or all of their contents)."""
+        by_digest = {}
+        for path, st in group:
+            try:
+                digest = _hash(path, limit)
+            except (IOError, OSError):
+                continue  # Not worth failing the extraction over
+            by_digest.setdefault(digest, []).append((path, st))
+        return [x for x in by_digest.values() if len(x) > 1]
+
+    def link(self, original, duplicate):
+        """Replace C{duplicate} with a link to C{original}.
+
+        @param original: A C{(path, lstat_result)} tuple.
+        @param duplicate: A C{(path, lstat_result)} tuple.
+        @return: C{True} if the duplicate was replaced.
+        """
+        (src, src_st), (dst, dst_st) = original, duplicate
+        parent, name = os.path.split(dst)
+        tmp = os.path.join(parent, '.%s.unball-dedup' % name)
+
+        if self.reflinks:
+            try:
+                _clone(src, tmp)
+                shutil.copystat(dst, tmp)
+                os.rename(tmp, dst)
+                return True
+            except (IOError, OSError) as err:
+                _remove(tmp)
+                if err.errno not in _UNSUPPORTED:
+                    return False
+                self.reflinks = False  # Don't retry for every file
+
+        if self.hardlinks and src_st.st_mode == dst_st.st_mode:
+            try:
+                os.link(src, tmp)
+                os.rename(tmp, dst)
+                return True
+            except OSError:
+                _remove(tmp)
+        return False
+
+def _walk(root):
+    """Yield C{(path, lstat_result)} for every deduplication candidate."""
+    pending = [root]
+    while pending:
+        parent = pending.pop()
+        for name, st in _lstat_entries(parent):
+            path = os.path.join(parent, name)
+            if S_ISDIR(st.st_mode):
+                pending.append(path)
+            elif S_ISREG(st.st_mode) and st.st_size and st.st_nlink == 1:
+                yield path, st
+
+def _hash(path, limit=None):
+    """Return the SHA-1 of the first C{limit} bytes of C{path} (or all of
+    it)."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fobj:
+        if limit:
+            digest.update(fobj.read(limit))
+        else:
+            for block in iter(lambda: fobj.read(HASH_BLOCK), b''):
+                digest.update(block)
+    return digest.digest()
+
+def _clone(src, dst):
+    """Create C{dst} as a reflink of C{src}."""
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            _reflink(src_fd, dst_fd, 0)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
@@ -9,9 +9,18 @@
 __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2.0 or later"
 
-import os, subprocess
+import errno, hashlib, json, os, struct, subprocess, sys, tempfile
+from fnmatch import fnmatchcase
 
-from .util import BinYes, UnballError, which
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2.x
+    from collections import Mapping
+from stat import S_IMODE, S_IRUSR, S_IWUSR, S_IXUSR
+
+from .mimetypes import findPayloads, isTarHeader
+from .util import (BinYes, CHILDREN, PATH_INDEX, UnballError, cache_dir,
+                   check_staging, normalize_permissions, which)
 
 #{ Exceptions
 
@@ -21,6 +30,129 @@ class UnsupportedFiletypeError(UnballError):
 class NoExtractorError(UnsupportedFiletypeError):
     """Raised when a mimetype is supported but no viable extractor was found"""
 
+#}
+#{ Member Selection
+
+class MemberFilter(object):
+    """Selects which archive members to extract by glob pattern.
+
+    Patterns are matched case-sensitively against each file's path within
+    the archive, using C{/} as the separator and without any leading C{./}.
+    As with C{unzip} and C{tar --wildcards}, C{*} also matches C{/}, so
+    C{*.xml} selects XML files at any depth.
+
+    A file is extracted if it matches at least one C{include} pattern (or
+    there are none) and no C{exclude} pattern. Directories left empty are
+    removed.
+
+    @param include: Patterns for the files to extract.
+    @param exclude: Patterns for files to skip.
+    """
+    def __init__(self, include=(), exclude=()):
+        self.include, self.exclude = tuple(include), tuple(exclude)
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.include,
+                               self.exclude)
+
+    def __nonzero__(self):
+        return bool(self.include or self.exclude)
+    __bool__ = __nonzero__  # Python 3.x
+
+    def __call__(self, name):
+        """Return C{True} if the member C{name} should be extracted."""
+        name = name.replace(os.sep, '/')
+        while name.startswith('./'):
+            name = name[2:]
+        name = name.lstrip('/')
+        return ((not self.include or
+                 any(fnmatchcase(name, x) for x in self.include)) and
+                not any(fnmatchcase(name, x) for x in self.exclude))
+
+    def args(self, command):
+        """Return the arguments which make the tool C{command} apply as much
+        of this filter as its own syntax can express. (See L{NATIVE_FILTERS})
+
+        @return: C{(before_archive, after_archive, ok_returncodes)}
+        """
+        native = NATIVE_FILTERS.get(os.path.basename(command))
+        if not native:
+            return [], [], ()
+        return native(self.include, self.exclude)
+
+    def prune(self, root):
+        """Enforce this filter on an already-extracted tree, for tools which
+        couldn't apply it (fully) themselves.
+
+        @return: The number of files removed.
+        """
+        removed = 0
+        for parent, dirs, files in os.walk(root, topdown=False):
+            rel_parent = os.path.relpath(parent, root)
+            for name in files + [x for x in dirs
+                                 if os.path.islink(os.path.join(parent, x))]:
+                if not self(os.path.join(rel_parent, name)):
+                    _unlink(os.remove, os.path.join(parent, name))
+                    removed += 1
+            if parent != root and not os.listdir(parent):
+                _unlink(os.rmdir, parent)
+        return removed
+
+def _unlink(remove, path):
+    """Call C{remove(path)}, temporarily making the parent directory
+    writable if the archive stored it read-only."""
+    try:
+        remove(path)
+    except OSError as err:
+        if err.errno not in (errno.EACCES, errno.EPERM):
+            raise
+        parent = os.path.dirname(path)
+        mode = S_IMODE(os.stat(parent).st_mode)
+        os.chmod(parent, mode | S_IWUSR)
+        try:
+            remove(path)
+        finally:
+            os.chmod(parent, mode)
+
+def strip_prefix(name, prefix):
+    """Return the member C{name} relative to the top-level directory
+    C{prefix}, C{''} for C{prefix} itself, or C{None} if it's outside it.
+    (Trailing slashes on directory names are kept)"""
+    parts = [x for x in name.replace(os.sep, '/').split('/')
+             if x not in ('', '.')]
+    if not parts or parts[0] != prefix:
+        return None
+    rest = '/'.join(parts[1:])
+    return rest and name.endswith('/') and rest + '/' or rest
+
+def _7z_filter(include, exclude):
+    return (['-ir!' + x for x in include] + ['-xr!' + x for x in exclude],
+            [], ())
+
+def _rar_filter(include, exclude):
+    # 10 means no files matched, which an empty target reports better
+    return ['-x' + x for x in exclude], list(include), (10,)
+
+def _unzip_filter(include, exclude):
+    # 11 means some pattern matched nothing, which isn't an error here
+    after = list(include) + (exclude and ['-x'] + list(exclude) or [])
+    return [], after, (11,)
+
+def _tar_filter(include, exclude):
+    # GNU tar fails on include patterns which match nothing, so only
+    # exclusions are passed and inclusion is left to MemberFilter.prune
+    after = ['--exclude=' + x for x in exclude]
+    return [], after and ['--anchored', '--wildcards'] + after, ()
+
+#: How each tool (by executable name) is told to apply a L{MemberFilter}
+#: itself, as functions returning the same values as L{MemberFilter.args}.
+NATIVE_FILTERS = {
+    '7z': _7z_filter, '7za': _7z_filter, '7zr': _7z_filter,
+    'rar': _rar_filter, 'unrar': _rar_filter,
+    'unzip': _unzip_filter,
+    'tar': _tar_filter,
+}
+
 #}
 #{ Generic Classes
 
@@ -28,6 +160,15 @@ class Extractor(object):
     """A generic wrapper for calling external extractor tools which behave
     in a reasonably sane manner and don't attempt to delete the source file on
     success."""
+    normalizes_permissions = False
+    """C{True} if the extractor itself guarantees that everything it creates
+    is readable (and directories traversable) by the owner, making the
+    post-extraction L{normalize_permissions} pass unnecessary."""
+    strips_prefix = False
+    """C{True} if C{__call__} accepts a C{prefix} argument naming the
+    archive's single top-level directory, whose contents it then extracts
+    straight into C{target}. (See L{strip_prefix})"""
+
     def __init__(self, *base_args):
         """Store the provided commandline for extracting archives."""
         self._args = list(base_args)
@@ -36,15 +177,17 @@ class Extractor(object):
         return "<%s(%s)>" % (self.__class__.__name__,
                 ', '.join(repr(x) for x in getattr(self, '_args', [])))
 
-    def __call__(self, path, target):
+    def __call__(self, path, target, member_filter=None):
         """Use the command provided in the constructor to extract the given
         archive to the given destination directory.
 
         @param path: The archive to be extracted.
         @param target: The directory into which the extracted files should be
         placed.
+        @param member_filter: If given, only extract the members it selects.
         @type path: C{str}
         @type target: C{str}
+        @type member_filter: L{MemberFilter}
         """
 
         if False:  # --verbose test goes here
@@ -57,10 +200,22 @@ class Extractor(object):
         # Can't redirect on Windows if the FDs are closed.
         _fds = (os.name != 'nt')
 
+        before, after, ok = [], [], ()
+        if member_filter:
+            before, after, ok = member_filter.args(self._args[0])
+
         # (The cwd= of this was the other major portion of the shell script)
-        subprocess.check_call(self._args + [path], stdin=BinYes,
-                    stdout=_out, stderr=_err, close_fds=_fds,
-                    cwd=target, universal_newlines=True)
+        try:
+            CHILDREN.check_call(self._args + before + [path] + after,
+                        owner=target, stdin=BinYes, stdout=_out,
+                        stderr=_err, close_fds=_fds, cwd=target,
+                        universal_newlines=True)
+        except subprocess.CalledProcessError as err:
+            if err.returncode not in ok:
+                raise
+
+        if member_filter:
+            member_filter.prune(target)
 
     def isViable(self):
         """Check to see if the extractor binary can be found in the PATH."""
@@ -101,13 +256,15 @@ class NamedOutputExtractor(Extractor):
         self.target_ext = target_ext
         self.outfile_option = outfile_option
 
-    def __call__(self, path, target):
+    def __call__(self, path, target, member_filter=None):
         """Use the command provided in the constructor to extract the given
         archive to the given destination directory.
 
         @param path: The archive to be extracted.
         @param target: The directory into which the extracted files should be
         placed.
+        @param member_filter: Ignored. A single output file has no members
+            to select from.
         @type path: C{str}
         @type target: C{str}
         """
@@ -135,7 +292,7 @@ class NamedOutputExtractor(Extractor):
             args.append(_outname)
 
         # (The cwd= of this was the other major portion of the shell script)
-        subprocess.check_call(self._args + args, stdin=BinYes,
+        CHILDREN.check_call(self._args + args, owner=target, stdin=BinYes,
                     stdout=_out, stderr=_err, close_fds=_fds,
                     cwd=target, universal_newlines=True)
 
@@ -173,15 +330,17 @@ class PipeExtractor(NamedOutputExtractor):
     """A wrapper class for extractors which delete the source file on success
     unless asked to pipe the output to stdout.
 
+    If the decompressed data turns out to be a tar archive, it is streamed
+    straight into a tar extractor rather than being written out as an
+    intermediate C{.tar} file for L{tryExtract} to recurse into.
+
     @note: C{outfile_option} is ignored.
     """
     CHUNK_SIZE = 4096  #: Provided for subclasses which do their own C{read}ing
+    TAR_BLOCK = 512    #: How much decompressed output to sniff for tar
 
-    def __call__(self, path, target):
-        target_path = self._make_target_filename(path, target, self.src_ext,
-                                                 self.target_ext)
-        _out = open(target_path, 'wb')
-
+    def __call__(self, path, target, member_filter=None):
+        """@param member_filter: Only applies to tarballs."""
         if False:  # --verbose test goes here
             _err = None
         else:
@@ -191,33 +350,230 @@ class PipeExtractor(NamedOutputExtractor):
         _fds = (os.name != 'nt')
 
         # (The cwd= of this was the other major portion of the shell script)
-        subprocess.check_call(self._args, stdin=open(path, 'rb'),
-                    stdout=_out, stderr=_err, close_fds=_fds, cwd=target,
-                    universal_newlines=False)
+        decompressor = CHILDREN.popen(self._args, owner=target,
+                    stdin=open(path, 'rb'), stdout=subprocess.PIPE,
+                    stderr=_err, close_fds=_fds, cwd=target)
+        try:
+            # Sniff the output as it goes by rather than decompressing the
+            # start of the file a second time just to peek at it.
+            head = decompressor.stdout.read(self.TAR_BLOCK)
+            stream = _Prepended(head, decompressor.stdout)
+            if isTarHeader(head):
+                self._untar(stream, target, member_filter)
+            else:
+                target_path = self._make_target_filename(path, target,
+                        self.src_ext, self.target_ext)
+                with open(target_path, 'wb') as out_handle:
+                    _copy_stream(stream, _StagingWriter(out_handle, target))
+
+            # tar stops at its end-of-archive marker. Drain any padding so
+            # the decompressor doesn't fail with EPIPE.
+            while decompressor.stdout.read(self.CHUNK_SIZE):
+                pass
+        finally:
+            decompressor.stdout.close()
+            retcode = decompressor.wait()
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, self._args)
+
+    def _untar(self, fileobj, target, member_filter=None):
+        """Stream the decompressed tarball read from C{fileobj} straight into
+        the preferred tar extractor without touching the disk in between.
+
+        @raises CalledProcessError: An external tar failed.
+        """
+        untar = mimeToExtractor('application/x-tar')[0]
+        if isinstance(untar, TarExtractor):
+            untar.extract_fileobj(fileobj, target, member_filter)
+            return
+
+        _err = open(os.devnull, 'w')
+        after = member_filter and member_filter.args('tar')[1] or []
+        proc = CHILDREN.popen(untar._args + ['-'] + after, owner=target,
+                    stdin=subprocess.PIPE, stdout=_err, stderr=_err,
+                    close_fds=(os.name != 'nt'), cwd=target)
+        try:
+            _copy_stream(fileobj, proc.stdin)
+        except IOError as err:
+            if err.errno != errno.EPIPE:
+                raise  # Otherwise, tar quit early and its status says why
+        finally:
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass  # The same EPIPE, while flushing
+            retcode = proc.wait()
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, untar._args)
+
+        if member_filter:
+            member_filter.prune(target)
+        if self.normalizes_permissions:  # External tar keeps stored modes
+            normalize_permissions(target)
+
+class _Prepended(object):
+    """A read-only file-like object which replays C{head} before reading on
+    from C{fileobj}. (ie. Un-reads what was consumed for sniffing)"""
+    def __init__(self, head, fileobj):
+        self.head, self.fileobj = head, fileobj
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fileobj.read(size)
+        elif size is None or size < 0:
+            data, self.head = self.head + self.fileobj.read(), b''
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+def _copy_stream(src, dst, chunk_size=64 * 1024):
+    """Copy everything readable from C{src} into C{dst} in bounded chunks.
+    """
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
 
 #}
 #{ Specific Extractor Classes (Python stdlib)
 
 class ZipExtractor(Extractor):
     """An internal fallback extractor for zip archives.
-    Only understands the most common subset of zip file types."""
-    def __init__(self):
-        """no-op"""
-    def __call__(self, path, target):
+    Only understands the most common subset of zip file types.
+
+    Members are inflated on a thread pool (zlib releases the GIL) with each
+    worker reading through its own C{ZipFile} handle."""
+    normalizes_permissions = True  # zipfile ignores stored permissions
+    strips_prefix = True
+    CHUNK_SIZE = 64 * 1024  #: Bounds per-member memory use while inflating
+    PARALLEL_MIN_BYTES = 1024 * 1024  #: Smaller archives aren't worth a pool
+
+    def __init__(self, threads=None):
+        """
+        @param threads: Size of the inflater thread pool. (Default: one per
+            CPU)
+        """
+        self.threads = threads
+
+    def __repr__(self):
+        return "<%s(%r)>" % (self.__class__.__name__, self.threads)
+
+    def __call__(self, path, target, member_filter=None, prefix=None):
         """Extract C{path} into C{target} using the C{zipfile} module.
 
+        Only the members selected by C{member_filter} (if given) are read.
+
         @note: No need to use C{zipfile.is_zipfile} because we want an
         exception on failure anyway.
 
         @todo: Write a fallback implementation.
-        C{ZipFile.extractall} was added in Python 2.6
+        C{ZipFile.open} was added in Python 2.6
         """
         import zipfile
-        if getattr(zipfile.ZipFile, 'extractall', None):
-            zipfile.ZipFile(path, 'r').extractall(target)
-        else:
+        if not getattr(zipfile.ZipFile, 'open', None):
             raise NotImplementedError("Fallback zip extraction currently " +
-                    "requires Python 2.6 or higher for ZipFile.extractall")
+                    "requires Python 2.6 or higher for ZipFile.open")
+
+        archive = zipfile.ZipFile(path, 'r')
+        try:
+            files = self._plan(archive.infolist(), target, member_filter,
+                               prefix)
+            threads = self.threads
+            if threads is None:
+                from .decompress import default_threads
+                threads = default_threads()
+
+            if (threads < 2 or len(files) < 2 or sum(x[0].compress_size
+                    for x in files) < self.PARALLEL_MIN_BYTES):
+                for info, dest in files:
+                    self._extract_member(archive, info, dest, target)
+            else:
+                self._extract_parallel(path, files, threads, target)
+        finally:
+            archive.close()
+
+    def _extract_parallel(self, path, files, threads, target):
+        """Inflate C{files} on a pool of C{threads} workers, each with its
+        own C{ZipFile} so no seek position is shared between threads."""
+        import threading, zipfile
+        from multiprocessing.pool import ThreadPool
+        local, handles = threading.local(), []
+
+        def work(job):
+            archive = getattr(local, 'archive', None)
+            if archive is None:
+                archive = local.archive = zipfile.ZipFile(path, 'r')
+                handles.append(archive)
+            self._extract_member(archive, job[0], job[1], target)
+
+        # Largest first so one huge member doesn't become the long tail
+        files = sorted(files, key=lambda x: x[0].file_size, reverse=True)
+        pool = ThreadPool(threads)
+        try:
+            for _ in pool.imap_unordered(work, files):
+                pass
+        finally:
+            pool.terminate()
+            for archive in handles:
+                archive.close()
+
+    @staticmethod
+    def _member_path(target, name):
+        """Map a member name to a path inside C{target} the way
+        C{ZipFile.extractall} does. (Drive letters, C{.}, and C{..} dropped)
+
+        @return: The destination path or C{None} if nothing would remain.
+        """
+        name = name.replace('/', os.sep)
+        if os.altsep:
+            name = name.replace(os.altsep, os.sep)
+        name = os.path.splitdrive(name)[1]
+        parts = [x for x in name.split(os.sep)
+                 if x not in ('', os.curdir, os.pardir)]
+        return parts and os.path.normpath(os.path.join(target, *parts)) or None
+
+    def _plan(self, infos, target, member_filter=None, prefix=None):
+        """Create every directory the archive needs up front (so workers
+        never race on C{makedirs}) and return C{(info, dest)} pairs for the
+        file members selected by C{member_filter}."""
+        dirs, files = set(), []
+        for info in infos:
+            name = info.filename
+            if prefix:
+                name = strip_prefix(name, prefix)
+                if not name:
+                    continue  # The top-level directory itself (or outside)
+            dest = self._member_path(target, name)
+            if dest is None:
+                continue
+            if info.filename.endswith('/'):
+                if not member_filter:  # Otherwise, only create what's used
+                    dirs.add(dest)
+            elif member_filter and not member_filter(info.filename):
+                continue
+            else:
+                dirs.add(os.path.dirname(dest))
+                files.append((info, dest))
+
+        for path in sorted(dirs):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        return files
+
+    def _extract_member(self, archive, info, dest, target):
+        """Stream one member to C{dest} in bounded C{CHUNK_SIZE} pieces."""
+        source = archive.open(info)
+        try:
+            with open(dest, 'wb') as out:
+                while True:
+                    block = source.read(self.CHUNK_SIZE)
+                    if not block:
+                        break
+                    check_staging(target, len(block))
+                    out.write(block)
+        finally:
+            source.close()
 
     def isViable(self):
         """Check to see if Python stdlib was built with zipfile support."""
@@ -232,17 +588,138 @@ class TarExtractor(Extractor):
     """An internal fallback extractor for tar archives.
     Probably doesn't understand everything GNU Tar can but it does
     transparently support gzip and bzip2 compression if Python stdlib does."""
+    normalizes_permissions = True  # See _fix_modes()
+    strips_prefix = True
+
     def __init__(self):
         """no-op"""
         pass
 
-    def __call__(self, path, target):
-        """Extract C{path} into C{target} using the C{zipfile} module.
+    def __call__(self, path, target, member_filter=None, prefix=None):
+        """Extract C{path} into C{target} using the C{tarfile} module.
 
         @note: No need to use C{tarfile.is_tarfile} because we want an
         exception on failure anyway."""
         import tarfile
-        tarfile.open(path, 'r').extractall(target)
+        tar = tarfile.open(path, 'r|*')
+        try:
+            self._extract_stream(tar, target, member_filter, prefix)
+        finally:
+            tar.close()
+
+    def extract_fileobj(self, fileobj, target, member_filter=None,
+                        prefix=None):
+        """Extract a tar archive from a (possibly non-seekable) file-like
+        object such as a decompressor's output pipe."""
+        import tarfile
+        self._extract_stream(tarfile.open(fileobj=fileobj, mode='r|'),
+                             target, member_filter, prefix)
+
+    def _extract_stream(self, tar, target, member_filter=None, prefix=None):
+        """Extract a stream-mode C{TarFile} in a single forward pass.
+
+        Unlike C{extractall}, this doesn't accumulate a C{TarInfo} for every
+        member, so memory use doesn't grow with the number of files. Only
+        directory metadata is kept, since it has to be applied after the
+        directory's contents are written.
+
+        Members rejected by C{member_filter} are skipped over without being
+        written. (Their data is still read, since the stream can't seek)
+        """
+        import tarfile
+        directories = []
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+            tar.members = []  # Stream mode still records every member
+            check_staging(target)
+            if (member_filter and not member.isdir() and
+                    not member_filter(member.name)):
+                continue
+            if prefix:
+                name = strip_prefix(member.name, prefix)
+                if name is None:
+                    continue
+                member.name = name.rstrip('/')
+                if member.islnk():
+                    member.linkname = (strip_prefix(member.linkname, prefix)
+                                       or member.linkname)
+            member = next(self._fix_modes([member]))
+
+            if member.isdir():
+                # Keep only what's needed to restore the metadata later
+                deferred = tarfile.TarInfo(member.name)
+                for attr in ('mode', 'mtime', 'uid', 'gid', 'uname',
+                             'gname'):
+                    setattr(deferred, attr, getattr(member, attr))
+                deferred.type = tarfile.DIRTYPE
+                directories.append(deferred)
+                member.mode = 0o700
+                if not member.name:
+                    continue  # The stripped prefix. ie. target itself
+            elif member.islnk():
+                self._extract_hardlink(member, target)
+                continue
+            check_staging(target, member.isfile() and member.size or 0)
+            tar.extract(member, target)
+
+        # Deepest first so setting a parent's mtime/mode comes last
+        directories.sort(key=lambda x: x.name, reverse=True)
+        for deferred in directories:
+            dirpath = os.path.join(target, deferred.name)
+            try:
+                if sys.version_info[0] < 3:
+                    tar.chown(deferred, dirpath)
+                else:
+                    tar.chown(deferred, dirpath, False)
+                tar.utime(deferred, dirpath)
+                tar.chmod(deferred, dirpath)
+            except tarfile.ExtractError:
+                pass  # Same leniency as extractall's default errorlevel
+
+        if member_filter:
+            member_filter.prune(target)  # Directories nothing was put in
+
+    @staticmethod
+    def _extract_hardlink(member, target):
+        """Link (or, failing that, copy) a hardlink member's already
+        extracted target into place.
+
+        C{tarfile}'s own fallback looks the target up in C{TarFile.members},
+        which L{_extract_stream} doesn't keep, and a stream can't seek back
+        to its data anyway. Links to files which weren't extracted (eg.
+        rejected by the member filter) are skipped instead.
+        """
+        parts = member.linkname.replace('\\', '/').split('/')
+        source = os.path.join(target, *parts)
+        dest = os.path.join(target, member.name)
+        if (os.path.isabs(member.linkname) or '..' in parts or
+                os.path.islink(source) or not os.path.isfile(source)):
+            return
+
+        parent = os.path.dirname(dest)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        try:
+            os.link(source, dest)
+        except OSError:  # eg. A filesystem without hardlinks
+            import shutil
+            shutil.copy2(source, dest)
+
+    @staticmethod
+    def _fix_modes(members):
+        """Add owner read (and directory search) bits to each member's stored
+        mode as it's extracted so no separate permission-fixing pass is
+        needed afterwards."""
+        for member in members:
+            if member.isdir():
+                member.mode |= S_IRUSR | S_IXUSR
+            elif not member.issym():
+                member.mode |= S_IRUSR
+            yield member
 
     def isViable(self):
         """Check to see if Python stdlib was built with tarfile support."""
@@ -253,42 +730,75 @@ class TarExtractor(Extractor):
         except ImportError:
             return False
 
+class _StagingWriter(object):
+    """Wraps an output file so each write is passed to L{check_staging}
+    first."""
+    def __init__(self, fileobj, target):
+        self.fileobj, self.target = fileobj, target
+
+    def write(self, data):
+        check_staging(self.target, len(data))
+        self.fileobj.write(data)
+
 class GZipExtractor(PipeExtractor):
-    """An internal fallback extractor for gzip-compressed files."""
+    """An internal extractor for gzip-compressed files.
+
+    Uses the streaming engine in L{unball.decompress}, which keeps pace with
+    C{gunzip} and also handles multi-member files."""
+    normalizes_permissions = True  # Output goes through open()/tar
+    src_ext = '.gz'
+
     def __init__(self):
         """no-op"""
-    def __call__(self, path, target):
-        """Decompress C{path} into C{target} using the C{gzip} module."""
-        import gzip
-        target_path = self._make_target_filename(path, target, '.gz')
-        in_handle, out_handle = gzip.open(path), open(target_path, 'wb')
-        for block in iter(lambda: in_handle.read(self.CHUNK_SIZE), ''):
-            out_handle.write(block)
-        in_handle.close()
-        out_handle.close()
+        self.last_stats = None  #: L{StreamStats} of the most recent call
+
+    def __call__(self, path, target, member_filter=None):
+        """Decompress C{path} into C{target}, streaming tarballs straight
+        into the preferred tar extractor. (The only case C{member_filter}
+        applies to)"""
+        with open(path, 'rb') as in_handle:
+            reader = self._reader(path, in_handle)
+            if isTarHeader(reader.peek(self.TAR_BLOCK)):
+                self._untar(reader, target, member_filter)
+            else:
+                target_path = self._make_target_filename(path, target,
+                                                         self.src_ext)
+                with open(target_path, 'wb') as out_handle:
+                    reader.copy_to(_StagingWriter(out_handle, target))
+        self.last_stats = reader.stats
+
+    def _reader(self, path, in_handle):
+        """Return a L{DecompressingReader} for the already-opened C{path}."""
+        from .decompress import DecompressingReader
+        return DecompressingReader(in_handle, self.format())
+
+    @staticmethod
+    def format():
+        """Return the L{unball.decompress.Format} this class decodes."""
+        from .decompress import GZIP
+        return GZIP
 
     def isViable(self):
         """Check to see if Python stdlib was built with gzip support."""
         try:
-            import gzip
-            gzip  # Silence flake8 complaint about unused import
+            import zlib
+            zlib  # Silence flake8 complaint about unused import
             return True
         except ImportError:
             return False
 
-class BZip2Extractor(PipeExtractor):
-    """An internal fallback extractor for bzip2-compressed files."""
-    def __init__(self):
-        """no-op"""
-    def __call__(self, path, target):
-        """Decompress C{path} into C{target} using the C{bz2} module."""
-        import bz2
-        target_path = self._make_target_filename(path, target, '.bz2')
-        in_handle, out_handle = bz2.BZ2File(path, 'r'), open(target_path, 'wb')
-        for block in iter(lambda: in_handle.read(self.CHUNK_SIZE), ''):
-            out_handle.write(block)
-        in_handle.close()
-        out_handle.close()
+class BZip2Extractor(GZipExtractor):
+    """An internal extractor for bzip2-compressed files.
+
+    Uses the streaming engine in L{unball.decompress}, which keeps pace with
+    C{bunzip2} and, unlike Python 2's C{BZ2File}, handles multi-stream files
+    such as those produced by C{pbzip2}."""
+    src_ext = '.bz2'
+
+    @staticmethod
+    def format():
+        from .decompress import BZIP2
+        return BZIP2
 
     def isViable(self):
         """Check to see if Python stdlib was built with bzip2 support."""
@@ -299,11 +809,38 @@ class BZip2Extractor(PipeExtractor):
         except ImportError:
             return False
 
+class ParallelGZipExtractor(GZipExtractor):
+    """An internal extractor which decodes BGZF (C{bgzip}) members on all
+    available cores. Other gzip files are handled as in L{GZipExtractor}."""
+    def __init__(self, threads=None):
+        """
+        @param threads: Size of the decoder thread pool. (Default: one per
+            CPU)
+        """
+        GZipExtractor.__init__(self)
+        self.threads = threads
+
+    def __repr__(self):
+        return "<%s(%r)>" % (self.__class__.__name__, self.threads)
+
+    def _reader(self, path, in_handle):
+        """Use a parallel decoder if C{path} can be split into pieces."""
+        from .decompress import (DecompressingReader, StreamStats,
+                                 parallel_chunks)
+        stats = StreamStats()
+        chunks = parallel_chunks(path, self.format(), self.threads, stats)
+        return DecompressingReader(in_handle, self.format(), chunks, stats)
+
+class ParallelBZip2Extractor(ParallelGZipExtractor, BZip2Extractor):
+    """An internal extractor which decodes bzip2 blocks on all available
+    cores. (Falls back to L{BZip2Extractor}'s single-threaded decoding for
+    single-block files or on single-CPU systems)"""
+
 class UUDecoder(Extractor):
     """An internal fallback extractor for uuencoded files."""
     def __init__(self):
         """no-op"""
-    def __call__(self, path, target):
+    def __call__(self, path, target, member_filter=None):
         """Decode C{path} into C{target} using the C{uu} module.
         @todo: Confirm that this will always extract within C{target}"""
         import uu
@@ -329,7 +866,7 @@ class B64Decoder(NamedOutputExtractor):
         """@todo: Rework this so it doesn't hard-code the extensions. (DRY)"""
         NamedOutputExtractor.__init__(self, [], ('.b64', '.mim'))
 
-    def __call__(self, path, target):
+    def __call__(self, path, target, member_filter=None):
         """Decode C{path} into C{target} using the C{base64} module."""
         import base64
         cwd = os.getcwd()
@@ -353,7 +890,7 @@ class BinhexDecoder(Extractor):
     """An internal fallback extractor for binhex-encoded files."""
     def __init__(self):
         """no-op"""
-    def __call__(self, path, target):
+    def __call__(self, path, target, member_filter=None):
         """Decode C{path} into C{target} using the C{binhex} module.
         @todo: Confirm that this will always extract within C{target}"""
         import binhex
@@ -387,10 +924,13 @@ class SitExtractor(Extractor):
         """
         self.prefixes = isinstance(prefix, basestring) and [prefix] or prefix
 
+    @property
+    def path(self):
+        """The current C{PATH} plus L{prefixes}, for finding unstuff."""
         path = os.environ.get('PATH', os.defpath).split(os.pathsep)
-        self.path = os.pathsep.join(path + self.prefixes)
+        return os.pathsep.join(path + list(self.prefixes))
 
-    def __call__(self, path, target):
+    def __call__(self, path, target, member_filter=None):
         """Use unstuff to extract the given Stuffit archive.
         @note: If I read my old shell script correctly, unstuff only accepts
         relative paths and that's why I break from the convention of not
@@ -426,11 +966,14 @@ class SitExtractor(Extractor):
                 path = os.path.join(os.pardir, path)
 
         # (The cwd= of this was the other major portion of the shell script)
-        subprocess.check_call(['unstuff', '--destination=.', path],
-                    stdin=BinYes, stdout=_out, stderr=_err,
+        CHILDREN.check_call(['unstuff', '--destination=.', path],
+                    owner=target, stdin=BinYes, stdout=_out, stderr=_err,
                     close_fds=_fds, cwd=target, env=_env,
                     universal_newlines=True)
 
+        if member_filter:
+            member_filter.prune(target)  # unstuff has no selection syntax
+
     def isViable(self):
         """Check to see if the PATH plus the given addition provides unstuff"""
         return bool(which('unstuff', self.path))
@@ -442,18 +985,48 @@ class TryAll(Extractor):
     """A meta-extractor for trying several other extractors until one works.
     Used for situations where it's not feasible to detect by extension or
     header. (eg. self-extracting arctives)
+
+    Before anything is run, the file is scanned for embedded archive
+    signatures (see L{findPayloads}) so only the extractors for payloads
+    actually present are tried, in the order they appear in the file.
     """
-    def __init__(self, *mimes):
+    def __init__(self, *mimes, **kwargs):
         """Takes a list of mimetypes to be lazily resolved to extractors.
+        @param fallback: The mimetype whose L{FALLBACK_DESCRIPTIONS} entry
+            should be reported if no embedded archive is found.
         @note: Order is significant."""
         self.mimes = mimes
+        self.fallback = kwargs.get('fallback')
         self.extractors = []
+        self.by_mime = {}
 
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__,
                 ', '.join(repr(x) for x in self.mimes))
 
-    def __call__(self, path, target):
+    def candidates(self, path):
+        """Return the extractors worth trying on C{path}, in order.
+
+        @raises NoExtractorError: An embedded archive was found but none of
+            the extractors for it are viable.
+        @raises UnsupportedFiletypeError: No embedded archive was found.
+        """
+        mimes = [x for x in self.mimes if not isinstance(x, Extractor)]
+        payloads = [mime for _, mime in findPayloads(path, mimes)]
+
+        # Extractors given directly can't be matched to a signature
+        found = [self.by_mime[x] for x in payloads if x in self.by_mime]
+        found += [x for x in self.mimes if x in self.extractors]
+        if found:
+            return found
+        elif payloads:
+            raise NoExtractorError("No viable extractors for the %s "
+                    "embedded in file: %s" % (', '.join(payloads), path))
+        else:
+            raise UnsupportedFiletypeError(FALLBACK_DESCRIPTIONS.get(
+                self.fallback, "No embedded archive found in file: %s" % path))
+
+    def __call__(self, path, target, member_filter=None):
         """Attempt to decompress C{path} to C{target} using one of the given
         extractors."""
         self.isViable()  # Make sure self.extractors has been built.
@@ -461,10 +1034,10 @@ class TryAll(Extractor):
         if not self.extractors:
             raise NoExtractorError("No extractors for file: %s" % path)
 
-        for potential_extractor in self.extractors:
+        for potential_extractor in self.candidates(path):
             try:
                 before = len(os.listdir(target))
-                potential_extractor(path, target)
+                potential_extractor(path, target, member_filter)
                 after = len(os.listdir(target))
 
                 if before < after:
@@ -478,23 +1051,203 @@ class TryAll(Extractor):
         if self.extractors:
             return True
 
-        self.extractors = []
+        self.extractors, self.by_mime = [], {}
         for mime in self.mimes:
             if isinstance(mime, Extractor):
                 if mime.isViable():
                     self.extractors.append(mime)
                 continue
-            potentials = mimeToExtractor(mime)
+            try:
+                potentials = mimeToExtractor(mime)
+            except UnsupportedFiletypeError:
+                continue  # No viable extractors for this sub-format
             if potentials and potentials[0].isViable():
                 self.extractors.append(potentials[0])
+                self.by_mime[mime] = potentials[0]
 
         return bool(self.extractors)
 #}
+#{ Dispatch
+
+class ExtractorTable(Mapping):
+    """A read-only mapping in the format of L{EXTRACTORS} which only builds
+    each entry the first time it's looked up.
+
+    Entries are given as zero-argument factories so that importing this
+    module doesn't construct (and, in L{SitExtractor}'s case, inspect the
+    environment for) extractors the current run will never use.
+    """
+    def __init__(self, factories):
+        self.factories = dict(factories)
+        self.aliases = {}
+        self._built = {}
+
+    def alias(self, name, target):
+        """Make C{name} look up the same entry (the same object) as
+        C{target}."""
+        if name in self:
+            raise Exception("OVERWRITE: %s -> %s" % (target, name))
+        self.aliases[name] = target
+
+    def fingerprint(self):
+        """Return a string which changes when the table's contents do,
+        without building any entries. (See L{DispatchTable.fingerprint})"""
+        entries = []
+        for mime in sorted(self.factories):
+            code = getattr(self.factories[mime], '__code__', None)
+            entries.append((mime, code and (code.co_names, [x for x in
+                code.co_consts if not hasattr(x, 'co_code')])))
+        return repr((entries, sorted(self.aliases.items())))
+
+    def __getitem__(self, mime):
+        mime = self.aliases.get(mime, mime)
+        if mime not in self._built:
+            self._built[mime] = self.factories[mime]()
+        return self._built[mime]
+
+    def __contains__(self, mime):
+        return mime in self.factories or mime in self.aliases
+
+    def __iter__(self):
+        return iter(list(self.factories) + list(self.aliases))
+
+    def __len__(self):
+        return len(self.factories) + len(self.aliases)
+
+class DispatchTable(object):
+    """Resolves mimetypes (and aliases) to their viable extractors once.
+
+    Viability is checked against L{PATH_INDEX}, so each search path entry is
+    listed at most once, and the result is persisted as indexes into the
+    candidate sequences of L{EXTRACTORS}. The on-disk copy is discarded when
+    C{PATH}, the mtime of a searched directory, the Python interpreter, or
+    the contents of the table change.
+    """
+    CACHE_VERSION = 1  #: Bump to invalidate caches on format changes
+
+    def __init__(self, table, cache_path=None, index=PATH_INDEX):
+        """
+        @param table: A mapping in the same format as L{EXTRACTORS}.
+        @param cache_path: Where to persist the resolved table or C{None} to
+            keep it in memory only.
+        @param index: The L{PathIndex} used for viability checks.
+        """
+        self.table = table
+        self.cache_path = cache_path
+        self.index = index
+        self.resolved = {}  #: Maps mimetypes to lists of candidate indexes
+        self._viable = {}   # Maps id(extractor) to isViable() results
+
+    @staticmethod
+    def candidates(entry):
+        """Normalize an L{EXTRACTORS} value into a list of extractors."""
+        if isinstance(entry, Extractor):
+            return [entry]
+        return list(entry)
+
+    def fingerprint(self):
+        """Return a digest identifying the table contents and interpreter."""
+        digest = hashlib.sha1(repr((self.CACHE_VERSION, sys.executable,
+                                    sys.version, os.environ.get('PATH'))))
+        if isinstance(self.table, ExtractorTable):
+            digest.update(self.table.fingerprint())
+        else:
+            for mime in sorted(self.table):
+                digest.update(repr((mime, self.table[mime])))
+        return digest.hexdigest()
+
+    def resolve(self, mime):
+        """Return the viable extractors for C{mime} in preference order.
+
+        @rtype: C{list}
+        """
+        if mime not in self.table:
+            return []
+
+        candidates = self.candidates(self.table[mime])
+        if mime not in self.resolved:
+            viable = []
+            for pos, extractor in enumerate(candidates):
+                key = id(extractor)
+                if key not in self._viable:
+                    self._viable[key] = extractor.isViable()
+                if self._viable[key]:
+                    viable.append(pos)
+            self.resolved[mime] = viable
+        return [candidates[x] for x in self.resolved[mime]]
+
+    def build(self):
+        """Resolve every mimetype in the table, preferring the on-disk cache,
+        and write the cache back if it had to be regenerated."""
+        if self.load():
+            return
+        for mime in self.table:
+            self.resolve(mime)
+        self.save()
+
+    def load(self):
+        """Attempt to populate L{resolved} from L{cache_path}.
+
+        @return: C{True} if a current cache was loaded.
+        @rtype: C{bool}
+        """
+        if not self.cache_path:
+            return False
+        try:
+            with open(self.cache_path, 'rb') as fobj:
+                cache = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if not (isinstance(cache, dict) and
+                cache.get('fingerprint') == self.fingerprint() and
+                self.index.is_current(cache.get('dirs', {}))):
+            return False
+
+        self.resolved = dict((str(k), v) for k, v
+                             in cache.get('table', {}).items())
+        return True
+
+    def save(self):
+        """Atomically write L{resolved} to L{cache_path}, ignoring failures
+        since the cache is purely an optimization."""
+        if not self.cache_path:
+            return
+        cache = {'fingerprint': self.fingerprint(),
+                 'dirs': self.index.mtimes(),
+                 'table': self.resolved}
+        parent = os.path.dirname(self.cache_path)
+        try:
+            try:
+                os.makedirs(parent)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            fd, tmp = tempfile.mkstemp(prefix='.dispatch-', dir=parent)
+            with os.fdopen(fd, 'wb') as fobj:
+                json.dump(cache, fobj)
+            os.rename(tmp, self.cache_path)
+        except (IOError, OSError):
+            pass
+
+_dispatch = None
+
+def get_dispatch_table():
+    """Return the shared L{DispatchTable} for L{EXTRACTORS}, building it (or
+    loading it from the on-disk cache) on first use."""
+    global _dispatch
+    if _dispatch is None:
+        _dispatch = DispatchTable(EXTRACTORS,
+                os.path.join(cache_dir(), 'dispatch.json'))
+        _dispatch.build()
+    return _dispatch
+
+#}
 
 
 def mimeToExtractor(mime):
     """Given a mimetype, return a list of possible extraction tools.
-    Uses L{Extractor.isViable} to check whether potentials are present.
+    Uses the L{DispatchTable} to check whether potentials are present.
 
     @param mime: The mimetype of the file to be extracted.
     @type mime: C{str}|C{tuple}|C{list}
@@ -506,16 +1259,11 @@ def mimeToExtractor(mime):
     if isinstance(mime, basestring):
         mime = (mime, )
 
-    possibilities = []
+    dispatch = get_dispatch_table()
+    extractors = []
     for mimetype in mime:
-        if mimetype in EXTRACTORS:
-            extractors = EXTRACTORS[mimetype]
-            if isinstance(extractors, Extractor):
-                possibilities.append(extractors)
-            else:
-                possibilities.extend(extractors)
+        extractors.extend(dispatch.resolve(mimetype))
 
-    extractors = [x for x in possibilities if x.isViable()]
     if extractors:
         return extractors
     else:
@@ -526,131 +1274,166 @@ def mimeToExtractor(mime):
         else:
             raise UnsupportedFiletypeError(mime)
 
-EXTRACTORS = {
+ESTIMATE_RATIO = 5
+"""Assumed expansion ratio for formats whose headers don't record the
+uncompressed size. (Used by L{estimateOutputSize})"""
+
+def estimateOutputSize(path, mime):
+    """Cheaply estimate how many bytes extracting C{path} will produce,
+    without decompressing anything.
+
+    Exact for zip-based formats and plain tarballs, close for single-member
+    gzip files under 4GiB and a guess (see L{ESTIMATE_RATIO}) otherwise.
+
+    @rtype: C{int}
+    """
+    size = os.path.getsize(path)
+    if mime == 'application/x-tar':
+        return size
+    elif mime == 'application/x-gzip' and size >= 18:
+        with open(path, 'rb') as fobj:
+            fobj.seek(-4, os.SEEK_END)
+            isize = struct.unpack('<I', fobj.read(4))[0]
+        if isize >= size // 2:  # Otherwise, it probably wrapped at 4GiB
+            return isize
+
+    import zipfile
+    try:
+        if zipfile.is_zipfile(path):
+            archive = zipfile.ZipFile(path)
+            try:
+                return sum(x.file_size for x in archive.infolist())
+            finally:
+                archive.close()
+    except (IOError, zipfile.BadZipfile):
+        pass
+    return size * ESTIMATE_RATIO
+
+EXTRACTORS = ExtractorTable({
         'application/x-7z-compressed':
-            (Extractor('7z', 'x'),
-             Extractor('7za', 'x'),
-             Extractor('7zr', 'x'),
-             Extractor('sqc', 'x')),
+            lambda: (Extractor('7z', 'x'),
+                     Extractor('7za', 'x'),
+                     Extractor('7zr', 'x'),
+                     Extractor('sqc', 'x')),
         'application/x-ace-compressed':
-            (Extractor('unace-bin', 'x', '-y'),
-             Extractor('unace', 'x', '-y'),
-             Extractor('sqc', 'x')),
+            lambda: (Extractor('unace-bin', 'x', '-y'),
+                     Extractor('unace', 'x', '-y'),
+                     Extractor('sqc', 'x')),
         'application/x-adf':
-            (Extractor('unadf'),
-             Extractor('readdisk'),
-             Extractor('e-readdisk')),
+            lambda: (Extractor('unadf'),
+                     Extractor('readdisk'),
+                     Extractor('e-readdisk')),
         'application/x-adz':
-            PipeExtractor('gunzip', '.adz', '.adf'),
+            lambda: PipeExtractor('gunzip', '.adz', '.adf'),
         'application/x-alz':
-            Extractor('unalz'),
+            lambda: Extractor('unalz'),
         'application/x-ar':
-            Extractor('ar', 'x'),
+            lambda: Extractor('ar', 'x'),
         'application/x-arc':
-            Extractor('arc', 'x'),
+            lambda: Extractor('arc', 'x'),
         'application/arj':
-            (Extractor('arj', 'x', '-y'),
-             Extractor('unarj', 'x'),
-             Extractor('sqc', 'x')),
+            lambda: (Extractor('arj', 'x', '-y'),
+                     Extractor('unarj', 'x'),
+                     Extractor('sqc', 'x')),
         'application/bzip2':
-            (PipeExtractor('bunzip2', '.bz2'),
-             BZip2Extractor()),
+            lambda: (ParallelBZip2Extractor(),
+                     BZip2Extractor(),
+                     PipeExtractor('bunzip2', '.bz2')),
         'application/cab':
-            TryAll(
+            lambda: TryAll(
                 Extractor('cabextract'),
                 Extractor('unshield'),
                 Extractor('sqc', 'x')),
         'application/x-compress':
-            (PipeExtractor('uncompress.real', '.z'),
-             PipeExtractor('uncompress', '.z')),
+            lambda: (PipeExtractor('uncompress.real', '.z'),
+                     PipeExtractor('uncompress', '.z')),
         'application/x-cpio':
-            Extractor('cpio', '--force-local', '--quiet', '-idI'),
+            lambda: Extractor('cpio', '--force-local', '--quiet', '-idI'),
         'application/x-deb':
-            Extractor('ar', 'x'),
+            lambda: Extractor('ar', 'x'),
         'application/x-dosexec':
-            [],  # See below for how this works
+            # Try the sequences for possible self-extractor formats
+            lambda: TryAll('application/zip',
+                           'application/x-rar',
+                           'application/arj',
+                           'application/x-7z-compressed',
+                           'application/lzh',
+                           'application/x-ace-compressed',
+                           fallback='application/x-dosexec'),
         'application/x-diskmasher':
-            (Extractor('xdms', 'u'),
-             NamedOutputExtractor('undms', '.dms', '.adf')),
+            lambda: (Extractor('xdms', 'u'),
+                     NamedOutputExtractor('undms', '.dms', '.adf')),
         'application/x-gzip':
-            (PipeExtractor('gunzip', '.gz'),
-             GZipExtractor()),
+            lambda: (ParallelGZipExtractor(),
+                     GZipExtractor(),
+                     PipeExtractor('gunzip', '.gz')),
         'application/lzh':
-            (Extractor('lha', 'x'),
-             Extractor('sqc', 'x')),
+            lambda: (Extractor('lha', 'x'),
+                     Extractor('sqc', 'x')),
         'application/lzx':
-            Extractor('unlzx', '-x'),
+            lambda: Extractor('unlzx', '-x'),
         'application/x-lzop':
-            Extractor('lzop', '-x',),
+            lambda: Extractor('lzop', '-x',),
         'application/macbinary':
-            (SitExtractor(),
-             Extractor('macunpack', '-f')),
+            lambda: (SitExtractor(),
+                     Extractor('macunpack', '-f')),
         'application/mac-binhex40':
-            (SitExtractor(),
-             Extractor('uudeview', '-i')),
+            lambda: (SitExtractor(),
+                     Extractor('uudeview', '-i')),
         'application/mime':
-            Extractor('uudeview', '-ib'),
+            lambda: Extractor('uudeview', '-ib'),
         'application/msi':
-            Extractor('7z', 'x'),
+            lambda: Extractor('7z', 'x'),
         'application/x-rar':
-            (Extractor('unrar', 'x', '-y', '-p-'),
-             Extractor('rar', 'x', '-y', '-p-'),
-             Extractor('sqc', 'x')),
+            lambda: (Extractor('unrar', 'x', '-y', '-p-'),
+                     Extractor('rar', 'x', '-y', '-p-'),
+                     Extractor('sqc', 'x')),
         'application/x-rpm':
-            (Extractor('rpm2cpio'),
-             Extractor('rpm2targz')),
+            lambda: (Extractor('rpm2cpio'),
+                     Extractor('rpm2targz')),
         'application/x-rzip':
-            NamedOutputExtractor(['runzip', '-k'], '.rz',
-                                 outfile_option='-o '),
+            lambda: NamedOutputExtractor(['runzip', '-k'], '.rz',
+                                         outfile_option='-o '),
         'application/x-extension-sfark':
-            Extractor('sfarkxtc'),
+            lambda: Extractor('sfarkxtc'),
         'application/x-slp':
-            Extractor('alien', '-g'),
+            lambda: Extractor('alien', '-g'),
             # FIXME: Untested for lack of a .slp file
         'application/x-squeeze':
-            Extractor('sqc', 'x'),
+            lambda: Extractor('sqc', 'x'),
         'application/x-stuffit':
-            SitExtractor(),
+            lambda: SitExtractor(),
         'application/x-tar':
-            (Extractor('tar', 'xf'),
-             TarExtractor()),
+            lambda: (Extractor('tar', 'xf'),
+                     TarExtractor()),
         'application/x-uuencode':
-            (Extractor('uudeview', '-i'),
-             Extractor('uudecode'),
-             UUDecoder()),
+            lambda: (Extractor('uudeview', '-i'),
+                     Extractor('uudecode'),
+                     UUDecoder()),
         'application/x-xar':
-            Extractor('xar', '-xf'),
+            lambda: Extractor('xar', '-xf'),
         'application/x-xx-encoded':
-            (Extractor('uudeview', '-i'),
-             Extractor('xxdecode')),
+            lambda: (Extractor('uudeview', '-i'),
+                     Extractor('xxdecode')),
         'application/x-yenc-encoded':
-            (Extractor('uudeview', '-i'),
-             Extractor('ydecode'),
-             Extractor('yydecode')),
+            lambda: (Extractor('uudeview', '-i'),
+                     Extractor('ydecode'),
+                     Extractor('yydecode')),
         'application/zip':
-            (Extractor('7z', 'x'),
-             Extractor('7za', 'x'),
-             Extractor('unzip', '-q'),
-             ZipExtractor(),
-             Extractor('jar', 'xf'),
-             Extractor('sqc', 'x')),
+            lambda: (Extractor('7z', 'x'),
+                     Extractor('7za', 'x'),
+                     Extractor('unzip', '-q'),
+                     ZipExtractor(),
+                     Extractor('jar', 'xf'),
+                     Extractor('sqc', 'x')),
         'application/x-zoo':
-            (Extractor('unzoo', '-x'),
-             Extractor('zoo', '-extract'))
-}
+            lambda: (Extractor('unzoo', '-x'),
+                     Extractor('zoo', '-extract'))
+})
 """Mappings from mimetypes to Extractor instances or iterables thereof.
+(Given as factories so each entry is only built when first looked up)
 @note: Order is significant within the target iterables."""
 
-# Dynamically build the extraction trial sequence for self-extractors from the
-# sequences for possible self-extractor formats.
-EXTRACTORS['application/x-dosexec'] = TryAll(
-            'application/zip',
-            'application/x-rar',
-            'application/arj',
-            'application/x-7z-compressed',
-            'application/lzh',
-            'application/x-ace-compressed')
-
 aliases = {
         'application/x-archive': 'application/x-ar',
         'application/x-ace': 'application/x-ace-compressed',
@@ -706,14 +1489,19 @@ FALLBACK_DESCRIPTIONS = {
         'application/x-dgca-compressed': "DGCA archive. The only known site "
             "for these is in Japanese and the only extraction tool seems to "
             "be Windows-only.",
-        'application/x-dosexec': "DOS/Windows Executable. It may be a self-"
-            "extracting archive, but all attempts to extract it failed.",
+        'application/x-dosexec': "DOS/Windows Executable. It doesn't appear "
+            "to contain a self-extracting archive that unball can unpack.",
         'application/x-gca-compressed': "GCA archive. The only known site "
             "for these is in Japanese and the only extraction tool seems to "
             "be Windows-only.",
         'application/x-iso9660-image': "ISO9660 CD/DVD image. To extract "
             "files from this, use a virtual disc drive like CDEmu (Linux) or"
             " DaemonTools (Windows)",
+        'application/x-ms-compress-kwaj': "MS-DOS COMPRESS.EXE (KWAJ) "
+            "file. Try Windows' EXPAND.EXE or the expand example tool from "
+            "libmspack.",
+        'application/x-ms-compress-szdd': "MS-DOS COMPRESS.EXE (SZDD) "
+            "file. Try msexpand (from mscompress) or Windows' EXPAND.EXE.",
         'application/msi': "Microsoft Installer package. If you trust it, "
             "you can use Wine's msiexec tool to install it.",
             #TODO: I believe 7zip can now unpack MSIs.
@@ -739,9 +1527,10 @@ command work.
 """
 
 for key, target_key in aliases.items():
-    for target in (EXTRACTORS, FALLBACK_DESCRIPTIONS):
-        if target_key in target:
-            if key in target:
-                raise Exception("OVERWRITE: %s -> %s" % (target_key, key))
-            target[key] = target[target_key]
+    if target_key in EXTRACTORS:
+        EXTRACTORS.alias(key, target_key)
+    if target_key in FALLBACK_DESCRIPTIONS:
+        if key in FALLBACK_DESCRIPTIONS:
+            raise Exception("OVERWRITE: %s -> %s" % (target_key, key))
+        FALLBACK_DESCRIPTIONS[key] = FALLBACK_DESCRIPTIONS[target_key]
 del aliases, key
@@ -0,0 +1,277 @@
+"""Listing archive members without extracting them.
+
+Zip central directories and tar headers are read in-process. Other formats
+are listed by parsing the "technical" listings of C{7z l -slt} and
+C{unrar lt}.
+
+Listings are remembered in a small SQLite L{ListingIndex}, keyed by the
+archive's real path and invalidated when its C{(device, inode, size, mtime)}
+changes, so repeated queries over a large collection don't re-read anything.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import os, struct, subprocess
+from collections import namedtuple
+
+from .extractors import EXTRACTORS, UnsupportedFiletypeError
+from .mimetypes import pathToMimetype
+from .util import cache_dir, which
+
+class Member(namedtuple('Member', 'name size compressed crc')):
+    """An archive member. Directories have names ending in C{/}.
+    Fields the format (or listing tool) doesn't provide are C{None}.
+
+    @ivar size: The uncompressed size in bytes.
+    @ivar compressed: The compressed size in bytes.
+    @ivar crc: The CRC32 of the contents as 8 lowercase hex digits.
+    """
+    __slots__ = ()
+
+#{ Listers
+
+def list_zip(path):
+    """List a zip file from its central directory."""
+    import zipfile
+    archive = zipfile.ZipFile(path)
+    try:
+        return [Member(x.filename, x.file_size, x.compress_size,
+                       '%08x' % x.CRC) for x in archive.infolist()]
+    finally:
+        archive.close()
+
+def list_tar(path):
+    """List a (possibly compressed) tar file in a single streaming pass."""
+    import tarfile
+    tar = tarfile.open(path, 'r|*')
+    try:
+        return [Member(x.name + (x.isdir() and '/' or ''),
+                       x.isreg() and x.size or 0, None, None) for x in tar]
+    finally:
+        tar.close()
+
+def iter_tar_names(path):
+    """Yield the member names of an uncompressed tar file (with C{/} on
+    directories) by seeking from header to header, without holding on to
+    the members like C{TarFile.getmembers} would."""
+    import tarfile
+    tar = tarfile.open(path, 'r:')
+    try:
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+            tar.members = []  # Constant memory, whatever the member count
+            yield member.name + (member.isdir() and '/' or '')
+    finally:
+        tar.close()
+
+def list_gzip(path):
+    """List a gzipped file which isn't a tarball, using the gzip trailer.
+
+    @note: The trailer only stores the size modulo 2**32.
+    """
+    with open(path, 'rb') as fobj:
+        if fobj.read(2) != b'\x1f\x8b':
+            raise ValueError("Not a gzip file: %s" % path)
+        fobj.seek(-8, os.SEEK_END)
+        crc, size = struct.unpack('<II', fobj.read(8))
+        packed = fobj.tell()
+    name = os.path.splitext(os.path.basename(path))[0]
+    return [Member(name, size, packed, '%08x' % crc)]
+
+def list_7z(path):
+    """List anything 7-Zip understands by parsing C{7z l -slt}."""
+    lines = _run('7z', '7za', '7zr')(['l', '-slt', path])
+    if '----------' in lines:  # Skip the block describing the archive
+        lines = lines[lines.index('----------') + 1:]
+
+    members = []
+    for block in _blocks(lines, '='):
+        is_dir = (block.get('folder') == '+' or
+                  block.get('attributes', '').startswith('D'))
+        members.append(Member(block['path'] + (is_dir and '/' or ''),
+                              _int(block.get('size')),
+                              _int(block.get('packed size')),
+                              _crc(block.get('crc'))))
+    return members
+
+def list_rar(path):
+    """List a RAR archive by parsing C{unrar lt}."""
+    members = []
+    for block in _blocks(_run('unrar', 'rar')(['lt', '-p-', path]), ':'):
+        if 'name' not in block:
+            continue
+        is_dir = block.get('type', '').lower() == 'directory'
+        members.append(Member(block['name'] + (is_dir and '/' or ''),
+                              _int(block.get('size')),
+                              _int(block.get('packed size')),
+                              _crc(block.get('crc32'))))
+    return members
+
+#: Listers to try for each mimetype, in order. Anything else is handed to
+#: L{list_7z}.
+LISTERS = {
+    'application/zip': (list_zip, list_7z),
+    'application/x-tar': (list_tar, list_7z),
+    'application/x-gzip': (list_tar, list_gzip),
+    'application/bzip2': (list_tar, list_7z),
+    'application/x-rar': (list_rar, list_7z),
+    'application/x-dosexec': (list_zip, list_7z, list_rar),
+}
+
+def _run(*commands):
+    """Return a function which runs the first of C{commands} found in the
+    C{PATH} with the given arguments and returns its output lines."""
+    for command in commands:
+        if which(command):
+            break
+    else:
+        raise OSError("None of %s found in the PATH" % ', '.join(commands))
+
+    def run(args):
+        with open(os.devnull, 'rb') as devnull:
+            proc = subprocess.Popen([command] + args, stdin=devnull,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        output = proc.communicate()[0].decode('utf-8', 'replace')
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode,
+                                                [command] + args)
+        return output.splitlines()
+    return run
+
+def _blocks(lines, separator):
+    """Parse blank-line-separated blocks of C{Key <separator> Value} lines
+    into dicts with lowercased keys."""
+    block = {}
+    for line in lines:
+        key, sep, value = line.partition(separator)
+        if sep and key.strip():
+            block[key.strip().lower()] = value.strip()
+        elif not line.strip() and block:
+            yield block
+            block = {}
+    if block:
+        yield block
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _crc(value):
+    return value and value.lower().zfill(8) or None
+
+#}
+
+def list_archive(path, index=None, mime=None):
+    """List the members of an archive.
+
+    @param index: A L{ListingIndex} to consult and update.
+    @param mime: The mimetype of C{path}, if already known.
+    @rtype: C{list} of L{Member}
+
+    @raises UnsupportedFiletypeError: C{path} isn't an archive or no lister
+        could read it.
+    """
+    st = os.stat(path)
+    if index:
+        members = index.get(path, st)
+        if members is not None:
+            return members
+
+    mime = mime or pathToMimetype(path, EXTRACTORS)
+    if mime not in EXTRACTORS and mime not in LISTERS:
+        raise UnsupportedFiletypeError("Not an archive: %s (%s)" %
+                                       (path, mime))
+
+    errors = []
+    for lister in LISTERS.get(mime, (list_7z,)):
+        try:
+            members = lister(path)
+            break
+        except Exception as err:  # Each lister fails in its own way
+            errors.append("%s: %s" % (lister.__name__, err))
+    else:
+        raise UnsupportedFiletypeError("Could not list %s (%s): %s" %
+                                       (path, mime, '; '.join(errors)))
+
+    if index:
+        index.put(path, st, mime, members)
+    return members
+
+class ListingIndex(object):
+    """A persistent SQLite index of archive listings.
+
+    Entries are keyed by the archive's real path and only returned while its
+    C{(device, inode, size, mtime)} matches what was recorded.
+
+    @param path: The database file. (Default: C{listings.sqlite} in
+        L{cache_dir})
+    @raises ImportError: Python was built without C{sqlite3}.
+    @raises IOError: The database couldn't be opened or created.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archives (
+            id INTEGER PRIMARY KEY, path TEXT UNIQUE, dev INTEGER,
+            ino INTEGER, size INTEGER, mtime REAL, mime TEXT);
+        CREATE TABLE IF NOT EXISTS members (
+            archive INTEGER, name TEXT, size INTEGER, compressed INTEGER,
+            crc TEXT);
+        CREATE INDEX IF NOT EXISTS members_archive ON members (archive);
+    """
+
+    def __init__(self, path=None):
+        import sqlite3
+        self.path = path or os.path.join(cache_dir(), 'listings.sqlite')
+        parent = os.path.dirname(self.path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        try:
+            self.db = sqlite3.connect(self.path, timeout=30)
+            if str is bytes:  # Python 2.x: Paths are byte strings
+                self.db.text_factory = str
+            self.db.executescript(self.SCHEMA)
+        except sqlite3.Error as err:
+            raise IOError("Could not open %s: %s" % (self.path, err))
+
+    @staticmethod
+    def _identity(st):
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime
+
+    def get(self, path, st):
+        """Return the recorded listing for C{path} or C{None} if there is
+        none or C{st} shows the archive has changed since."""
+        row = self.db.execute("SELECT id, dev, ino, size, mtime "
+            "FROM archives WHERE path = ?", (os.path.realpath(path),)
+            ).fetchone()
+        if not row or tuple(row[1:]) != self._identity(st):
+            return None
+        return [Member(*x) for x in self.db.execute(
+            "SELECT name, size, compressed, crc FROM members "
+            "WHERE archive = ? ORDER BY rowid", (row[0],))]
+
+    def put(self, path, st, mime, members):
+        """Record the listing of C{path}, replacing any previous one."""
+        path = os.path.realpath(path)
+        with self.db:
+            for (old,) in self.db.execute(
+                    "SELECT id FROM archives WHERE path = ?", (path,)):
+                self.db.execute("DELETE FROM members WHERE archive = ?",
+                                (old,))
+            self.db.execute("DELETE FROM archives WHERE path = ?", (path,))
+            archive = self.db.execute("INSERT INTO archives "
+                "(path, dev, ino, size, mtime, mime) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path,) + self._identity(st) + (mime,)).lastrowid
+            self.db.executemany("INSERT INTO members "
+                "(archive, name, size, compressed, crc) "
+                "VALUES (?, ?, ?, ?, ?)",
+                ((archive,) + tuple(x) for x in members))
+
+    def close(self):
+        self.db.close()
@@ -30,8 +30,6 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 @todo: Decide how to implement --overwrite and --verbose
 @todo: Do the exception handling in a way which produces nicer output.
 @todo: Consider switching to the logging module for error messages.
-@todo: Now that this is in Python, restructure the code so it provides a proper
-       API for being imported by other Python programs.
 @todo: Verify that POSIX signals don't circumvent try/finally. Handle them if
        necessary.
 @todo: Consider re-adding the convenience identifiers for skipped files in
@@ -45,13 +43,19 @@ __license__ = "GNU GPL 2.0 or later"
 
 RECURSION_LIMIT = 5  #: Controls the anti-quine check.
 
-import errno, os, subprocess, sys
-from stat import S_IRUSR, S_IXUSR
+#: Mimetypes whose layout is cheap enough to read to work out the output
+#: path before extracting: Zip central directories and the headers of
+#: uncompressed (so seekable) tarballs. (See L{plan_target})
+PLANNABLE = frozenset(['application/zip', 'application/x-tar'])
+
+import errno, json, os, shutil, sys
 
 from .mimetypes import pathToMimetype
-from .extractors import (mimeToExtractor,
-                        NoExtractorError, UnsupportedFiletypeError)
-from .util import TempTarget
+from .extractors import (estimateOutputSize, mimeToExtractor,
+                        MemberFilter, PipeExtractor, UnsupportedFiletypeError)
+from .util import (ExtractionStats, OutputGuard, OutputLimitExceeded,
+                   OutputLimits, StagingOverflow, TempTarget,
+                   free_space, normalize_permissions, parse_size)
 
 # TODO: See if I can refactor to remove the need for this
 from .extractors import EXTRACTORS
@@ -62,7 +66,9 @@ class NothingProducedError(UnballError):
     """The extractor (usually a subprocess) didn't return an error condition
     but also didn't extract anything."""
 
-def tryExtract(srcFile, targetDir=None, level=0):
+def tryExtract(srcFile, targetDir=None, level=0, memory_budget=None,
+               stats=None, cache=None, dedup=None, member_filter=None,
+               limits=None):
     """Attempt to extract the given archive.
 
     @param srcFile: The potential archive file for which an extraction attempt
@@ -72,15 +78,39 @@ def tryExtract(srcFile, targetDir=None, level=0):
     @param level: Recursion level. Used to protect the nested
         extractor/decompressor from quines. (Proven possible in zipfiles.
         I don't know about others.)
+    @param memory_budget: If given, stage the extraction in RAM when the
+        output is expected to fit in this many bytes, falling back to
+        on-disk staging if it turns out not to. (See L{TempTarget})
+    @param stats: If given, an L{ExtractionStats} to record per-phase timings
+        and resource usage in.
+    @param cache: If given, copy the extractor's output out of this cache
+        when the same archive has been extracted before and store it there
+        otherwise. (C{stats.info['cache']} records which happened)
+    @param dedup: If given, called on the finished tree before it is
+        published to replace identical files with links.
+        (C{stats.info['dedup_files']} and C{['dedup_saved']} record the
+        number of files replaced and bytes saved)
+    @param member_filter: If given, only extract the members it selects.
+        Archives wrapped in a single-member archive or compressor (eg. a
+        C{.tar} inside a C{.zip}) have it applied to the innermost one.
+        (Bypasses C{cache})
+    @param limits: If given, fail archives which would unpack to more than
+        it allows, before extracting where possible. (See L{preflight})
     @type srcFile: C{str} | C{unicode}
     @type targetDir: C{str} | C{unicode}
     @type level: C{int}
+    @type memory_budget: C{int}
+    @type stats: L{ExtractionStats}
+    @type cache: L{ExtractionCache<unball.cache.ExtractionCache>}
+    @type dedup: L{Deduplicator<unball.dedup.Deduplicator>}
+    @type member_filter: L{MemberFilter}
+    @type limits: L{OutputLimits}
 
     @return: The path to the extracted content.
     @rtype: C{str}
 
     @raises IOError: The source or target are invalid or require additional
-    permissions.
+    permissions. (Or there isn't enough free space)
     @raises OSError: The specified target isn't a directory or already
     contains the file/directory name extraction produced.
     @raises CalledProcessError: The subprocess called by an L{Extractor}
@@ -91,6 +121,8 @@ def tryExtract(srcFile, targetDir=None, level=0):
     files or directories were extracted. (eg. unace when it fails)
     @raises UnsupportedFiletypeError: The mimetype of the given file has no
     L{Extractor} mappings.
+    @raises OutputLimitExceeded: The archive would unpack (or was aborted
+    while unpacking) to more than C{limits} allow.
     """
 
     srcFile = os.path.abspath(srcFile)
@@ -104,48 +136,339 @@ def tryExtract(srcFile, targetDir=None, level=0):
     elif not os.access(srcFile, os.R_OK):
         raise IOError(errno.EACCES, "Access denied to source file", srcFile)
 
+    stats = stats or ExtractionStats()
+
+    store = None
+    if cache and not member_filter:
+        with stats.phase('hash'):
+            key = cache.key(srcFile)
+        cached = cache.lookup(key)
+        if cached:
+            stats.info.update(mime=cached.mime, cache='hit')
+            with stats.phase('preflight'):  # Same checks as a real run
+                check_size(srcFile, targetDir, cached.meta.get('size'),
+                           limits)
+            try:
+                return _extract_staged(srcFile, targetDir, [cached], level,
+                                       None, stats, dedup=dedup,
+                                       limits=limits)
+            except (IOError, OSError):
+                stats.info['cache'] = 'stale'  # Evicted while copying
+
+        def store(tree, extractor):
+            return cache.store(key, tree, mime=mime,
+                               extractor=repr(extractor))
+
     # Check for viable extractors for the given file
-    mime = pathToMimetype(srcFile, EXTRACTORS)
-    extractors = mimeToExtractor(mime)
+    with stats.phase('detect'):
+        mime = pathToMimetype(srcFile, EXTRACTORS)
+    stats.info['mime'] = mime
+    with stats.phase('dispatch'):
+        extractors = mimeToExtractor(mime)
+
+    with stats.phase('preflight'):
+        members = list_members(srcFile, mime,
+                               thorough=bool(limits or member_filter))
+        preflight(srcFile, targetDir, members, limits, member_filter)
+        wrapper = is_wrapper(srcFile, members, member_filter)
+
+    if memory_budget:
+        with stats.phase('estimate'):
+            fits = estimateOutputSize(srcFile, mime) <= memory_budget
+        if fits:
+            try:
+                return _extract_staged(srcFile, targetDir, extractors, level,
+                                       memory_budget, stats, store, dedup,
+                                       member_filter, limits, wrapper)
+            except StagingOverflow:
+                stats.info['staging_overflow'] = True  # Retry on disk.
+
+    if not store:  # Caching needs the tree as it would have been staged
+        with stats.phase('plan'):
+            plan = plan_target(srcFile, targetDir, mime, extractors[0],
+                               member_filter, members)
+        if plan:
+            return _extract_direct(srcFile, plan[0], plan[1], extractors[0],
+                                   stats, dedup, member_filter, limits)
+    return _extract_staged(srcFile, targetDir, extractors, level, None,
+                           stats, store, dedup, member_filter, limits, wrapper)
+
+def _target_name(srcFile):
+    """Return the name of the folder an archive with several top-level
+    entries is extracted into."""
+    target_name = os.path.splitext(os.path.basename(srcFile))[0]
+    if target_name.lower().endswith('.tar'):  # Streamed .tar.gz and friends
+        target_name = target_name[:-4]
+    return target_name
+
+def list_members(srcFile, mime, thorough=False):
+    """Return the member listing of C{srcFile} or C{None} if it can't be
+    listed. (An empty listing is also C{None}, since a compressed stream
+    which doesn't start with a tar header lists as empty)
+
+    Unless C{thorough}, only listings which come for free are tried: Zip
+    central directories and gzip trailers (which are as close as tarballs
+    compressed with gzip get). Otherwise, anything L{list_archive
+    <unball.listing.list_archive>} supports is, even if that means running
+    C{7z}, except for other compressed streams. Those can only be listed by
+    decompressing all of them, which is exactly what a preflight check on a
+    decompression bomb mustn't do.
+    """
+    from .listing import list_archive, list_gzip, list_zip
+    members = None
+    try:
+        if mime == 'application/zip':
+            members = list_zip(srcFile)
+        elif mime == 'application/x-gzip':
+            members = list_gzip(srcFile)
+        elif thorough and not _is_stream(mime):
+            members = list_archive(srcFile, mime=mime)
+    except Exception:  # Each format fails in its own way
+        pass  # Listings are only used for optimizations and sanity checks
+    return members or None
+
+def _is_stream(mime):
+    """Return whether C{mime} is a compressed stream (eg. a .tar.bz2), as
+    indicated by it being unpacked by a L{PipeExtractor}."""
+    extractors = EXTRACTORS.get(mime, ())
+    if not isinstance(extractors, tuple):
+        extractors = (extractors,)
+    return any(isinstance(x, PipeExtractor) for x in extractors)
+
+def preflight(srcFile, targetDir, members, limits=None, member_filter=None):
+    """Check, before extracting, that the members listed by L{list_members}
+    will fit on the filesystem holding C{targetDir} (where L{TempTarget}
+    stages them) and within C{limits}, if given.
+
+    Does nothing for archives which couldn't be listed, leaving their size
+    to the L{OutputGuard}.
+
+    @raises IOError: There isn't enough free space. (C{ENOSPC})
+    @raises OutputLimitExceeded: The listed members exceed C{limits}.
+    """
+    if members is not None:
+        check_size(srcFile, targetDir, sum(x.size or 0 for x in members
+            if not member_filter or member_filter(x.name)), limits)
+
+def is_wrapper(srcFile, members, member_filter=None):
+    """Decide from the member listing whether C{srcFile} is just a wrapper
+    around the archive C{member_filter} was meant for. (eg. A .tar inside a
+    .zip) That's the case when its only file isn't selected.
+
+    @return: C{True} if C{srcFile} should be extracted unfiltered, with the
+        filter applied to the nested archive instead. (C{False} if there's
+        no filter or listing)
+    @raises NothingProducedError: The filter selects none of several files.
+    """
+    if not (member_filter and members):
+        return False
+    files = [x.name for x in members if not x.name.endswith('/')]
+    if any(member_filter(x) for x in files):
+        return False
+    elif len(files) == 1:
+        return True
+    raise NothingProducedError("No members of %s matched the filter" %
+                               srcFile)
+
+def check_size(srcFile, targetDir, total, limits=None):
+    """Check that C{srcFile} unpacking to C{total} bytes will fit in the
+    free space and C{limits}. (See L{preflight}) Does nothing if C{total}
+    is C{None}.
+
+    @raises IOError: There isn't enough free space. (C{ENOSPC})
+    @raises OutputLimitExceeded: C{total} exceeds C{limits}.
+    """
+    if total is None:
+        return
+
+    budget = limits and limits.budget(srcFile)
+    if budget is not None and total > budget:
+        raise OutputLimitExceeded("%s would unpack to %d bytes (limit: %d)"
+                                  % (srcFile, total, budget))
+
+    free = free_space(targetDir)
+    if free is not None and total > free:
+        raise IOError(errno.ENOSPC, "%s would unpack to %d bytes but only "
+                      "%d are free" % (srcFile, total, free), targetDir)
+
+def plan_target(srcFile, targetDir, mime, extractor, member_filter=None,
+                members=None):
+    """Predict from the archive's member names where L{_extract_staged}
+    would end up publishing it, so it can be extracted straight there
+    instead. (Only for L{PLANNABLE} archives)
+
+    Archives with several top-level entries are planned for any extractor.
+    A single top-level directory is only planned for extractors which can
+    strip it (see L{Extractor.strips_prefix}) and a single top-level file
+    never is, since it may need nested extraction.
+
+    Tarballs are only planned for extractors which strip prefixes. Others
+    (ie. GNU tar) gain too little from it to pay for the extra header pass.
+
+    @param members: The zip listing, if L{list_members} has already read it.
+    @return: C{(target, prefix)}, where C{prefix} is the top-level directory
+        to strip, if any, or C{None} if the outcome can't be predicted
+        cheaply.
+    """
+    from .listing import iter_tar_names, list_zip
+    if mime == 'application/zip':
+        names = (x.name for x in members or list_zip(srcFile))
+    elif mime == 'application/x-tar' and extractor.strips_prefix:
+        names = iter_tar_names(srcFile)
+    else:
+        return None
+
+    tops, dirs = set(), set()
+    try:
+        for name in names:
+            is_dir = name.endswith('/')
+            if member_filter and (is_dir or not member_filter(name)):
+                continue  # Filtered extractions prune emptied directories
+            parts = [x for x in name.replace('\\', '/').split('/')
+                     if x not in ('', '.')]
+            if '..' in parts:
+                return None  # Tools differ on where these end up
+            elif parts:
+                tops.add(parts[0])
+                if is_dir or len(parts) > 1:
+                    dirs.add(parts[0])
+    except Exception:  # Each format fails in its own way
+        return None  # Planning is purely an optimization
+
+    if len(tops) > 1:
+        target, prefix = os.path.join(targetDir, _target_name(srcFile)), None
+    elif tops and tops == dirs and extractor.strips_prefix:
+        prefix = tops.pop()
+        target = os.path.join(targetDir, prefix)
+    else:
+        return None
+
+    if target == srcFile:
+        target += '.out'
+    return target, prefix
+
+def _extract_direct(srcFile, target, prefix, extractor, stats, dedup=None,
+                    member_filter=None, limits=None):
+    """Extract straight into the final C{target} planned by L{plan_target},
+    which is claimed atomically with C{mkdir} so it's a stable path to watch
+    while extraction runs. It's removed again if extraction fails.
+
+    @param limits: See L{tryExtract}.
+    @raises OSError: C{target} already exists.
+    """
+    limit = limits and limits.budget(srcFile)
+    os.mkdir(target)
+    guard = limit is not None and OutputGuard(target, limit)
+    try:
+        kwargs = prefix and {'prefix': prefix} or {}
+        if guard:
+            guard.start()
+        try:
+            _run_extractor(extractor, srcFile, target, stats, member_filter,
+                           **kwargs)
+        finally:
+            if guard:
+                guard.stop()
+                if guard.exceeded:  # Even if the extractor won the race
+                    raise OutputLimitExceeded("Extracting %s produced more "
+                        "than %d bytes" % (target, limit))
+        if not os.listdir(target) and not prefix:
+            raise NothingProducedError("Operation completed but target "
+                "folder is empty for %s" % target)
+        _dedup(dedup, target, stats)
+    except BaseException:
+        shutil.rmtree(target, ignore_errors=True)
+        raise
 
+    stats.info['planned'] = True
+    return target
+
+def _run_extractor(extractor, srcFile, target, stats, member_filter,
+                   **kwargs):
+    """Run C{extractor} and make sure everything it produced is readable."""
+    stats.info['extractor'] = repr(extractor)
+    with stats.phase('extract'):
+        with stats.measure():
+            # Raises exception on non-zero exit
+            extractor(srcFile, target, member_filter, **kwargs)
+
+    # Ensure that unball can't create files and dirs with 000 permissions.
+    if not extractor.normalizes_permissions:
+        with stats.phase('permissions'):
+            normalize_permissions(target)
+
+def _dedup(dedup, tree, stats):
+    """Run the C{dedup} callable from L{tryExtract} on C{tree}, if given."""
+    if dedup:
+        with stats.phase('dedup'):
+            files, saved = dedup(tree)
+        stats.info.update(dedup_files=files, dedup_saved=saved)
+
+def _extract_staged(srcFile, targetDir, extractors, level, memory_budget,
+                    stats, store=None, dedup=None, member_filter=None,
+                    limits=None, wrapper=False):
+    """The part of L{tryExtract} which has to be retried if staging in RAM
+    was aborted by L{StagingOverflow}.
+
+    @param store: If given, called as C{store(tree, extractor)} with the
+        extractor's output before any nested archive is unpacked, returning
+        C{True} if it was cached.
+    @param dedup: See L{tryExtract}.
+    @param member_filter: See L{tryExtract}.
+    @param limits: See L{tryExtract}.
+    @param wrapper: Extract unfiltered and apply C{member_filter} only to
+        the nested archive. (See L{is_wrapper})
+    """
     prefer_contained_name = True  # TODO: Make this configurable
 
     # TODO: Unit test for proper output folder name generation
     # TODO: Make sure there's always a test file which LACKS a containing
     # folder for the files within.
-    target_name = os.path.splitext(os.path.basename(srcFile))[0]
-    context = TempTarget(os.path.join(targetDir, target_name),
-                         prefix='unball-', parent=targetDir, collapse=True)
+    context = TempTarget(os.path.join(targetDir, _target_name(srcFile)),
+                         prefix='unball-', parent=targetDir, collapse=True,
+                         memory_budget=memory_budget,
+                         output_limit=limits and limits.budget(srcFile))
 
     with context as tempTarget:
-        extractors[0](srcFile, tempTarget)  # Raises exception on non-zero exit
+        extractor = extractors[0]
+        _run_extractor(extractor, srcFile, tempTarget, stats,
+                       not wrapper and member_filter or None)
 
-        # Ensure that unball can't create files and dirs with 000 permissions.
-        for fldr, dirs, files in os.walk(tempTarget):
-            for dirname in dirs:
-                path = os.path.join(fldr, dirname)
-                os.chmod(path, os.stat(path).st_mode | S_IRUSR | S_IXUSR)
-            for filename in files:
-                path = os.path.join(fldr, filename)
-                os.chmod(path, os.stat(path).st_mode | S_IRUSR)
+        if store:
+            with stats.phase('cache'):
+                stats.info['cache'] = (store(tempTarget, extractor) and
+                                       'stored' or 'miss')
 
         contents = os.listdir(tempTarget)
-        first_contained = os.path.join(tempTarget, contents[0])
         if len(contents) == 0:
             raise NothingProducedError("Operation completed but temp "
                 "folder is empty for %s" % context.target)
-        elif (len(contents) == 1 and level < RECURSION_LIMIT and
-                os.path.isfile(first_contained)):
-                # Handle nesting like .tar.7z
+
+        first_contained = os.path.join(tempTarget, contents[0])
+        nested = (len(contents) == 1 and level < RECURSION_LIMIT and
+                  os.path.isfile(first_contained))
+        if nested:  # Handle nesting like .tar.7z
             #TODO: Should I go as far as explicitly collapsing nested
             #      containing folders?
+
+            # The filter belongs to the innermost archive, unless it's what
+            # selected this one. (Decompressors like gunzip ignore it)
+            nested_filter = member_filter
+            if member_filter and member_filter(contents[0]):
+                nested_filter = None
             try:
-                tryExtract(first_contained, None, level + 1)
+                with stats.phase('nested'):
+                    tryExtract(first_contained, None, level + 1,
+                               member_filter=nested_filter, limits=limits)
             except UnsupportedFiletypeError:
-                pass
+                nested = False
             else:
                 os.remove(first_contained)
 
+        if wrapper and not nested:
+            raise NothingProducedError("No members of %s matched the "
+                                       "filter" % srcFile)
+
         # TODO: Unit test that nested extraction doesn't break this
         contents = os.listdir(tempTarget)
         if len(contents) == 1 and prefer_contained_name:
@@ -165,6 +488,9 @@ def tryExtract(srcFile, targetDir=None, level=0):
         if srcFile == context.target:
             context.target = context.target + '.out'
 
+        _dedup(dedup, tempTarget, stats)
+
+    stats.add('publish', context.publish_seconds)
     return context.target
 
 
@@ -223,11 +549,196 @@ def get_opt_parser():
         "the current working directory)")
     parser.add_option('--strict', action="store_true", dest="strict_return",
         help="Don't return success unless all input files were archives.")
+    parser.add_option('-j', '--jobs', action="store", type="int",
+        dest="jobs", metavar="N", default=default_jobs(),
+        help="Extract up to N archives in parallel (default: %default)")
+    parser.add_option('--unordered', action="store_true", dest="unordered",
+        default=False, help="Report results as each archive finishes rather "
+        "than in the order they were given")
+    parser.add_option('--stage-in-memory', action="store", dest="stage_size",
+        metavar="SIZE", default=None, help="Stage extraction in RAM (tmpfs) "
+        "for archives expected to unpack to less than SIZE (eg. 50M), "
+        "falling back to disk if they grow larger")
+    parser.add_option('--cache', action="store", dest="cache_dir",
+        metavar="DIR", default=None, help="Reuse the output of previous "
+        "extractions of identical archives, kept in DIR")
+    parser.add_option('--cache-size', action="store", dest="cache_size",
+        metavar="SIZE", default=None, help="Evict the least recently used "
+        "entries from the --cache once it exceeds SIZE (default: 1G)")
+    parser.add_option('--cache-hardlinks', action="store_true",
+        dest="cache_hardlinks", default=False, help="Hardlink files in and "
+        "out of the --cache when reflinks aren't supported. (Outputs must "
+        "then be treated as read-only)")
+    parser.add_option('--dedup', action="store_true", dest="dedup",
+        default=False, help="Replace identical files within each extracted "
+        "tree with reflinks where the filesystem supports them")
+    parser.add_option('--dedup-hardlinks', action="store_true",
+        dest="dedup_hardlinks", default=False, help="Like --dedup but fall "
+        "back to hardlinks. (Outputs must then be treated as read-only)")
+    parser.add_option('--include', action="append", dest="include",
+        metavar="PATTERN", default=[], help="Only extract (or --list) "
+        "files whose path within the archive matches PATTERN (eg. '*.xml'). "
+        "May be given more than once")
+    parser.add_option('--exclude', action="append", dest="exclude",
+        metavar="PATTERN", default=[], help="Skip files whose path within "
+        "the archive matches PATTERN. May be given more than once")
+    parser.add_option('--max-ratio', action="store", type="float",
+        dest="max_ratio", metavar="N", default=None, help="Abort (with exit "
+        "code 8) extracting any archive which unpacks to more than N times "
+        "its own size")
+    parser.add_option('--max-output', action="store", dest="max_output",
+        metavar="SIZE", default=None, help="Abort (with exit code 8) "
+        "extracting any archive which unpacks to more than SIZE (eg. 10G)")
+    parser.add_option('--list', action="store_true", dest="list",
+        default=False, help="List each archive's members (name, size, "
+        "compressed size, and CRC) instead of extracting it")
+    parser.add_option('--stats', action="store_true", dest="stats",
+        default=False, help="Write per-phase timings and resource usage for "
+        "each archive to stderr as JSON lines, followed by a summary")
+    parser.add_option('--serve', action="store", dest="serve",
+        metavar="SOCKET", default=None, help="Run as a daemon, accepting "
+        "extraction requests on the Unix socket SOCKET with --jobs workers")
+    parser.add_option('--queue-depth', action="store", type="int",
+        dest="queue_depth", metavar="N", default=None, help="With --serve, "
+        "make clients wait once N archives are queued or in progress "
+        "(default: twice --jobs)")
+    parser.add_option('--connect', action="store", dest="connect",
+        metavar="SOCKET", default=None, help="Send the archives to the "
+        "daemon listening on SOCKET rather than extracting them directly")
+    parser.add_option('--watch', action="store", dest="watch",
+        metavar="DIR", default=None, help="Extract files as they finish "
+        "arriving in DIR (and any not already processed) until interrupted")
     parser.add_option("--self-test", action="store_true", dest="self_test",
         help="Test the referential integrity of the filetype lookup tables.")
 
     return parser
 
+def summarize_stats(records, top=5):
+    """Build a human-readable summary of the slowest archives and phases
+    from L{ExtractionResult.stats<unball.api.ExtractionResult>} records.
+
+    @rtype: C{list} of C{str}
+    """
+    lines = ["Slowest archives:"]
+    for record in sorted(records, key=lambda x: -x['total'])[:top]:
+        phase, seconds = max(record['phases'].items() or [('-', 0)],
+                             key=lambda x: x[1])
+        lines.append("  %8.3fs  %s (mostly %s: %.3fs)" % (
+            record['total'], record['archive'], phase, seconds))
+
+    totals = {}
+    for record in records:
+        for phase, seconds in record['phases'].items():
+            totals[phase] = totals.get(phase, 0) + seconds
+    overall = sum(totals.values()) or 1e-9
+    lines.append("Time by phase:")
+    for phase, seconds in sorted(totals.items(), key=lambda x: -x[1]):
+        lines.append("  %8.3fs  %5.1f%%  %s" % (seconds,
+                     seconds * 100 / overall, phase))
+
+    saved = sum(x.get('dedup_saved', 0) for x in records)
+    if saved:
+        lines.append("Dedup: %d file(s) replaced, %d bytes saved" % (
+            sum(x.get('dedup_files', 0) for x in records), saved))
+
+    cached = [x['cache'] for x in records if 'cache' in x]
+    if cached:
+        lines.append("Cache: %d hit(s), %d stored, of %d" % (
+            cached.count('hit'), cached.count('stored'), len(cached)))
+    return lines
+
+def report_dedup(result):
+    """Print the savings from C{--dedup} for an L{ExtractionResult}, if any.
+    """
+    if result.stats.get('dedup_saved'):
+        print("  Replaced %d identical file(s), saving %d bytes" % (
+            result.stats['dedup_files'], result.stats['dedup_saved']))
+
+def list_archives(paths, member_filter=None):
+    """Print the members of each archive in C{paths}, using the default
+    L{ListingIndex<unball.listing.ListingIndex>} if it's available.
+
+    @param member_filter: If given, only list the files it selects.
+
+    @return: An exit code for C{sys.exit}
+    """
+    from .listing import ListingIndex, list_archive
+    try:
+        index = ListingIndex()
+    except (ImportError, IOError, OSError):
+        index = None  # The index is purely an optimization
+
+    unknown = lambda value, fmt='%d': value is None and '-' or fmt % value
+    errcode = 0
+    for path in paths:
+        try:
+            members = list_archive(path, index)
+            if member_filter:
+                members = [x for x in members if not x.name.endswith('/')
+                           and member_filter(x.name)]
+        except UnsupportedFiletypeError as err:
+            print("%s\n" % err)
+            errcode = errcode or 4
+            continue
+        except (IOError, OSError) as err:
+            print("Could not list %s: %s\n" % (path, err))
+            errcode = 2
+            continue
+
+        print("%s:" % path)
+        print("%12s %12s %8s  %s" % ('Size', 'Packed', 'CRC', 'Name'))
+        for member in members:
+            print("%12s %12s %8s  %s" % (unknown(member.size),
+                  unknown(member.compressed), unknown(member.crc, '%s'),
+                  member.name))
+        print("%d member(s), %d bytes\n" % (len(members),
+              sum(x.size or 0 for x in members)))
+
+    if index:
+        index.close()
+    return errcode
+
+def watch_dir(directory, target, options):
+    """Run L{unball.watch.watch}, reporting each result as it happens.
+
+    @return: An exit code for C{sys.exit}
+    """
+    from .watch import watch
+    try:
+        for result in watch(directory, target, options):
+            if result.ok:
+                print("Extracted to %s" % result.target)
+                report_dedup(result)
+            elif result.errcode == 0:
+                print("Not an archive: %s" % result.source)
+            else:
+                print("Could not extract %s: %s" % (result.source,
+                                                    result.message))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    except OSError as err:
+        print("FATAL: %s" % err)
+        return 1
+    return 0
+
+def default_jobs():
+    """Return the default size for the C{--jobs} worker pool.
+
+    Asks C{sysconf} directly where possible because this runs even for
+    C{--help} and C{--version} and C{multiprocessing} is slow to import.
+    """
+    try:
+        return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (AttributeError, ValueError, OSError):
+        pass
+
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
 def main():
     """The main entry point... in a form setup.py can reference."""
     parser = get_opt_parser()
@@ -238,51 +749,112 @@ def main():
             print("\nNo inconsistencies found")
         parser.exit()
 
-    if not len(args):
+    if opts.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    options = {}
+    if opts.stage_size:
+        try:
+            options['memory_budget'] = parse_size(opts.stage_size)
+        except ValueError:
+            parser.error("Invalid --stage-in-memory size: %s" %
+                         opts.stage_size)
+
+    if opts.cache_dir:
+        from .cache import DEFAULT_LIMIT, ExtractionCache
+        try:
+            limit = opts.cache_size and parse_size(opts.cache_size)
+        except ValueError:
+            parser.error("Invalid --cache-size: %s" % opts.cache_size)
+        options['cache'] = ExtractionCache(opts.cache_dir,
+                                           limit or DEFAULT_LIMIT,
+                                           opts.cache_hardlinks)
+
+    if opts.include or opts.exclude:
+        options['member_filter'] = MemberFilter(opts.include, opts.exclude)
+
+    if opts.max_ratio is not None and opts.max_ratio <= 0:
+        parser.error("--max-ratio must be positive")
+    if opts.max_ratio or opts.max_output:
+        try:
+            size = opts.max_output and parse_size(opts.max_output)
+        except ValueError:
+            parser.error("Invalid --max-output size: %s" % opts.max_output)
+        options['limits'] = OutputLimits(opts.max_ratio, size)
+
+    if opts.dedup or opts.dedup_hardlinks:
+        from .dedup import Deduplicator
+        options['dedup'] = Deduplicator(opts.dedup_hardlinks)
+
+    if opts.serve:
+        from .server import serve
+        if (opts.queue_depth or 1) < 1:
+            parser.error("--queue-depth must be at least 1")
+        serve(opts.serve, opts.jobs, opts.queue_depth, options)
+        parser.exit()
+
+    if not (args or opts.watch):
         parser.print_help()
         parser.exit(errno.ENOENT)  # Apparently it's standard to use ENOENT.
 
+    if opts.list:
+        sys.exit(list_archives(args, options.get('member_filter')))
+
     if opts.outdir and not os.access(opts.outdir, os.W_OK):
         print("FATAL: No write permissions for given destination directory")
         parser.exit(errno.EPERM)
 
-    failures, cautions = [], []
+    if opts.watch:
+        sys.exit(watch_dir(opts.watch, opts.outdir or None, options))
+
+    remote_errors = ()
+    if opts.connect:
+        if set(options) - set(['memory_budget']):
+            parser.error("--cache, --dedup, --include, --exclude, and "
+                         "--max-* must be given to the --serve daemon")
+        from socket import error as socket_error
+        from .server import ServerError, submit
+        remote_errors = (socket_error, ServerError)
+        results = submit(opts.connect, args, opts.outdir,
+                         ordered=not opts.unordered, **options)
+    else:
+        from .api import extract_many
+        results = extract_many(args, opts.outdir, jobs=opts.jobs,
+                               ordered=not opts.unordered, **options)
+
+    failures, cautions, records = [], [], []
     last_errcode = 0
-    for archive in args:
-        try:
-            print("Extracted to %s" % tryExtract(archive, opts.outdir))
-            #TODO: Do this in a way which produces nicer output.
-        except UnsupportedFiletypeError as err:
-            cautions.append(archive)
-        except NothingProducedError as err:  # Bug trap triggered
-            failures.append(str(err))
-            last_errcode = 1
-        except IOError as err:  # Permissions error
-            failures.append(str(err))
-            last_errcode = 2
-        except OSError as err:  # Path error (eg. target exists or not a dir)
-            failures.append(str(err))
-            last_errcode = 3
-        except NoExtractorError as err:  # Could not find suitable extractor
-            failures.append(str(err))
-            last_errcode = 4
-        except subprocess.CalledProcessError as err:  # Extractor failed
-            if err.returncode >= 0:
-                failures.append(str(err))
-                last_errcode = 5
-            else:
-                last_errcode = 6
+    try:
+        for result in results:
+            if opts.stats:
+                record = dict(result.stats, archive=result.source,
+                              target=result.target, errcode=result.errcode)
+                sys.stderr.write(json.dumps(record, sort_keys=True) + '\n')
+                records.append(record)
+
+            if result.ok:
+                print("Extracted to %s" % result.target)
+                report_dedup(result)
+                #TODO: Do this in a way which produces nicer output.
+            elif result.errcode == 0:
+                cautions.append(result.source)
+            elif result.errcode == 6:  # Extractor killed by a signal
+                last_errcode = result.errcode
                 break
-        except Exception as err:   # Unknown error
-            failures.append(str(err))
-            last_errcode = 7
+            else:
+                failures.append(result.message)
+                last_errcode = result.errcode
+    except remote_errors as err:
+        print("FATAL: Could not talk to %s: %s" % (opts.connect, err))
+        sys.exit(errno.ECONNREFUSED)
+    finally:
+        results.close()
 
     if failures:
         print('')
         print("Unball encountered errors while extracting one or more files:")
         print('\t' + '\n\t'.join(failures))
         print('')
-        raise
 
     if cautions:
         print("One or more provided files were not recognized as archives. ")
@@ -290,6 +862,9 @@ def main():
               "http://launchpad.net/unball so support can be added.")
         print(' - ' + '\n - '.join(cautions))
 
+    if records:
+        sys.stderr.write('\n'.join(summarize_stats(records)) + '\n')
+
     if failures or (cautions and opts.strict_return):
         sys.exit(last_errcode or 1)
 
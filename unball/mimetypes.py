@@ -1,8 +1,9 @@
 """Mimetype lookup helpers
 
-@todo: Use the following to set up an internal header matcher:
-    - http://www.fileformat.info/format/arc/corion.htm
-    - http://www.fileformat.info/format/zoo/corion.htm
+Header detection is done in-process by L{sniffMimetype} using the
+L{SIGNATURES} table. libmagic (via python-magic) or the C{file} command are
+only consulted for files it doesn't recognize.
+
 @todo: Fix this so it handles "one ext to multiple mimetypes" mappings properly
 @todo: The extension checker needs to be rewritten to support *.??_
 (Oh, and what does compress.exe do with extensions longer than 3 characters?)
@@ -27,67 +28,327 @@
 __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2.0 or later"
 
-import errno, os
-
-try:
-    import magic
-    mime_checker = magic.open(magic.MAGIC_MIME)
-    mime_checker.load()
-
-    def headerToMimetype(path, checker=mime_checker.file):
-        """Given a path, attempt to determine the file's mimetype by examining
-        the file's contents.
-
-        @param checker: Ignore this. Only present if "import magic" succeeded.
-        @param path: The path to the file to be inspected.
-        @type path: C{str}
-
-        @return: Mimetype of the file or application/octet-stream on failure.
-        @rtype: C{str}
-        @raises IOError: The file does not exist or cannot be read.
-
-        @todo: Polish this code and copy it to nonstdlib.
-        """
-        if not os.path.exists(path):
-            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
-        elif not os.access(path, os.R_OK):
-            raise IOError(errno.EACCES, os.strerror(errno.EACCES), path)
-        else:
-            mime = checker(path).decode('string_escape').split()[0]
-
-            # TODO: Unit test this. IF nothing else, ';' is needed for
-            # arctest.header on Ubuntu 12.04 LTS.
-            mime = mime.rstrip(',; \t\n')
-            return mime
-
-    del mime_checker
-except ImportError:  # TODO: Can magic.open or mime_checker.load() fail?
-    import subprocess
-
-    def headerToMimetype(path):
-        """Given a path, attempt to determine the file's mimetype by examining
-        the file's contents.
-
-        @param path: The path to the file to be inspected.
-        @type path: C{str}
-        @return: Mimetype of the file or application/octet-stream on failure.
-        @rtype: C{str}
-
-        @todo: When can the C{file} command return non-zero error codes?
-        @todo: Polish this code and copy it to nonstdlib.
-        """
-        # TODO: Implement a completely internal version of this.
-        # (And implement detection of COMPRESS.EXE files
-        #  http://www.cabextract.org.uk/libmspack/doc/szdd_kwaj_format.html)
+import binascii, errno, mmap, os, re, struct
+
+#{ Built-in header matching
+
+SNIFF_SIZE = 32774
+"""How many bytes L{sniffMimetype} reads from the start of a file. (Enough to
+reach the ISO9660 volume descriptor at offset 32769)"""
+
+TRAILER_SIZE = 65557
+"""How many bytes L{sniffMimetype} may read from the end of a file.
+(A zip end-of-central-directory record plus the longest possible comment)"""
+
+def _is_arc(buf, size):
+    """Validate an ARC/PAK member header. (0x1A, method, NUL-terminated name)
+    See http://www.fileformat.info/format/arc/corion.htm"""
+    if len(buf) < 29 or not 1 <= ord(buf[1:2]) <= 0x14:
+        return False
+    name = buf[2:15].split(b'\0', 1)
+    return (len(name) == 2 and bool(name[0]) and
+            all(32 < ord(name[0][x:x + 1]) < 127
+                for x in range(len(name[0]))))
+
+def _is_arj(buf, size):
+    """Validate the basic header size of an ARJ archive."""
+    return len(buf) > 4 and 0 < struct.unpack('<H', buf[2:4])[0] <= 2600
+
+def _is_arj_crc(buf, size):
+    """Validate an ARJ main header by its CRC32. (C{\\x60\\xea} alone is too
+    common in executable code to trust when scanning a whole file)"""
+    if not _is_arj(buf, size):
+        return False
+    length = struct.unpack('<H', buf[2:4])[0]
+    stored = buf[4 + length:8 + length]
+    return (len(stored) == 4 and struct.unpack('<I', stored)[0] ==
+            binascii.crc32(buf[4:4 + length]) & 0xffffffff)
+
+def _is_lzh(buf, size):
+    """Validate an LHA/LZH member header by its level and (for levels 0 and
+    1) its checksum byte."""
+    if len(buf) < 22 or buf[6:7] != b'-' or buf[20:21] not in b'\0\1\2':
+        return False
+    if buf[20:21] == b'\2':
+        return True
+    header = bytearray(buf[:2 + ord(buf[0:1])])
+    return len(header) > 2 and sum(header[2:]) & 0xff == header[1]
+
+def _is_zip_local(buf, size):
+    """Validate a zip local file header's version, compression method and
+    name length. (Zip tools contain C{PK\\x03\\x04} as a constant)"""
+    if len(buf) < 30:
+        return False
+    version, method = struct.unpack('<H2xH', buf[4:10])
+    name_len = struct.unpack('<H', buf[26:28])[0]
+    return (version < 100 and 0 < name_len < 1024 and
+            method in (0, 1, 6, 8, 9, 12, 14, 93, 95, 98, 99))
+
+def _is_bzip2(buf, size):
+    """Require a block size digit and the magic of the first block (or of
+    the end of an empty stream) after C{BZh}, which is too short to trust
+    on its own. (eg. A tarball whose first member is C{BZh/})"""
+    return (buf[3:4] in (b'1', b'2', b'3', b'4', b'5', b'6', b'7', b'8',
+                         b'9') and
+            buf[4:10] in (b'1AY&SY', b'\x17\x72\x45\x38\x50\x90'))
+
+def _is_mz(buf, size):
+    """Sanity-check a DOS executable header, since C{MZ} alone is too short
+    to trust. (eg. A tarball whose first member is C{MZmine-2.5/})
+
+    Accepts a PE/NE/LE/LX header where C{e_lfanew} points or a DOS header
+    whose page and paragraph counts fit within the file."""
+    if len(buf) < 64:
+        return False
+    last_page, pages, _, paragraphs = struct.unpack('<4H', buf[2:10])
+    new_header = struct.unpack('<I', buf[60:64])[0]
+    if buf[new_header:new_header + 2] in (b'PE', b'NE', b'LE', b'LX'):
+        return True
+    image = (pages - 1) * 512 + (last_page or 512)
+    return (last_page < 512 and pages > 0 and image <= size and
+            2 <= paragraphs and paragraphs * 16 <= image)
+
+def _is_tar(buf, size):
+    """Validate a tar header by its checksum so pre-POSIX archives (which
+    lack the C{ustar} magic) are still recognized."""
+    if len(buf) < 512 or buf[:1] == b'\0':
+        return False
+    try:
+        stored = int(buf[148:156].replace(b'\0', b' ').strip() or '-1', 8)
+    except ValueError:
+        return False
+    header = bytearray(buf[:148] + b' ' * 8 + buf[156:512])
+    return stored == sum(header)
+
+def isTarHeader(block):
+    """Check whether C{block} (the first 512 bytes of a stream) looks like
+    the start of a tar archive.
+
+    @type block: C{str}
+    @rtype: C{bool}
+    """
+    return block[257:262] == b'ustar' or _is_tar(block, None)
+
+def _is_adf(buf, size):
+    """Amiga floppy images are only recognizable by their exact size."""
+    return size in (901120, 1802240)
+
+def _is_uuencode(buf, size):
+    """Tell uuencoded data from xxencoded data by the length character of the
+    first line after the C{begin} line. (C{M} vs. C{h} for full lines)"""
+    match = _UU_BEGIN_RE.search(buf)
+    if not match:
+        return None
+    nextline = buf[match.end():match.end() + 1]
+    return nextline == b'h' and 'application/x-xx-encoded' or \
+        'application/x-uuencode'
+
+_UU_BEGIN_RE = re.compile(br'^begin [0-7]{3,4} [^\r\n]+\r?\n', re.M)
+
+def _matches(buf, size, offset, magic, validator):
+    """Apply a single L{SIGNATURES} entry to a buffer."""
+    if not buf.startswith(magic, offset):
+        return False
+    return validator is None or validator(buf[offset:], size)
+
+def _compile(signatures):
+    """Index L{SIGNATURES} by offset and first magic byte so only a handful
+    of entries need to be examined for any given file."""
+    index = {}
+    for offset, magic, mime, validator in signatures:
+        index.setdefault(offset, {}).setdefault(magic[:1], []).append(
+            (magic, mime, validator))
+    return sorted(index.items())
+
+def _read_at(fd, length, offset):
+    """Read up to C{length} bytes at C{offset} in a single call."""
+    pread = getattr(os, 'pread', None)
+    if pread:
+        return pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+def sniffMimetype(path):
+    """Identify a file by comparing its first (and, where needed, last) bytes
+    against the built-in L{SIGNATURES} table.
+
+    Files of up to C{SNIFF_SIZE + TRAILER_SIZE} bytes are read whole with a
+    single C{pread}. Larger ones only need a second read for the trailer if
+    their header isn't recognized.
+
+    @param path: The path to the file to be inspected.
+    @type path: C{str}
+
+    @return: The mimetype or C{None} if nothing matched.
+    @rtype: C{str}
+    @raises OSError: The file cannot be opened or read.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        whole = size <= SNIFF_SIZE + TRAILER_SIZE
+        data = _read_at(fd, whole and size or SNIFF_SIZE, 0)
+        buf = data[:SNIFF_SIZE]
+
+        if _is_tar(buf, size):  # Checksummed, unlike short magic numbers
+            return 'application/x-tar'
+
+        mime = None
+        for offset, by_byte in _SIG_INDEX:
+            candidates = by_byte.get(buf[offset:offset + 1], []) + \
+                    by_byte.get(b'', [])
+            for magic, candidate, validator in candidates:
+                if _matches(buf, size, offset, magic, validator):
+                    mime = candidate
+                    break
+            if mime:
+                break
+
+        if mime is None:
+            for pattern, candidate in TEXT_SIGNATURES:
+                found = pattern.search(buf)
+                if found:
+                    mime = callable(candidate) and candidate(buf, size) \
+                            or candidate
+                    break
+
+        # Self-extracting zips and zips with prepended junk are only
+        # recognizable by the end of central directory record.
+        if mime in (None, 'application/x-dosexec'):
+            if whole:
+                tail = data
+            else:
+                tail = _read_at(fd, TRAILER_SIZE, size - TRAILER_SIZE)
+            if b'PK\x05\x06' in tail[-TRAILER_SIZE:]:
+                mime = 'application/zip'
+        return mime
+    finally:
+        os.close(fd)
+
+#}
+#{ Embedded payload detection
 
+PAYLOAD_WINDOW = 4096
+"""How many bytes from the start of a candidate payload are passed to the
+validators in L{PAYLOAD_SIGNATURES}."""
+
+def findPayloads(path, mimes=None):
+    """Scan a file (usually a self-extracting executable) for embedded
+    archives without running any extractors.
+
+    @param mimes: If provided, only look for these mimetypes.
+    @return: A list of C{(offset, mimetype)} tuples, sorted by offset, for
+        the first valid occurrence of each mimetype.
+    """
+    with open(path, 'rb') as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        if not size:
+            return []
+        data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        found = {}
+        for magic, skip, mime, validator in PAYLOAD_SIGNATURES:
+            if mime in found or (mimes is not None and mime not in mimes):
+                continue
+            pos = data.find(magic, skip)
+            while pos != -1:
+                start = pos - skip
+                if not validator or validator(
+                        data[start:start + PAYLOAD_WINDOW], size - start):
+                    found[mime] = start
+                    break
+                pos = data.find(magic, pos + 1)
+
+        # As in sniffMimetype, a zip may only be identifiable by its trailer
+        if 'application/zip' not in found and (mimes is None or
+                'application/zip' in mimes):
+            if data.find(b'PK\x05\x06', max(0, size - TRAILER_SIZE)) != -1:
+                found['application/zip'] = max(0, data.find(b'PK\x03\x04'))
+        return sorted((offset, mime) for mime, offset in found.items())
+    finally:
+        data.close()
+
+#}
+#{ Header matching via libmagic or file(1)
+
+_magic_checker = None
+
+def load_magic():
+    """Open and load the libmagic database, if python-magic is installed.
+
+    This is deferred until a file actually needs it, since loading the
+    database dominates start-up time and L{sniffMimetype} recognizes most
+    archives on its own. Long-running callers may call it up front so
+    worker processes inherit the loaded handle.
+
+    @return: The loaded C{magic.Magic} handle or C{False} if unavailable.
+    """
+    global _magic_checker
+    if _magic_checker is None:
+        try:
+            import magic
+            _magic_checker = magic.open(magic.MAGIC_MIME)
+            _magic_checker.load()
+        except (ImportError, AttributeError, EnvironmentError):
+            _magic_checker = False
+    return _magic_checker
+
+def magicToMimetype(path):
+    """Given a path, attempt to determine the file's mimetype using
+    libmagic or, if that isn't available, the C{file} command.
+
+    @param path: The path to the file to be inspected.
+    @type path: C{str}
+
+    @return: Mimetype of the file or application/octet-stream on failure.
+    @rtype: C{str}
+
+    @todo: When can the C{file} command return non-zero error codes?
+    """
+    checker = load_magic()
+    if checker:
+        mime = checker.file(path).decode('string_escape').split()[0]
+    else:
+        import subprocess
         _sp, _cmd = subprocess, ['file', '-bi', path]
         try:
             mime = _sp.Popen(_cmd, stdout=_sp.PIPE).stdout.read().strip()
             mime = mime.decode('string_escape').split()[0].rstrip(',')
-        except OSError:
+        except (OSError, IndexError):
             mime = 'application/octet-stream'
-        mime = mime.rstrip(',; \t\n')
-        return mime
+
+    # TODO: Unit test this. IF nothing else, ';' is needed for
+    # arctest.header on Ubuntu 12.04 LTS.
+    return mime.rstrip(',; \t\n')
+
+#}
+
+def headerToMimetype(path):
+    """Given a path, attempt to determine the file's mimetype by examining
+    the file's contents.
+
+    Tries the built-in L{sniffMimetype} first and only falls back to
+    libmagic or the C{file} command for unrecognized files.
+
+    @param path: The path to the file to be inspected.
+    @type path: C{str}
+
+    @return: Mimetype of the file or application/octet-stream on failure.
+    @rtype: C{str}
+    @raises IOError: The file does not exist or cannot be read.
+
+    @todo: Polish this code and copy it to nonstdlib.
+    """
+    if not os.path.exists(path):
+        raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    elif not os.access(path, os.R_OK):
+        raise IOError(errno.EACCES, os.strerror(errno.EACCES), path)
+
+    try:
+        mime = sniffMimetype(path)
+    except OSError as err:
+        raise IOError(err.errno, err.strerror, path)
+    return mime or magicToMimetype(path)
 
 def pathToMimetype(path, desired_types=None):
     """Given a path, identify the mimetype (tries L{headerToMimetype}, falls
@@ -184,3 +445,90 @@ EXTENSIONS = {
         '.zip': 'application/zip',
         '.zoo': 'application/x-zoo',
 }
+
+SIGNATURES = [
+        (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed', None),
+        (0, b'!<arch>\ndebian-binary', 'application/x-deb', None),
+        (0, b'!<arch>\n', 'application/x-ar', None),
+        (0, b'\x1a', 'application/x-arc', _is_arc),
+        (0, b'\x60\xea', 'application/arj', _is_arj),
+        (0, b'ALZ\x01', 'application/x-alz', None),
+        (0, b'BZh', 'application/bzip2', _is_bzip2),
+        (0, b'DMS!', 'application/x-diskmasher', None),
+        (0, b'DOS', 'application/x-adf', _is_adf),
+        (0, b'KWAJ\x88\xf0\x27\xd1', 'application/x-ms-compress-kwaj', None),
+        (0, b'LZX', 'application/lzx', None),
+        (0, b'MSCF\0\0\0\0', 'application/cab', None),
+        (0, b'MZ', 'application/x-dosexec', _is_mz),
+        (0, b'PK\x03\x04', 'application/zip', None),
+        (0, b'PK\x05\x06', 'application/zip', None),
+        (0, b'PK\x07\x08', 'application/zip', None),
+        (0, b'RZIP', 'application/x-rzip', None),
+        (0, b'Rar!\x1a\x07\x00', 'application/x-rar', None),
+        (0, b'Rar!\x1a\x07\x01\x00', 'application/x-rar', None),
+        (0, b'SIT!', 'application/x-stuffit', None),
+        (0, b'StuffIt (c)1997', 'application/x-stuffit', None),
+        (0, b'StuffIt!', 'application/x-stuffitx', None),
+        (0, b'SZ \x88\xf0\x27\x33\xd1', 'application/x-ms-compress-szdd',
+            None),
+        (0, b'SZDD\x88\xf0\x27\x33', 'application/x-ms-compress-szdd', None),
+        (0, b'ZOO ', 'application/x-zoo',
+            lambda buf, size: buf[20:24] == b'\xdc\xa7\xc4\xfd'),
+        (0, b'\x1f\x8b', 'application/x-gzip', None),
+        (0, b'\x1f\x9d', 'application/x-compress', None),
+        (0, b'070701', 'application/x-cpio', None),
+        (0, b'070702', 'application/x-cpio', None),
+        (0, b'070707', 'application/x-cpio', None),
+        (0, b'\xc7\x71', 'application/x-cpio', None),
+        (0, b'\x71\xc7', 'application/x-cpio', None),
+        (0, b'\x89LZO\x00\r\n\x1a\n', 'application/x-lzop', None),
+        (0, b'\xed\xab\xee\xdb', 'application/x-rpm', None),
+        (0, b'xar!', 'application/x-xar', None),
+        (2, b'-lh', 'application/lzh',
+            lambda buf, size: buf[4:5] == b'-'),
+        (2, b'-lz', 'application/lzh',
+            lambda buf, size: buf[4:5] == b'-'),
+        (7, b'**ACE**', 'application/x-ace-compressed', None),
+        (7, b'-sqx-', 'application/x-squeeze', None),
+        (257, b'ustar', 'application/x-tar', None),
+        (32769, b'CD001', 'application/x-iso9660-image', None),
+]
+"""Binary signatures as C{(offset, magic, mimetype, validator)} tuples.
+
+C{validator}, if not C{None}, is called as C{validator(buf, size)} with the
+buffer starting at C{offset} and the file's size to weed out false positives
+for short or ambiguous magic numbers.
+
+@note: Order is significant within each offset. (eg. C{.deb} before C{ar})
+    Lower offsets are tried first, but L{sniffMimetype} checks for a tar
+    header which passes its checksum (which covers pre-POSIX tarballs)
+    before any of them, since a member name can start with anything.
+"""
+
+TEXT_SIGNATURES = [
+        (re.compile(br'\(This file must be converted with BinHex'),
+            'application/mac-binhex40'),
+        (re.compile(br'^=ybegin ', re.M), 'application/x-yenc-encoded'),
+        (_UU_BEGIN_RE, _is_uuencode),
+        (re.compile(br'^Content-Transfer-Encoding:\s*base64', re.M | re.I),
+            'application/mime'),
+]
+"""Signatures for text-based encodings which may be preceded by arbitrary
+text such as e-mail headers. Searched only if L{SIGNATURES} found nothing."""
+
+PAYLOAD_SIGNATURES = [
+        (b'PK\x03\x04', 0, 'application/zip', _is_zip_local),
+        (b'Rar!\x1a\x07\x00', 0, 'application/x-rar', None),
+        (b'Rar!\x1a\x07\x01\x00', 0, 'application/x-rar', None),
+        (b'\x60\xea', 0, 'application/arj', _is_arj_crc),
+        (b'7z\xbc\xaf\x27\x1c', 0, 'application/x-7z-compressed', None),
+        (b'-lh', 2, 'application/lzh', _is_lzh),
+        (b'-lz', 2, 'application/lzh', _is_lzh),
+        (b'**ACE**', 7, 'application/x-ace-compressed', None),
+]
+"""Signatures for archives embedded in self-extractors as C{(magic, skip,
+mimetype, validator)} tuples, where C{skip} is the offset of C{magic} within
+the archive header. Validators are called as in L{SIGNATURES}, with the buffer
+starting at the header. Used by L{findPayloads}."""
+
+_SIG_INDEX = _compile(SIGNATURES)
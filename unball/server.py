@@ -0,0 +1,329 @@
+"""A persistent extraction daemon and its client, for callers which can't
+import L{unball.api} (eg. shell scripts) but still want to avoid paying
+interpreter start-up and table loading for every archive.
+
+The protocol is line-delimited JSON over a Unix socket. The client sends a
+single request line::
+
+    {"paths": ["/abs/a.zip", ...], "target": "/abs/out",
+     "memory_budget": null, "ordered": true}
+
+and the server replies with a C{{"result": ...}} line per archive (holding
+L{ExtractionResult.as_dict}) as it completes, followed by C{{"done": N}}.
+A bad request gets a single C{{"error": "..."}} line instead.
+
+All connections share one worker pool and at most C{queue_depth} archives may
+be queued or running at once. Further requests simply wait to be accepted,
+which propagates back-pressure to the clients.
+
+@note: Anyone who can connect to the socket can extract into any directory
+    the daemon can write to, so it is created with mode C{0600}.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import errno, itertools, json, multiprocessing, os, signal, socket, sys
+import threading, time
+
+try:
+    import SocketServer as socketserver
+    from Queue import Queue
+except ImportError:  # Python 3.x
+    import socketserver
+    from queue import Queue
+
+from .api import ExtractionResult, _error_result, _extract_one, preload
+from .util import UnballError
+
+QUEUE_FACTOR = 2  #: Default queue depth, as a multiple of the pool size
+WATCH_INTERVAL = 1.0  #: Seconds between checks for lost jobs
+
+class ServerError(UnballError):
+    """The daemon rejected a request or went away before finishing it."""
+
+class WorkerLost(UnballError):
+    """The worker process running a job died without returning a result."""
+
+#{ Server
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Run one extraction request, streaming results back as JSON lines."""
+    cancelled = False
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:  # eg. L{_claim_socket} checking for a live daemon
+            return
+
+        try:
+            request = json.loads(line.decode('utf-8'))
+            paths, target = request['paths'], request.get('target')
+            for path in paths + [target or '/']:
+                if not os.path.isabs(path):
+                    raise ValueError("Paths must be absolute: %s" % path)
+            options = dict(self.server.options)
+            if request.get('memory_budget'):
+                options['memory_budget'] = int(request['memory_budget'])
+        except KeyError as err:
+            return self.send({'error': "Bad request: missing %s" %
+                              err.args[0]})
+        except (ValueError, TypeError, AttributeError) as err:
+            return self.send({'error': "Bad request: %s" % err})
+
+        results = Queue()
+        feeder = threading.Thread(target=self.feed,
+                                  args=(paths, target, options, results.put))
+        feeder.daemon = True
+        feeder.start()
+
+        buffered, next_index = {}, 0
+        try:
+            for _ in paths:
+                index, result = results.get()
+                if not request.get('ordered', True):
+                    self.send({'result': result.as_dict()})
+                    continue
+
+                buffered[index] = result
+                while next_index in buffered:
+                    result = buffered.pop(next_index)
+                    self.send({'result': result.as_dict()})
+                    next_index += 1
+            self.send({'done': len(paths)})
+        except socket.error:  # Client went away. Don't start the rest.
+            self.cancelled = True
+
+    def feed(self, paths, target, options, put):
+        """Submit jobs to the shared pool, blocking while it's full."""
+        for index, path in enumerate(paths):
+            if self.cancelled:
+                break
+            self.server.submit((path, target, options),
+                               lambda result, index=index: put((index,
+                                                                result)))
+
+    def finish(self):
+        try:
+            socketserver.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass  # Client already gone
+
+    def send(self, obj):
+        self.wfile.write((json.dumps(obj) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+class ExtractionServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """A Unix socket server which feeds requests to a shared, bounded
+    C{multiprocessing.Pool} with a warm dispatch table.
+
+    @param path: The path at which to create the socket. A stale socket
+        left behind by a previous daemon will be replaced.
+    @param jobs: The number of worker processes.
+    @param queue_depth: The maximum number of archives queued or in progress
+        at once across all connections. (Default: C{jobs * QUEUE_FACTOR})
+    @param options: Default L{tryExtract} arguments for every request.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, jobs=1, queue_depth=None, options=None):
+        preload()  # Before forking, so workers inherit it
+        self.options = options or {}
+        self.slots = threading.BoundedSemaphore(
+            queue_depth or jobs * QUEUE_FACTOR)
+        self.pending = {}  #: Job ID -> L{_PendingJob} for outstanding jobs
+        self.pending_lock = threading.Lock()
+        self.job_ids = itertools.count()
+        self.closed = False
+
+        # (Not a Queue, whose feeder thread could lose a report if the
+        # worker died right after making it)
+        self.started, started = multiprocessing.Pipe(duplex=False)
+        self.pool = multiprocessing.Pool(jobs, _init_worker,
+                                         (started, multiprocessing.Lock()))
+
+        try:
+            _claim_socket(path)
+            socketserver.UnixStreamServer.__init__(self, path,
+                                                   RequestHandler)
+            os.chmod(path, 0o600)
+        except:
+            self.pool.terminate()
+            raise
+
+        watcher = threading.Thread(target=self.watch_jobs)
+        watcher.daemon = True
+        watcher.start()
+
+    def submit(self, job, callback):
+        """Queue a job for L{_extract_one}, blocking while C{queue_depth}
+        jobs are already outstanding, and pass its L{ExtractionResult} to
+        C{callback} when done.
+
+        The slot is released and C{callback} called exactly once, with an
+        error result if the job couldn't be queued or its worker failed.
+        (See L{watch_jobs})
+        """
+        self.slots.acquire()
+        job_id, pending = next(self.job_ids), _PendingJob(job, callback)
+        with self.pending_lock:
+            self.pending[job_id] = pending
+        try:
+            pending.result = self.pool.apply_async(_run_job, (job_id, job),
+                callback=lambda result: self.finish_job(*result))
+        except Exception as err:  # eg. The pool was already terminated
+            self.finish_job(job_id, _error_result(job[0], err))
+
+    def finish_job(self, job_id, result):
+        """Release the slot held by job C{job_id} and report C{result} to
+        its callback, unless that has already happened."""
+        with self.pending_lock:
+            pending = self.pending.pop(job_id, None)
+        if pending:
+            self.slots.release()
+            pending.callback(result)
+
+    def watch_jobs(self):
+        """Fail jobs which will never call back on their own.
+
+        Python 2's C{Pool.apply_async} has no C{error_callback}, and no
+        version reports a task whose worker died (eg. killed by the OOM
+        killer), so poll for both rather than leaking the job's slot and
+        leaving its client waiting forever.
+        """
+        next_check = time.time() + WATCH_INTERVAL
+        while not self.closed:
+            if self.started.poll(max(0, next_check - time.time())):
+                job_id, pid = self.started.recv()
+                with self.pending_lock:
+                    if job_id in self.pending:
+                        self.pending[job_id].pid = pid
+                if time.time() < next_check:
+                    continue
+            next_check = time.time() + WATCH_INTERVAL
+
+            with self.pending_lock:
+                pending = list(self.pending.items())
+            for job_id, job in pending:
+                if job.result and job.result.ready():
+                    try:
+                        job.result.get(0)
+                    except Exception as err:  # eg. An unpicklable result
+                        self.finish_job(job_id,
+                                        _error_result(job.job[0], err))
+                elif job.pid and not _is_alive(job.pid):
+                    self.finish_job(job_id, _error_result(job.job[0],
+                        WorkerLost("Worker process %d died while extracting "
+                                   "%s" % (job.pid, job.job[0]))))
+
+    def server_close(self):
+        self.closed = True
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+class _PendingJob(object):
+    """Book-keeping for a job L{ExtractionServer.submit} has queued."""
+    pid = None  #: The worker which picked it up, once known
+    result = None  #: The C{AsyncResult}
+
+    def __init__(self, job, callback):
+        self.job, self.callback = job, callback
+
+_started = None  #: C{(connection, lock)} for L{_run_job} to report to
+
+def _init_worker(connection, lock):
+    """Pool initializer which gives L{_run_job} somewhere to report to."""
+    global _started
+    _started = connection, lock
+
+def _run_job(job_id, job):
+    """Report which worker picked C{job} up so L{ExtractionServer} can tell
+    if it dies, then run it, turning whatever escapes L{_extract_one} into
+    an error result."""
+    connection, lock = _started
+    with lock:
+        connection.send((job_id, os.getpid()))
+    try:
+        return job_id, _extract_one(job)
+    except BaseException as err:
+        return job_id, _error_result(job[0], err)
+
+def _is_alive(pid):
+    """Return whether a process with the given ID exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+def _claim_socket(path):
+    """Remove a stale socket at C{path} but refuse to replace a live one."""
+    if not os.path.exists(path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as err:
+        if err.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.remove(path)
+    else:
+        raise socket.error(errno.EADDRINUSE,
+                           "Already being served: %s" % path)
+    finally:
+        probe.close()
+
+def serve(path, jobs=1, queue_depth=None, options=None):
+    """Run an L{ExtractionServer} until interrupted or sent C{SIGTERM}."""
+    server = ExtractionServer(path, jobs, queue_depth, options)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+#}
+
+def submit(path, paths, target=None, memory_budget=None, ordered=True):
+    """Send an extraction request to the daemon listening at C{path} and
+    yield an L{ExtractionResult} for each archive as it arrives.
+
+    Relative paths are resolved against the current directory before being
+    sent. The arguments are otherwise as for L{unball.api.extract_many}.
+
+    @raises socket.error: The daemon couldn't be reached.
+    @raises ServerError: The daemon rejected the request or disconnected
+        before sending every result.
+    """
+    request = {
+        'paths': [os.path.abspath(x) for x in paths],
+        'target': target and os.path.abspath(target) or None,
+        'memory_budget': memory_budget,
+        'ordered': ordered,
+    }
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for line in sock.makefile('rb'):
+            reply = json.loads(line.decode('utf-8'))
+            if 'result' in reply:
+                yield ExtractionResult(**dict((str(key), value)
+                    for key, value in reply['result'].items()))
+            elif 'done' in reply:
+                return
+            else:
+                raise ServerError(reply.get('error', reply))
+        raise ServerError("Connection closed before all results arrived")
+    finally:
+        sock.close()
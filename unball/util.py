@@ -2,13 +2,34 @@
 __author__  = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "GNU GPL 2.0 or later"
 
-import errno, os, shutil, tempfile
+import errno, os, shutil, subprocess, sys, tempfile, threading, time
+import warnings
+from contextlib import contextmanager
+from stat import S_IMODE, S_IRUSR, S_ISDIR, S_ISLNK, S_IXUSR
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 #{ Exceptions
 
 class UnballError(Exception):
     """Base class for all Unball-internal exceptions."""
 
+class StagingOverflow(UnballError):
+    """Extraction into a memory-backed staging directory outgrew its budget.
+    (The caller should retry with on-disk staging)"""
+
+class OutputLimitExceeded(UnballError):
+    """An archive would unpack (or was aborted while unpacking) to more than
+    its L{OutputLimits} allow. (eg. A decompression bomb)"""
+
+class CrossDeviceWarning(UserWarning):
+    """Issued when extracted files have to be copied rather than renamed into
+    place because no staging directory was usable on the target's
+    filesystem."""
+
 #}
 #{ Classes
 
@@ -73,20 +94,38 @@ class TempTarget(NamedTemporaryFolder):
       context manager is to instantiate it within the C{with} statement.
 
     """
+    same_device = None  #: Whether publishing is a single rename
+    bytes_copied = 0  #: Bytes copied on publish when C{same_device} is False
+    copy_seconds = 0.0  #: How long that copy took
+    guard = None  #: The L{StagingGuard} when staging in memory
+    output_guard = None  #: The L{OutputGuard} when given an C{output_limit}
+    publish_seconds = 0.0  #: Time taken to move the result into place
+
     def __init__(self, target, suffix="", prefix=tempfile.template,
-                 parent=None, collapse=False):
+                 parent=None, collapse=False, memory_budget=None,
+                 output_limit=None):
         """
         @param suffix: See C{tempfile.mkstemp(suffix)}
         @param prefix: See C{tempfile.mkstemp(prefix)}
-        @param parent: See C{tempfile.mkstemp(dir)}
+        @param parent: See C{tempfile.mkstemp(dir)}. Only used if it's on the
+            same filesystem as C{target} or nothing else is usable.
 
         @param target: Target directory to move to on successful completion.
         @param collapse: If C{True} and the temporary directory contains only
             one entry when the context manager exits, rename that file or
             folder to the target path rather than the temporary directory.
+        @param memory_budget: If given, stage in a RAM-backed directory (see
+            L{memory_staging_dir}) and raise L{StagingOverflow} from the
+            C{with} block if the staged files grow beyond this many bytes.
+            Falls back to normal staging if no such directory has room.
+        @param output_limit: If given, raise L{OutputLimitExceeded} from the
+            C{with} block if the staged files grow beyond this many bytes,
+            wherever they're staged. (See L{OutputGuard})
 
         @type target: C{basestring}
         @type collapse: C{bool}
+        @type memory_budget: C{int}
+        @type output_limit: C{int}
 
         @todo: Figure out how to get rid of the "src" parameter.
         """
@@ -94,15 +133,95 @@ class TempTarget(NamedTemporaryFolder):
 
         self.target = target
         self.collapse = collapse
+        self.memory_budget = memory_budget
+        self.output_limit = output_limit
+
+    def __enter__(self):
+        """Create the temporary directory on the same filesystem as the
+        target's parent directory if at all possible, so that L{__exit__} can
+        publish it with a single C{rename}.
+
+        @returns: The path to the temporary directory.
+        @rtype: C{str}
+        @raises OSError: No candidate location was usable.
+        """
+        self.tmp = self._mkdtemp()
+        if self.output_limit is not None:
+            self.output_guard = OutputGuard(self.tmp, self.output_limit)
+            self.output_guard.start()
+        return self.tmp
+
+    def _mkdtemp(self):
+        """Create the temporary directory for L{__enter__}."""
+        memory_dir = self.memory_budget and memory_staging_dir(
+            self.memory_budget)
+        if memory_dir:
+            try:
+                self.tmp = tempfile.mkdtemp(suffix=self.suffix,
+                                            prefix=self.prefix,
+                                            dir=memory_dir)
+            except OSError:
+                pass
+            else:
+                self.same_device = False
+                self.guard = StagingGuard(self.tmp, self.memory_budget)
+                self.guard.start()
+                return self.tmp
+
+        target_dir = os.path.dirname(os.path.abspath(self.target))
+        target_dev = _device(target_dir)
+
+        candidates = []
+        for path in (self.parent, target_dir, tempfile.gettempdir()):
+            if path not in candidates:
+                candidates.append(path)
+        candidates.sort(key=lambda x: target_dev is None or
+                        _device(x) != target_dev)
+
+        error = None
+        for parent in candidates:
+            try:
+                self.tmp = tempfile.mkdtemp(suffix=self.suffix,
+                                            prefix=self.prefix, dir=parent)
+            except OSError as err:
+                error = err
+                continue
+
+            self.same_device = (target_dev is not None and
+                                _device(parent) == target_dev)
+            if not self.same_device:
+                warnings.warn("Staging %s on a different filesystem (%s). "
+                    "Publishing it will require a full copy." % (
+                        self.target, parent), CrossDeviceWarning)
+            return self.tmp
+        raise error
 
     def __exit__(self, exc_type, exc_value, traceback):
         """
-        @raises OSError: Target path exists.
+        @raises OSError: The target path already exists. (C{EEXIST}, claimed
+          atomically so a concurrent extraction can't slip in between)
         @raises OSError: Failed to delete temporary directory
         @raises NothingProducedError: The context exited cleanly but the temp
           directory contained no files.
+        @raises StagingOverflow: The extraction failed because it was aborted
+          for exceeding C{memory_budget}.
+        @raises OutputLimitExceeded: The extraction failed because it was
+          aborted for exceeding C{output_limit}.
         """
         try:
+            for guard in (self.output_guard, self.guard):
+                if guard:
+                    guard.stop()
+
+            if self.output_guard and self.output_guard.exceeded:
+                # (Even if the extractor finished before it was noticed)
+                raise OutputLimitExceeded("Extracting %s produced more "
+                    "than %d bytes" % (self.target, self.output_limit))
+            if self.guard:
+                if exc_type and self.guard.exceeded:
+                    raise StagingOverflow("Staging %s needed more than %d "
+                        "bytes of RAM" % (self.target, self.memory_budget))
+
             #TODO: Unit test to ensure exception are always passed through.
             if exc_type:
                 return  # Just let the "finally" clause fire on errors
@@ -113,12 +232,11 @@ class TempTarget(NamedTemporaryFolder):
                 if len(contents) == 1:
                     move_from = os.path.join(self.tmp, contents[0])
 
+            started = time.time()
             #TODO: --overwrite handling should probably go here?
-            if os.path.exists(self.target):
-                raise OSError(errno.EEXIST, os.strerror(errno.EEXIST),
-                              self.target)
-            else:
-                shutil.move(move_from, self.target)
+            # Claim the name atomically rather than checking for it first
+            # so concurrent extractions (--jobs) can't replace each other.
+            self._publish(move_from, self.target)
 
             # You have to set the umask to retrieve it. :(
             umask = os.umask(0o022)
@@ -128,38 +246,723 @@ class TempTarget(NamedTemporaryFolder):
             # permissions according to the umask.
             perms = os.path.isdir(self.target) and 0o777 or 0o666
             os.chmod(self.target, perms & (~umask))
+            self.publish_seconds = time.time() - started
         finally:
             super(TempTarget, self).__exit__(exc_type, exc_value, traceback)
 
+    def _publish(self, move_from, target):
+        """Rename C{move_from} to C{target}, falling back to a (warned and
+        measured) copy only if they're on different filesystems.
+
+        @raises OSError: C{target} exists. (C{EEXIST}, never replaced)
+        """
+        if self.same_device:
+            try:
+                rename_new(move_from, target)
+                return
+            except OSError as err:
+                if err.errno != errno.EXDEV:  # eg. Separate bind mounts
+                    raise
+
+        # (copy_tree claims each name with mkdir/O_EXCL, so this is safe too)
+        self.bytes_copied, seconds = move_tree(move_from, target)
+        self.copy_seconds = seconds
+        if self.guard:
+            return  # Copying out of RAM is the point, so don't warn
+        warnings.warn("Copied %d bytes across filesystems to publish %s "
+            "(%.1f MiB/s)" % (self.bytes_copied, target,
+                self.bytes_copied / (seconds or 1e-9) / 1048576),
+            CrossDeviceWarning)
+
+class PathIndex(object):
+    """Memoized directory listings for answering L{which} lookups.
+
+    Probing every C{PATH} entry with C{os.path.exists} for every candidate
+    executable costs hundreds of C{stat} calls per archive. This lists each
+    directory once instead and answers subsequent lookups from memory.
+
+    @note: Listings aren't refreshed automatically. Use L{is_current} and
+        L{refresh} in long-running processes.
+    """
+    def __init__(self):
+        self.listings = {}  #: Maps directory paths to sets of entry names
+
+    def listing(self, path):
+        """Return the set of names in C{path}, listing it on first use.
+        Missing or unreadable directories are treated as empty."""
+        if path not in self.listings:
+            try:
+                self.listings[path] = frozenset(os.listdir(path))
+            except OSError:
+                self.listings[path] = frozenset()
+        return self.listings[path]
+
+    def mtimes(self):
+        """Return a C{{path: mtime}} dict for every directory listed so far.
+        (C{None} for directories which couldn't be C{stat}ed)"""
+        return dict((path, _mtime(path)) for path in self.listings)
+
+    def is_current(self, mtimes=None):
+        """Check whether the given (or memoized) directories are unchanged.
+
+        @param mtimes: A dict as returned by L{mtimes}. Defaults to the
+            directories this index has listed.
+        @rtype: C{bool}
+        """
+        mtimes = self.mtimes() if mtimes is None else mtimes
+        return all(_mtime(path) == mtime for path, mtime in mtimes.items())
+
+    def refresh(self):
+        """Discard all memoized listings."""
+        self.listings.clear()
+
+    def which(self, execName, execpath=None):
+        """See L{which}."""
+        if 'nt' in os.name:
+            # TODO: Figure out how to retrieve this list from the OS.
+            # (We can't just use PATHEXT according to
+            #  http://bugs.python.org/issue2200#msg131532 because spawnv
+            #  doesn't support all extensions)
+            suffixes = ['', '.exe', '.com', '.bat', '.cmd']
+        else:
+            suffixes = ['']
+
+        if isinstance(execpath, basestring):
+            execpath = execpath.split(os.pathsep)
+        elif not execpath:
+            execpath = os.environ.get('PATH', os.defpath).split(os.pathsep)
+
+        for path in execpath:
+            path = os.path.expanduser(path)
+            listing = self.listing(path)
+            for suffix in suffixes:
+                if execName + suffix in listing:
+                    return os.path.join(path, execName + suffix)
+        return None  # Couldn't find anything.
+
+class ProcessRegistry(object):
+    """Tracks running child processes by the directory they're extracting
+    into so a L{StagingGuard} (running on another thread) can kill them.
+
+    @note: Processes are only ever C{wait}ed for by the thread which started
+        them. The registry just checks C{returncode}.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = []
+
+    def popen(self, args, owner=None, **kwargs):
+        """Start and register a C{subprocess.Popen}.
+        @param owner: The extraction target the process is writing to.
+        """
+        proc = subprocess.Popen(args, **kwargs)
+        with self._lock:
+            self._procs = [x for x in self._procs if x[1].returncode is None]
+            self._procs.append((owner, proc))
+        return proc
+
+    def check_call(self, args, owner=None, **kwargs):
+        """Like C{subprocess.check_call} but registered. (See L{popen})"""
+        proc = self.popen(args, owner, **kwargs)
+        try:
+            retcode = proc.wait()
+        finally:
+            with self._lock:
+                self._procs = [x for x in self._procs if x[1] is not proc]
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, args)
+        return 0
+
+    def kill(self, owner):
+        """Kill every still-running process registered for C{owner} or a
+        path inside it. (eg. Nested extractions)"""
+        with self._lock:
+            procs = [proc for key, proc in self._procs
+                     if _is_within(key, owner) and proc.returncode is None]
+        for proc in procs:
+            try:
+                proc.kill()
+            except OSError:
+                pass  # Exited in the meantime
+
+class StagingGuard(object):
+    """Watches the size of a memory-backed staging directory from a
+    background thread.
+
+    Once C{budget} is exceeded, child processes registered in L{CHILDREN} for
+    the directory are killed and in-process extractors are stopped the next
+    time they call L{check_staging}. In-process extractors also report what
+    they're about to write, so they're stopped before a single large write
+    rather than up to C{interval} after it.
+    """
+    error = StagingOverflow  #: Raised by L{check}
+    def __init__(self, path, budget, interval=0.25):
+        """
+        @param path: The staging directory.
+        @param budget: The size limit in bytes.
+        @param interval: Seconds between size checks.
+        """
+        self.path = path
+        self.budget = budget
+        self.interval = interval
+        self.exceeded = False
+        self.written = 0  #: Bytes reported via L{charge}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Begin watching in a daemon thread."""
+        _GUARDS.add(self)
+        self._thread = threading.Thread(target=self._run,
+                                        name="unball staging guard")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching. (Safe to call more than once)"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        _GUARDS.discard(self)
+
+    def check(self):
+        """@raises StagingOverflow: The budget has been exceeded.
+        (Or L{error}, in subclasses)"""
+        if self.exceeded:
+            raise self.error("Extraction into %s exceeded its %d byte "
+                             "budget" % (self.path, self.budget))
+
+    def charge(self, size):
+        """Count C{size} bytes an in-process extractor is about to write,
+        then L{check}.
+
+        @raises StagingOverflow: They'd take the total written past the
+            budget. (Or L{error}, in subclasses)
+        """
+        self.written += size
+        if self.written > self.budget:
+            self.exceeded = True
+        self.check()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                size = tree_size(self.path)
+            except OSError:
+                continue  # Entries vanished mid-walk. Try again later.
+            if size > self.budget:
+                self.exceeded = True
+                CHILDREN.kill(self.path)
+                return
+
+class OutputGuard(StagingGuard):
+    """A L{StagingGuard} for the hard L{OutputLimits} on an extraction,
+    wherever it's staged. Exceeding them fails the extraction with
+    L{OutputLimitExceeded} rather than having it retried on disk.
+
+    Checks are less frequent since the tree may be large and on disk.
+    """
+    error = OutputLimitExceeded
+
+    def __init__(self, path, budget, interval=1.0):
+        super(OutputGuard, self).__init__(path, budget, interval)
+
+    def stop(self):
+        """Stop watching, measuring once more in case extraction finished
+        between checks."""
+        super(OutputGuard, self).stop()
+        try:
+            self.exceeded = self.exceeded or tree_size(self.path) > self.budget
+        except OSError:
+            pass  # Already cleaned up
+
+class OutputLimits(object):
+    """Caps on how much a single archive may unpack to, to stop
+    decompression bombs (or corrupt archives) from filling the disk.
+
+    They're checked against the member listing before extracting, where one
+    is cheap to get, and by an L{OutputGuard} while extracting. (Which
+    in-process extractors consult before each write)
+
+    @param ratio: The largest allowed ratio of output to archive size.
+        (Never less than L{RATIO_FLOOR} bytes)
+    @param size: The largest allowed output in bytes.
+
+    @note: The ratio is taken against the whole archive rather than the
+        bytes read so far, since subprocesses don't report their progress.
+    """
+    RATIO_FLOOR = 64 * 1024
+    """The smallest budget C{ratio} gives, so tiny (eg. empty) archives
+    aren't limited to nothing."""
+
+    def __init__(self, ratio=None, size=None):
+        self.ratio, self.size = ratio, size
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.ratio,
+                               self.size)
+
+    def budget(self, path):
+        """Return the most bytes extracting the archive at C{path} may
+        produce, or C{None} for no limit."""
+        limits = []
+        if self.size is not None:
+            limits.append(self.size)
+        if self.ratio is not None:
+            limits.append(max(int(self.ratio * os.path.getsize(path)),
+                              self.RATIO_FLOOR))
+        return min(limits) if limits else None
+
+class ExtractionStats(object):
+    """Per-phase wall-clock timings and resource usage for one archive.
+
+    Phases are named by the caller and accumulate if entered more than once.
+    Resource usage is the C{getrusage} difference across L{measure} blocks,
+    both for this process (in-process extractors) and for waited-for child
+    processes (subprocess extractors).
+
+    @note: C{max_rss_kib} for children is the largest of any child this
+        process has reaped so far, as that's all C{getrusage} reports.
+    """
+    def __init__(self):
+        self.phases = []  #: C{[name, seconds]} pairs in first-entered order
+        self.info = {}  #: Extra details such as the mimetype and extractor
+        self.process = {}  #: L{measure}d usage by this process
+        self.children = {}  #: L{measure}d usage by child processes
+
+    @contextmanager
+    def phase(self, name):
+        """Time the C{with} block as part of phase C{name}."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def add(self, name, seconds):
+        """Add C{seconds} to phase C{name}."""
+        for entry in self.phases:
+            if entry[0] == name:
+                entry[1] += seconds
+                return
+        self.phases.append([name, seconds])
+
+    @contextmanager
+    def measure(self):
+        """Accumulate C{getrusage} deltas for the C{with} block."""
+        if not resource:
+            yield
+            return
+        before = [resource.getrusage(x) for x in
+                  (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        try:
+            yield
+        finally:
+            after = [resource.getrusage(x) for x in
+                     (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+            for totals, old, new in zip((self.process, self.children),
+                                        before, after):
+                for key, value in _rusage_delta(old, new).items():
+                    if key == 'max_rss_kib':
+                        totals[key] = max(totals.get(key, 0), value)
+                    else:
+                        totals[key] = totals.get(key, 0) + value
+
+    @property
+    def total(self):
+        """The sum of all phase times in seconds."""
+        return sum(x[1] for x in self.phases)
+
+    def as_dict(self):
+        """Return a JSON-serializable summary."""
+        result = dict(self.info)
+        result.update(phases=dict(self.phases), total=self.total,
+                      process=self.process, children=self.children)
+        return result
+
+#}
+
+def _rusage_delta(before, after):
+    """Summarize the difference between two C{getrusage} results."""
+    rss = after.ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024  # Bytes there, KiB elsewhere
+    return {
+        'user_seconds': after.ru_utime - before.ru_utime,
+        'system_seconds': after.ru_stime - before.ru_stime,
+        'max_rss_kib': rss,
+        'blocks_in': after.ru_inblock - before.ru_inblock,
+        'blocks_out': after.ru_oublock - before.ru_oublock,
+    }
+
+_scandir = getattr(os, 'scandir', None)  # Python 3.5+
+
+def _lstat_entries(path):
+    """Yield C{(name, lstat_result)} for every entry in a directory, using
+    C{os.scandir}'s cached entry data where available."""
+    if _scandir:
+        for entry in _scandir(path):
+            yield entry.name, entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            yield name, os.lstat(os.path.join(path, name))
+
+def normalize_permissions(root):
+    """Ensure the owner can read every file and list every directory below
+    C{root} so unball can't leave behind files with 000 permissions.
+
+    Each entry is C{lstat}ed exactly once and only entries which actually
+    lack the required bits are C{chmod}ed. Symlinks are never followed.
+
+    @param root: The directory to process. (Assumed to be accessible)
+    @type root: C{str}
+
+    @return: The number of entries which had to be changed.
+    @rtype: C{int}
+    """
+    changed = 0
+    pending = [root]
+    while pending:
+        parent = pending.pop()
+        for name, st in _lstat_entries(parent):
+            mode = st.st_mode
+            if S_ISLNK(mode):
+                continue
+            path = os.path.join(parent, name)
+
+            is_dir = S_ISDIR(mode)
+            wanted = is_dir and (S_IRUSR | S_IXUSR) or S_IRUSR
+            if mode & wanted != wanted:
+                # Directories must be fixed before they can be listed
+                os.chmod(path, S_IMODE(mode) | wanted)
+                changed += 1
+            if is_dir:
+                pending.append(path)
+    return changed
+
+def tree_size(path):
+    """Return the total size in bytes of the files in (or at) C{path}.
+    Symlinks are counted but not followed."""
+    st = os.lstat(path)
+    if not S_ISDIR(st.st_mode):
+        return st.st_size
+
+    total, pending = 0, [path]
+    while pending:
+        parent = pending.pop()
+        for name, st in _lstat_entries(parent):
+            if S_ISDIR(st.st_mode):
+                pending.append(os.path.join(parent, name))
+            else:
+                total += st.st_size
+    return total
+
+def rename_new(src, dst):
+    """Like C{os.rename} but atomically fail with C{EEXIST} rather than
+    replacing C{dst} if it already exists.
+
+    Directories claim C{dst} with C{os.mkdir} and then C{rename} over the
+    empty placeholder. Everything else is hardlinked into place and unlinked
+    from C{src}, falling back to a checked C{rename} on filesystems without
+    hardlinks.
+
+    @raises OSError: C{EEXIST} or anything C{os.rename} can raise.
+    """
+    if os.path.isdir(src) and not os.path.islink(src):
+        os.mkdir(dst)
+        try:
+            os.rename(src, dst)
+        except OSError:
+            os.rmdir(dst)
+            raise
+        return
+
+    try:
+        os.link(src, dst)
+    except OSError as err:
+        if err.errno not in _UNSUPPORTED or err.errno == errno.EXDEV:
+            raise
+        if os.path.lexists(dst):  # (Best effort. eg. FAT, some FUSE mounts)
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        os.rename(src, dst)
+    else:
+        os.remove(src)
+
+#{ Cross-device moves
+
+COPY_THREADS = 8
+"""Default number of files L{move_tree} copies at once. Copying is I/O-bound
+(and releases the GIL) so this doesn't depend on the CPU count."""
+
+COPY_THREAD_MIN = 4 * 1024 * 1024
+"""Trees with fewer bytes than this are copied serially since starting and
+stopping a thread pool costs more than it saves. (About 0.1s)"""
+
+COPY_BUFFER_SIZE = 1024 * 1024  #: Chunk size for the read/write fallback
+
+_FICLONE = sys.platform.startswith('linux') and 0x40049409 or None
+_copy_file_range = getattr(os, 'copy_file_range', None)  # Python 3.8+
+_sendfile = getattr(os, 'sendfile', None)  # Python 3.3+
+_UNSUPPORTED = frozenset(getattr(errno, x) for x in (
+    'EBADF', 'EINVAL', 'ENOSYS', 'ENOTSUP', 'ENOTTY', 'EOPNOTSUPP', 'EPERM',
+    'EXDEV') if hasattr(errno, x))
+"""Errors meaning "this copying method won't work here" rather than an
+actual I/O failure."""
+
+def _reflink(src_fd, dst_fd, size):
+    """Share C{src_fd}'s extents with C{dst_fd} (btrfs, XFS, etc.)"""
+    import fcntl
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+    return size
+
+def _kernel_copy(copier):
+    """Wrap C{os.copy_file_range} or C{os.sendfile} as a whole-file copier.
+    """
+    def copy(src_fd, dst_fd, size):
+        copied = 0
+        while copied < size:
+            if copier is _sendfile:
+                count = copier(dst_fd, src_fd, copied, size - copied)
+            else:
+                count = copier(src_fd, dst_fd, size - copied)
+            if not count:
+                break
+            copied += count
+        return copied
+    return copy
+
+def _buffered_copy(src_fd, dst_fd, size):
+    """Copy through userspace buffers. (Works everywhere)"""
+    copied = 0
+    while True:
+        block = os.read(src_fd, COPY_BUFFER_SIZE)
+        if not block:
+            return copied
+        while block:
+            written = os.write(dst_fd, block)
+            block = block[written:]
+            copied += written
+
+_COPIERS = [x for x in (_FICLONE and _reflink,
+                        _copy_file_range and _kernel_copy(_copy_file_range),
+                        _sendfile and _kernel_copy(_sendfile)) if x]
+_COPIERS.append(_buffered_copy)
+
+def copy_file(src, dst):
+    """Copy a regular file's contents and metadata (as C{shutil.copy2}),
+    using the cheapest method the OS and filesystems support.
+
+    @return: The number of bytes copied.
+    @raises OSError: C{dst} already exists.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            for copier in _COPIERS:
+                try:
+                    copied = copier(src_fd, dst_fd, size)
+                    break
+                except (IOError, OSError) as err:
+                    if (err.errno not in _UNSUPPORTED or
+                            os.lseek(dst_fd, 0, os.SEEK_END)):
+                        raise  # A real error or a partial copy
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+    return copied
+
+def copy_tree(src, dst, threads=None, copier=copy_file):
+    """Recursively copy the directory C{src} to C{dst}, copying files on a
+    thread pool. Symlinks are recreated rather than followed.
+
+    If anything fails, the partial copy is removed.
+
+    @param threads: Number of files to copy at once. (Default:
+        L{COPY_THREADS}, or 1 for trees smaller than L{COPY_THREAD_MIN})
+    @param copier: The function called as C{copier(src, dst)} to copy each
+        file and return the number of bytes copied.
+    @return: The number of bytes copied.
+    @raises OSError: C{dst} already exists.
+    """
+    os.mkdir(dst)  # Raises EEXIST rather than merging into an existing dir
+    try:
+        # Create the skeleton serially so workers only ever write files
+        files, dirs, pending = [], [(src, dst)], [(src, dst)]
+        total = 0
+        while pending:
+            src_dir, dst_dir = pending.pop()
+            for name, st in _lstat_entries(src_dir):
+                src_path = os.path.join(src_dir, name)
+                dst_path = os.path.join(dst_dir, name)
+                if S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(src_path), dst_path)
+                elif S_ISDIR(st.st_mode):
+                    os.mkdir(dst_path)
+                    dirs.append((src_path, dst_path))
+                    pending.append((src_path, dst_path))
+                else:
+                    files.append((src_path, dst_path))
+                    total += st.st_size
+
+        copied = 0
+        if not threads:
+            threads = total < COPY_THREAD_MIN and 1 or COPY_THREADS
+        threads = min(threads, len(files))
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+            try:
+                copied = sum(pool.imap_unordered(lambda x: copier(*x),
+                                                 files))
+            finally:
+                pool.terminate()
+        else:
+            copied = sum(copier(*x) for x in files)
+
+        # Directory mtimes last, deepest first, since copying changes them
+        for src_dir, dst_dir in reversed(dirs):
+            shutil.copystat(src_dir, dst_dir)
+    except BaseException:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+    return copied
+
+def move_tree(src, dst, threads=None):
+    """Move a file or directory tree across filesystems, copying files on a
+    thread pool, then delete C{src}. Like C{shutil.move}, symlinks are
+    recreated rather than followed.
+
+    If anything fails, the partial copy is removed and C{src} is left intact.
+
+    @param threads: Number of files to copy at once.
+        (Default: L{COPY_THREADS})
+    @return: C{(bytes_copied, seconds)}
+    @raises OSError: C{dst} already exists.
+    """
+    started = time.time()
+    if not os.path.isdir(src) or os.path.islink(src):
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+            copied = 0
+        else:
+            copied = copy_file(src, dst)
+        os.remove(src)
+        return copied, time.time() - started
+
+    copied = copy_tree(src, dst, threads)
+    shutil.rmtree(src)
+    return copied, time.time() - started
+
 #}
 
+PATH_INDEX = PathIndex()
+"""The L{PathIndex} shared by L{which} and the extractor dispatch table."""
+
+CHILDREN = ProcessRegistry()
+"""The L{ProcessRegistry} extractors start their subprocesses through."""
+
+_GUARDS = set()  # Active StagingGuards
+
+def check_staging(path, size=0):
+    """Let in-process extractors bail out of an extraction which has grown
+    too large. Call periodically with the extraction target.
+
+    @param size: Bytes about to be written into C{path}, which are counted
+        against the budgets up front. (See L{StagingGuard.charge})
+
+    @raises StagingOverflow: C{path} is (or is inside) a directory watched
+        by a L{StagingGuard} whose budget has been (or would be) exceeded.
+    @raises OutputLimitExceeded: Likewise, for an L{OutputGuard}.
+    """
+    for guard in list(_GUARDS):
+        if _is_within(path, guard.path):
+            guard.charge(size)
+
+def _is_within(path, parent):
+    """Return whether C{path} is C{parent} or somewhere inside it."""
+    return bool(path) and (path == parent or
+                           path.startswith(parent.rstrip(os.sep) + os.sep))
+
+MEMORY_DIRS = ('/dev/shm', '/run/shm')
+"""RAM-backed (tmpfs) directories to try for C{--stage-in-memory}, after
+C{$UNBALL_MEMORY_DIR} and before C{$XDG_RUNTIME_DIR}."""
+
+def memory_staging_dir(budget):
+    """Return a writable RAM-backed directory with at least C{budget} bytes
+    free, or C{None} if there isn't one."""
+    candidates = ([os.environ.get('UNBALL_MEMORY_DIR')] + list(MEMORY_DIRS) +
+                  [os.environ.get('XDG_RUNTIME_DIR')])
+    for path in candidates:
+        if not (path and os.path.isdir(path) and
+                os.access(path, os.W_OK | os.X_OK)):
+            continue
+        if (free_space(path) or 0) >= budget:
+            return path
+    return None
+
+def free_space(path):
+    """Return the bytes available to unprivileged users on the filesystem
+    holding C{path}, or C{None} if that can't be determined."""
+    try:
+        st = os.statvfs(path)
+    except (AttributeError, OSError):  # No statvfs on Windows
+        return None
+    return st.f_bavail * st.f_frsize
+
+def parse_size(text):
+    """Parse a size like C{50M} or C{1.5G} (binary units) into bytes.
+
+    @raises ValueError: C{text} isn't a valid size.
+    """
+    text = text.strip().upper().rstrip('B').rstrip('I')
+    power = 'KMGT'.find(text[-1:]) + 1 if text else 0
+    if power:
+        text = text[:-1]
+    size = int(float(text) * 1024 ** power)
+    if size < 0:
+        raise ValueError("Sizes can't be negative: %s" % text)
+    return size
+
+def _mtime(path):
+    """Return the C{st_mtime} of C{path} or C{None} if it can't be read."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _device(path):
+    """Return the C{st_dev} of C{path} or C{None} if it can't be read."""
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+def cache_dir():
+    """Return the directory unball should use for persistent caches.
+
+    Honours C{$UNBALL_CACHE_DIR}, then the XDG Base Directory spec.
+    The directory is not guaranteed to exist or be writable.
+    """
+    path = os.environ.get('UNBALL_CACHE_DIR')
+    if not path:
+        path = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.expanduser('~/.cache'), 'unball')
+    return path
+
 def which(execName, execpath=None):
     """Like the UNIX which command, this function attempts to find the given
     executable in the system's search path. Returns C{None} if it cannot find
     anything.
 
+    Lookups go through L{PATH_INDEX} so each search path entry is only
+    listed once per process.
+
     @todo: Find the copy I extended with win32all and use it here.
     @todo: Figure out how to "pragma: no cover" conditional on os.name.
     """
-    if 'nt' in os.name:
-        # TODO: Figure out how to retrieve this list from the OS.
-        # (We can't just use PATHEXT according to
-        #  http://bugs.python.org/issue2200#msg131532 because spawnv doesn't
-        #  support all extensions)
-        suffixes = ['.exe', '.com', '.bat', '.cmd']
-    else:
-        suffixes = []
-
-    if isinstance(execpath, basestring):
-        execpath = execpath.split(os.pathsep)
-    elif not execpath:
-        execpath = os.environ.get('PATH', os.defpath).split(os.pathsep)
-
-    for path in execpath:
-        fullPath = os.path.join(os.path.expanduser(path), execName)
-        if os.path.exists(fullPath):
-            return fullPath
-        for suffix in suffixes:
-            if os.path.exists(fullPath + suffix):
-                return fullPath + suffix
-    return None  # Couldn't find anything.
+    return PATH_INDEX.which(execName, execpath)
@@ -0,0 +1,261 @@
+"""Watch-folder mode: extract files as soon as they finish arriving in a
+directory, using Linux's inotify via C{ctypes} rather than polling.
+
+Files are picked up on C{IN_CLOSE_WRITE} (written in place) or
+C{IN_MOVED_TO} (renamed in) and processed once no further events have
+arrived for them for L{SETTLE_DELAY} seconds, so a file which is rewritten
+or appended to in several passes is only sniffed once it has settled.
+Files found by scanning the directory (at startup or after lost events)
+must instead go that long without changing size or mtime.
+
+Every processed file is remembered by C{(inode, size, mtime)} in a
+L{SeenFiles} cache so that non-archives and failed extractions are never
+re-sniffed (and successes never re-extracted) until they change, even across
+restarts.
+
+@todo: Watch subdirectories too.
+"""
+
+__author__  = "Stephan Sokolow (deitarion/SSokolow)"
+__license__ = "GNU GPL 2.0 or later"
+
+import ctypes, ctypes.util, errno, hashlib, json, os, select, stat, struct
+import sys, tempfile, time
+
+from .api import _extract_one
+from .util import cache_dir
+
+SETTLE_DELAY = 1.0  #: Seconds a file must go without events to be processed
+
+#{ inotify
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')  #: wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+class Inotify(object):
+    """A minimal C{ctypes} binding for the inotify API.
+
+    @raises OSError: inotify isn't available on this platform.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS,
+                          "inotify is not available on this platform")
+        self._add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        """Watch C{path} for the events in C{mask}.
+
+        @return: The watch descriptor.
+        """
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout=None):
+        """Wait up to C{timeout} seconds for events.
+
+        @return: C{(mask, name)} tuples, with C{name} relative to the watched
+            directory (empty for events on the directory itself).
+        @rtype: C{list}
+        """
+        try:
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return []
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+
+        buf, pos, events = os.read(self.fd, READ_SIZE), 0, []
+        while pos < len(buf):
+            _, mask, _, length = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = buf[pos:pos + length].rstrip(b'\0')
+            pos += length
+            events.append((mask, name.decode(sys.getfilesystemencoding())))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+#}
+
+class SeenFiles(object):
+    """A persistent record of files which have already been processed,
+    keyed by path and invalidated by changes to C{(inode, size, mtime)}.
+
+    @param cache_path: The JSON file to persist to, or C{None} to only keep
+        the record in memory.
+    """
+    dirty = False  #: Whether there are changes L{save} hasn't written yet
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.entries = {}
+        if cache_path:
+            try:
+                with open(cache_path, 'rb') as fobj:
+                    self.entries = dict(json.load(fobj))
+            except (IOError, OSError, ValueError, TypeError):
+                pass
+
+    @staticmethod
+    def _key(st):
+        return [st.st_ino, st.st_size, st.st_mtime]
+
+    def __contains__(self, item):
+        """C{(path, stat_result)} in L{SeenFiles}"""
+        path, st = item
+        entry = self.entries.get(path)
+        return bool(entry) and entry[0] == self._key(st)
+
+    def add(self, path, st, errcode=None):
+        """Remember that C{path}, as described by C{st}, was processed with
+        the given C{unball} exit code."""
+        self.entries[path] = [self._key(st), errcode]
+        self.dirty = True
+
+    def prune(self, directory):
+        """Forget files in C{directory} which no longer exist."""
+        for path in list(self.entries):
+            if (os.path.dirname(path) == directory and
+                    not os.path.exists(path)):
+                del self.entries[path]
+                self.dirty = True
+
+    def save(self):
+        """Atomically write the record to C{cache_path} if it has changed,
+        ignoring failures since the cache is purely an optimization."""
+        if not (self.cache_path and self.dirty):
+            return
+        parent = os.path.dirname(self.cache_path)
+        try:
+            try:
+                os.makedirs(parent)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            fd, tmp = tempfile.mkstemp(prefix='.watch-', dir=parent)
+            with os.fdopen(fd, 'w') as fobj:
+                json.dump(self.entries, fobj)
+            os.rename(tmp, self.cache_path)
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+def default_cache_path(directory):
+    """Return the L{SeenFiles} cache path for a watched directory."""
+    directory = os.path.abspath(directory)
+    if not isinstance(directory, bytes):
+        directory = directory.encode(sys.getfilesystemencoding())
+    digest = hashlib.sha1(directory)
+    return os.path.join(cache_dir(), 'watch-%s.json' % digest.hexdigest())
+
+def watch(directory, target=None, options=None, settle=SETTLE_DELAY,
+          seen=None):
+    """Extract files which appear in C{directory} until interrupted,
+    starting with any already present which haven't been seen before.
+
+    @param target: The directory to extract into. (Default: C{directory})
+        Single-file outputs are added to C{seen} so they aren't processed
+        in turn if they land in C{directory}.
+    @param options: Extra keyword arguments for L{tryExtract}.
+    @param settle: See L{SETTLE_DELAY}.
+    @param seen: The L{SeenFiles} to consult and update.
+        (Default: one persisted to L{default_cache_path})
+
+    @return: An L{ExtractionResult} for each file processed.
+    @rtype: generator
+    """
+    directory = os.path.abspath(directory)
+    if seen is None:
+        seen = SeenFiles(default_cache_path(directory))
+    seen.prune(directory)
+
+    inotify = Inotify()
+    pending, unsettled = {}, {}
+
+    def rescan():
+        """Schedule every file not already pending. Any of them may still
+        be being written, with no event until it's closed, so they settle
+        like the rest and are rescheduled if they changed meanwhile."""
+        for path in _listdir(directory):
+            if path not in pending:
+                pending[path] = time.time() + settle
+                unsettled[path] = _signature(path)
+
+    try:
+        inotify.add_watch(directory, IN_CLOSE_WRITE | IN_MOVED_TO)
+        rescan()
+
+        while True:
+            for path in sorted(x for x, due in pending.items()
+                               if due <= time.time()):
+                del pending[path]
+                if path in unsettled:
+                    before, after = unsettled.pop(path), _signature(path)
+                    if after != before:
+                        pending[path] = time.time() + settle
+                        unsettled[path] = after
+                        continue
+                result = _process(path, target, options or {}, seen)
+                if result:
+                    yield result
+            seen.save()  # Once per batch. (Rewriting it per file is O(n^2))
+
+            timeout = None
+            if pending:
+                timeout = max(0, min(pending.values()) - time.time())
+            for mask, name in inotify.read(timeout):
+                if mask & IN_Q_OVERFLOW:  # Events were lost. Rescan.
+                    rescan()
+                elif name and not mask & IN_ISDIR:
+                    path = os.path.join(directory, name)
+                    pending[path] = time.time() + settle
+                    unsettled.pop(path, None)  # Now reported on close
+    finally:
+        inotify.close()
+        seen.save()
+
+def _listdir(directory):
+    return [os.path.join(directory, x) for x in os.listdir(directory)]
+
+def _signature(path):
+    """Return what L{watch} compares to tell whether C{path} is still
+    changing. (C{None} if it's gone)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+def _process(path, target, options, seen):
+    """Extract C{path} unless it's gone, not a file, or in C{seen}."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode) or (path, st) in seen:
+        return None
+
+    result = _extract_one((path, target, options))
+    seen.add(path, st, result.errcode)
+    if result.target and os.path.isfile(result.target):
+        seen.add(result.target, os.stat(result.target))
+    return result